@@ -0,0 +1,379 @@
+"""This module implements the 'async_server' input method of decode.py.
+It accepts the same JSON-lines protocol as the ``server`` module, but
+decodes many requests concurrently instead of one after another.
+
+Every request is handled by a coroutine which runs the (synchronous)
+``Decoder.decode()`` of its own decoder instance in a worker thread.
+The decodes themselves are not coroutines: all decoders call their
+predictors synchronously from deep inside their search loops, so a
+decoding thread blocks on a ``concurrent.futures.Future`` for each
+model call instead of awaiting it. Turning every decoder into a
+coroutine would mean rewriting all search strategies, while the
+threads only wait and do not compete for the model. Thus, the number
+of requests decoded at the same time is bounded by the number of
+threads (--server_max_concurrent).
+The decoders do not call the model directly. Each request gets a
+``BatchedPredictor`` which wraps its own fork of the resident predictor
+(see ``Predictor.fork()``) and turns every call of the model into a
+future. A central ``Batcher`` coroutine collects these futures from all
+in-flight requests, up to --server_max_batch calls or until
+--server_batch_wait milliseconds have passed, and evaluates them in a
+single model thread with ``Predictor.predict_next_batch()``. Model
+calls are thus serialized and coalesced across requests. How much a
+batch saves depends on the predictor: ``FairseqPredictor`` runs one
+forward pass for all calls with the same target prefix length and
+source sentence length, while predictors without a batched
+implementation evaluate the calls one after another.
+
+Per-request latencies are collected in a ``LatencyHistogram``. Sending
+``{"command": "stats"}`` returns the histogram and latency percentiles.
+"""
+
+import asyncio
+import bisect
+import concurrent.futures
+import json
+import logging
+import os
+import time
+import traceback
+
+import numpy as np
+
+import decode_utils
+import server
+from predictors.core import Predictor
+
+
+class LatencyHistogram(object):
+    """Histogram of request latencies with logarithmic buckets."""
+
+    BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+               1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0]
+    """Upper bounds of the buckets in seconds. The last bucket is
+    unbounded."""
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        """Adds a latency in seconds to the histogram."""
+        self.counts[bisect.bisect_left(self.BUCKETS, latency)] += 1
+        self.total += 1
+        self.sum += latency
+        self.max = max(self.max, latency)
+
+    def percentile(self, q):
+        """Returns an upper bound on the ``q``-th percentile (0-100)
+        from the bucket boundaries."""
+        if not self.total:
+            return 0.0
+        rank = q / 100.0 * self.total
+        for bound, count in zip(self.BUCKETS + [self.max], np.cumsum(self.counts)):
+            if count >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        """Returns the histogram in JSON serializable form."""
+        return {"buckets": [["<=%g" % b, c] for b, c in
+                            zip(self.BUCKETS, self.counts)]
+                           + [[">%g" % self.BUCKETS[-1], self.counts[-1]]],
+                "count": self.total,
+                "mean": self.sum / self.total if self.total else 0.0,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class Batcher(object):
+    """Collects model calls of all in-flight requests and evaluates
+    them in a single model thread. ``predict_next()`` calls are
+    coalesced with ``Predictor.predict_next_batch()``.
+    """
+
+    def __init__(self, predictor, max_batch, max_wait):
+        """
+        Args:
+            predictor (Predictor): Resident predictor. Calls are
+                                   evaluated with its
+                                   ``predict_next_batch()``
+            max_batch (int): Maximum number of calls per batch
+            max_wait (float): Maximum time in seconds to wait for
+                              further calls after the first one
+        """
+        self.predictor = predictor
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.loop = None
+        self.queue = None
+        self.model_thread = concurrent.futures.ThreadPoolExecutor(1)
+        self.batch_sizes = []
+
+    def start(self, loop):
+        """Starts the batching coroutine on ``loop``."""
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        return loop.create_task(self.run())
+
+    def call(self, predictor, method, *args):
+        """Schedules ``predictor.method(*args)`` and blocks until it has
+        been evaluated. Called from the decoding threads.
+
+        Returns:
+            object. Return value of the call
+        """
+        return self.call_many([(predictor, method, args)])[0]
+
+    def call_many(self, calls):
+        """Like ``call()`` for a list of (predictor, method, args)
+        tuples. The calls are scheduled together, so they can be
+        evaluated in the same batch.
+
+        Returns:
+            list. Return values of the calls
+        """
+        futures = []
+        for predictor, method, args in calls:
+            future = concurrent.futures.Future()
+            self.loop.call_soon_threadsafe(self.queue.put_nowait,
+                                           (predictor, method, args, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - self.loop.time()
+                try:
+                    if remaining > 0:
+                        batch.append(await asyncio.wait_for(self.queue.get(),
+                                                            remaining))
+                    else:
+                        batch.append(self.queue.get_nowait())
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+            await self.loop.run_in_executor(self.model_thread,
+                                            self.execute, batch)
+
+    def execute(self, batch):
+        """Evaluates a batch of calls in the model thread."""
+        predict_calls = [c for c in batch if c[1] == "predict_next"]
+        if predict_calls:
+            self.batch_sizes.append(len(predict_calls))
+            try:
+                results = self.predictor.predict_next_batch(
+                    [predictor for predictor, _, _, _ in predict_calls])
+                for (_, _, _, future), result in zip(predict_calls, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, _, future in predict_calls:
+                    future.set_exception(e)
+        for predictor, method, args, future in batch:
+            if method == "predict_next":
+                continue
+            try:
+                future.set_result(getattr(predictor, method)(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+
+class BatchedPredictor(Predictor):
+    """Predictor used by the decoder of a single request. It wraps a
+    fork of the resident predictor and routes all calls which need the
+    model through the ``Batcher``.
+    """
+
+    def __init__(self, predictor, batcher):
+        """
+        Args:
+            predictor (Predictor): Fork of the resident predictor
+            batcher (Batcher): Central batcher
+        """
+        super(BatchedPredictor, self).__init__()
+        self.predictor = predictor
+        self.batcher = batcher
+
+    def initialize(self, src_sentence):
+        self.batcher.call(self.predictor, "initialize", src_sentence)
+
+    def predict_next(self):
+        return self.batcher.call(self.predictor, "predict_next")
+
+    def fork(self):
+        return BatchedPredictor(self.predictor.fork(), self.batcher)
+
+    def predict_next_batch(self, predictors):
+        return self.batcher.call_many(
+            [(predictor.predictor, "predict_next", ()) for predictor in predictors])
+
+    def get_initial_dist(self):
+        return self.batcher.call(self.predictor, "get_initial_dist")
+
+    def get_empty_str_prob(self):
+        return self.batcher.call(self.predictor, "get_empty_str_prob")
+
+    def consume(self, word):
+        self.predictor.consume(word)
+
+    def get_state(self):
+        return self.predictor.get_state()
+
+    def set_state(self, state):
+        self.predictor.set_state(state)
+
+    def coalesce_and_set_states(self, states):
+        self.predictor.coalesce_and_set_states(states)
+
+    def set_current_sen_id(self, cur_sen_id):
+        self.predictor.set_current_sen_id(cur_sen_id)
+
+    def get_unk_probability(self, posterior):
+        return self.predictor.get_unk_probability(posterior)
+
+    def is_equal(self, state1, state2):
+        return self.predictor.is_equal(state1, state2)
+
+
+class AsyncDecodeServer(object):
+    """Serves JSON-lines requests and decodes them concurrently."""
+
+    def __init__(self, decoder, args):
+        """Creates a server which reuses the predictor of ``decoder``.
+
+        Args:
+            decoder (Decoder): Decoder created with the SGNMT config
+            args (object): SGNMT configuration
+        """
+        self.args = args
+        self.predictor = decoder.predictor
+        self.batcher = Batcher(self.predictor, args.server_max_batch,
+                               args.server_batch_wait / 1000.0)
+        self.decode_threads = concurrent.futures.ThreadPoolExecutor(
+            max(1, args.server_max_concurrent))
+        self.histogram = LatencyHistogram()
+
+    def decode(self, fields):
+        """Decodes a single request. Runs in a decoding thread."""
+        config = server.request_config(fields, self.args)
+        predictor = BatchedPredictor(self.predictor.fork(), self.batcher)
+        decoder = server.create_decoder(self.args, config, predictor)
+        hypos = decode_utils.decode_sentence(
+            decoder, fields["sentence"].strip(), nbest=config[2])
+        return server.hypos_to_json(hypos), decoder.apply_predictor_count
+
+    async def process_request(self, fields):
+        """Coroutine which decodes a request and returns the response."""
+        received = time.time()
+        loop = asyncio.get_running_loop()
+        try:
+            hypos, num_expansions = await loop.run_in_executor(
+                self.decode_threads, self.decode, fields)
+            response = {"hypos": hypos}
+        except Exception as e:
+            logging.error("Error while processing request: %s Stack trace: %s"
+                          % (e, traceback.format_exc()))
+            response = {"error": "%s: %s" % (type(e).__name__, e)}
+            num_expansions = 0
+        response["id"] = fields.get("id")
+        response["latency"] = time.time() - received
+        self.histogram.add(response["latency"])
+        logging.info("Request (ID: %s): latency=%.3f num_expansions=%d"
+                     % (response["id"], response["latency"], num_expansions))
+        return response
+
+    def stats(self):
+        """Returns the latency histogram and batching statistics."""
+        batch_sizes = self.batcher.batch_sizes
+        return {"latency": self.histogram.to_dict(),
+                "num_batches": len(batch_sizes),
+                "mean_batch_size": float(np.mean(batch_sizes))
+                                   if batch_sizes else 0.0}
+
+    async def handle_connection(self, reader, writer):
+        """Reads requests from a client and writes responses in the
+        order of the requests. Requests on the same connection are
+        decoded concurrently."""
+        pending = asyncio.Queue()
+
+        async def send_responses():
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                writer.write((json.dumps(await task) + "\n").encode('utf-8'))
+                await writer.drain()
+
+        sender = asyncio.ensure_future(send_responses())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                await pending.put(asyncio.ensure_future(self.dispatch(line)))
+        finally:
+            await pending.put(None)
+            await sender
+            writer.close()
+
+    async def dispatch(self, line):
+        try:
+            fields = json.loads(line.decode('utf-8'))
+            if isinstance(fields, dict) and fields.get("command") == "stats":
+                return self.stats()
+            if not isinstance(fields, dict) or "sentence" not in fields:
+                raise ValueError("Request must be a JSON object with a "
+                                 "'sentence' field")
+        except ValueError as e:
+            return {"error": "Invalid request: %s" % e}
+        return await self.process_request(fields)
+
+    async def run(self):
+        """Starts the batcher and serves --server_address forever."""
+        loop = asyncio.get_running_loop()
+        self.batcher.start(loop)
+        address = self.args.server_address
+        if address.startswith("unix:"):
+            path = address[len("unix:"):]
+            if os.path.exists(path):
+                os.remove(path)
+            socket_server = await asyncio.start_unix_server(
+                self.handle_connection, path)
+        else:
+            host, port = address.rsplit(":", 1)
+            socket_server = await asyncio.start_server(
+                self.handle_connection, host, int(port))
+        logging.info("Listening on %s (PID: %d)" % (address, os.getpid()))
+        async with socket_server:
+            await socket_server.serve_forever()
+
+
+def serve(decoder, args):
+    """Starts the asynchronous decoding server and processes requests
+    until it is interrupted.
+
+    Args:
+        decoder (Decoder): Decoder created with the SGNMT config
+        args (object): SGNMT configuration
+    """
+    async_server = AsyncDecodeServer(decoder, args)
+    try:
+        asyncio.run(async_server.run())
+    except KeyboardInterrupt:
+        logging.info("Shutting down server...")
+    finally:
+        logging.info("Server statistics: %s" % json.dumps(async_server.stats()))
+        if args.server_address.startswith("unix:"):
+            try:
+                os.remove(args.server_address[len("unix:"):])
+            except OSError:
+                pass
@@ -0,0 +1,138 @@
+"""This module defines the columnar binary n-best format written by the
+``nbest_bin`` output handler and provides a memory-mapped reader for it.
+
+An n-best directory contains one flat file per column. All files are
+plain little-endian arrays without header, so they can be appended to
+while decoding and mapped with ``np.memmap`` afterwards:
+
+    sen_indices.bin       int64    sentence index (0-indexed) per sentence
+    sen_offsets.bin       int64    num_sentences+1 offsets into hypotheses
+    hypo_offsets.bin      int64    num_hypos+1 offsets into tokens.bin
+    tokens.bin            int32    target token IDs of all hypotheses
+    total_scores.bin      float32  total score per hypothesis
+    base_scores.bin       float32  base score per hypothesis
+    breakdown_offsets.bin int64    num_hypos+1 offsets into breakdown.bin
+    breakdown.bin         float32  per-token score breakdowns
+
+Hypothesis ``i`` of sentence ``j`` is stored at position
+``sen_offsets[j] + i`` in the per-hypothesis arrays.
+"""
+
+import os
+import numpy as np
+
+
+SEN_INDICES = "sen_indices.bin"
+SEN_OFFSETS = "sen_offsets.bin"
+HYPO_OFFSETS = "hypo_offsets.bin"
+TOKENS = "tokens.bin"
+TOTAL_SCORES = "total_scores.bin"
+BASE_SCORES = "base_scores.bin"
+BREAKDOWN_OFFSETS = "breakdown_offsets.bin"
+BREAKDOWN = "breakdown.bin"
+
+
+COLUMNS = {
+    SEN_INDICES: np.dtype('<i8'),
+    SEN_OFFSETS: np.dtype('<i8'),
+    HYPO_OFFSETS: np.dtype('<i8'),
+    TOKENS: np.dtype('<i4'),
+    TOTAL_SCORES: np.dtype('<f4'),
+    BASE_SCORES: np.dtype('<f4'),
+    BREAKDOWN_OFFSETS: np.dtype('<i8'),
+    BREAKDOWN: np.dtype('<f4'),
+}
+"""Maps file names to the dtype of the stored array."""
+
+
+def flatten_breakdown(score_breakdown):
+    """Converts a score breakdown to a flat float32 array with one
+    entry per token. Breakdowns stored as lists of
+    ``(score, weight)`` tuples are reduced to their scores.
+
+    Args:
+        score_breakdown (list): Score breakdown of a hypothesis
+
+    Returns:
+        np.ndarray. float32 array of per-token scores
+    """
+    breakdown = np.asarray(score_breakdown, dtype=COLUMNS[BREAKDOWN])
+    if breakdown.ndim > 1:
+        breakdown = breakdown.reshape(len(breakdown), -1)[:, 0]
+    return breakdown
+
+
+def _memmap(path, dtype):
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class BinaryNBestReader(object):
+    """Read-only view on an n-best directory written by the
+    ``nbest_bin`` output handler. All arrays are memory-mapped, and the
+    accessors return views into the mapped files without copying.
+    """
+
+    def __init__(self, path):
+        """Maps all columns in ``path``.
+
+        Args:
+            path (string): Path to the n-best directory
+        """
+        self.path = path
+        col = lambda file_name: _memmap(os.path.join(path, file_name),
+                                        COLUMNS[file_name])
+        self.sen_indices = col(SEN_INDICES)
+        self.sen_offsets = col(SEN_OFFSETS)
+        self.hypo_offsets = col(HYPO_OFFSETS)
+        self.token_ids = col(TOKENS)
+        self.total_scores = col(TOTAL_SCORES)
+        self.base_scores = col(BASE_SCORES)
+        self.breakdown_offsets = col(BREAKDOWN_OFFSETS)
+        self.breakdown = col(BREAKDOWN)
+
+    def __len__(self):
+        """Returns the number of sentences."""
+        return len(self.sen_indices)
+
+    def num_hypos(self, j):
+        """Returns the number of hypotheses of sentence ``j``."""
+        return int(self.sen_offsets[j+1] - self.sen_offsets[j])
+
+    def _hypo_pos(self, j, i):
+        if not 0 <= i < self.num_hypos(j):
+            raise IndexError("Sentence %d has no hypothesis %d" % (j, i))
+        return self.sen_offsets[j] + i
+
+    def sentence_index(self, j):
+        """Returns the sentence index (0-indexed) of sentence ``j``."""
+        return int(self.sen_indices[j])
+
+    def tokens(self, j, i):
+        """Returns the token IDs of hypothesis ``i`` of sentence ``j``
+        as int32 array view."""
+        pos = self._hypo_pos(j, i)
+        return self.token_ids[self.hypo_offsets[pos]:self.hypo_offsets[pos+1]]
+
+    def total_score(self, j, i):
+        """Returns the total score of hypothesis ``i`` of sentence
+        ``j``."""
+        return float(self.total_scores[self._hypo_pos(j, i)])
+
+    def base_score(self, j, i):
+        """Returns the base score of hypothesis ``i`` of sentence
+        ``j``."""
+        return float(self.base_scores[self._hypo_pos(j, i)])
+
+    def score_breakdown(self, j, i):
+        """Returns the per-token score breakdown of hypothesis ``i`` of
+        sentence ``j`` as float32 array view."""
+        pos = self._hypo_pos(j, i)
+        return self.breakdown[self.breakdown_offsets[pos]:
+                              self.breakdown_offsets[pos+1]]
+
+    def sentence_total_scores(self, j):
+        """Returns the total scores of all hypotheses of sentence
+        ``j`` as float32 array view."""
+        return self.total_scores[self.sen_offsets[j]:self.sen_offsets[j+1]]
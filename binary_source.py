@@ -0,0 +1,89 @@
+"""This module defines the binary format for preprocessed source
+sentences read with --src_test_bin, and provides a memory-mapped reader
+for it. Use ``preprocess.py`` to create such a file from --src_test.
+
+The file stores already encoded source sentences (i.e. after applying
+--preprocessing, BPE and word maps), so decoding does not need to
+tokenize the input again. It consists of
+
+    magic        8 bytes  b'SGNMTSRC'
+    num_sens     int64    number of sentences
+    offsets      int64    num_sens+1 offsets into tokens
+    tokens       int32    token IDs of all sentences
+
+All numbers are little-endian. Sentence ``j`` consists of the tokens
+``tokens[offsets[j]:offsets[j+1]]``. Since the file is memory-mapped,
+any --range can be accessed without reading the rest of the file, and
+worker processes which decode the same file share its pages.
+"""
+
+import numpy as np
+
+
+MAGIC = b'SGNMTSRC'
+OFFSET_DTYPE = np.dtype('<i8')
+TOKEN_DTYPE = np.dtype('<i4')
+
+
+def write_corpus(path, sentences):
+    """Writes encoded sentences to a binary source file.
+
+    Args:
+        path (string): Path to the output file
+        sentences (iterable): Sequences of token IDs, one per sentence
+    """
+    sentences = [np.asarray(sentence, dtype=TOKEN_DTYPE)
+                 for sentence in sentences]
+    offsets = np.zeros(len(sentences) + 1, dtype=OFFSET_DTYPE)
+    np.cumsum([len(sentence) for sentence in sentences], out=offsets[1:])
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([len(sentences)], dtype=OFFSET_DTYPE).tobytes())
+        f.write(offsets.tobytes())
+        for sentence in sentences:
+            f.write(sentence.tobytes())
+
+
+class BinarySourceReader(object):
+    """Read-only, memory-mapped view on a binary source file. Behaves
+    like a list of source sentences where each sentence is a list of
+    token IDs.
+    """
+
+    def __init__(self, path):
+        """Maps the file at ``path``.
+
+        Args:
+            path (string): Path to a file written by ``write_corpus()``
+
+        Raises:
+            IOError. If ``path`` is not a binary source file
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("%s is not a binary source file. Create it "
+                              "with preprocess.py" % path)
+            num_sens = int(np.frombuffer(f.read(OFFSET_DTYPE.itemsize),
+                                         dtype=OFFSET_DTYPE)[0])
+        offsets_start = len(MAGIC) + OFFSET_DTYPE.itemsize
+        self.offsets = np.memmap(path, dtype=OFFSET_DTYPE, mode='r',
+                                 offset=offsets_start, shape=(num_sens + 1,))
+        num_tokens = int(self.offsets[-1])
+        if num_tokens > 0:
+            self.tokens = np.memmap(
+                path, dtype=TOKEN_DTYPE, mode='r',
+                offset=offsets_start + (num_sens + 1) * OFFSET_DTYPE.itemsize,
+                shape=(num_tokens,))
+        else:
+            self.tokens = np.zeros(0, dtype=TOKEN_DTYPE)
+
+    def __len__(self):
+        """Returns the number of sentences."""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, j):
+        """Returns the token IDs of sentence ``j`` as list."""
+        if not 0 <= j < len(self):
+            raise IndexError("Sentence index %d out of range" % j)
+        return self.tokens[self.offsets[j]:self.offsets[j+1]].tolist()
@@ -0,0 +1,298 @@
+"""This module implements compiled word maps. Text word maps (one
+'word id' pair per line) are converted to a binary file which is
+memory-mapped, so loading is nearly instantaneous and the pages are
+shared by all worker processes which use the same word map. The binary
+file is created next to the text file (``<path>.bin``) on first use and
+rebuilt whenever the text file changes.
+
+The file consists of
+
+    magic        8 bytes  b'SGNMTWMP'
+    header       int64    version, size and mtime (ns) of the text
+                          file, num_ids, num_words, table_size
+    id_offsets   int64    num_ids+1 offsets into words by ID
+    words        bytes    UTF-8 words ordered by ID, zero-padded to a
+                          multiple of 8 bytes
+    key_offsets  int64    num_words+1 offsets into keys
+    keys         bytes    UTF-8 words of all entries of the word map,
+                          zero-padded to a multiple of 8 bytes
+    key_ids      int64    num_words IDs of the entries in keys
+    table        int64    open addressing hash table of entries in
+                          keys, indexed by crc32 of the word (linear
+                          probing, -1 if empty)
+
+All numbers are little-endian. IDs which are not in the word map have
+an empty entry in ``words``. Several words may share an ID, so the
+word -> ID direction (keys) is stored separately from the ID -> word
+direction (words), for which the last line of an ID wins.
+"""
+
+import logging
+import os
+import zlib
+from collections.abc import Mapping
+
+import numpy as np
+
+
+MAGIC = b'SGNMTWMP'
+VERSION = 2
+HEADER_DTYPE = np.dtype('<i8')
+HEADER_SIZE = 6
+OFFSET_DTYPE = np.dtype('<i8')
+
+
+def compiled_path(path):
+    """Returns the path of the compiled version of the word map at
+    ``path``."""
+    return path + '.bin'
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def compile_wmap(path, out_path):
+    """Converts the text word map at ``path`` to a compiled word map.
+    As in the text loaders in ``io_utils``, the first field of a line
+    is the word and the last field its ID, and later lines override
+    earlier ones.
+
+    Args:
+        path (string): Path to the text word map
+        out_path (string): Path to the compiled word map
+
+    Raises:
+        ValueError. If the word map contains negative IDs
+    """
+    word2id = {}
+    id2word = {}
+    with open(path) as f:
+        for line in f:
+            entry = line.strip().split()
+            word, idx = entry[0], int(entry[-1])
+            if idx < 0:
+                raise ValueError("Negative ID %d in word map %s" % (idx, path))
+            word2id[word] = idx
+            id2word[idx] = word
+    num_ids = max(id2word, default=-1) + 1
+    encoded = [b''] * num_ids
+    for idx, word in id2word.items():
+        encoded[idx] = word.encode('utf-8')
+    id_offsets = np.zeros(num_ids + 1, dtype=OFFSET_DTYPE)
+    np.cumsum([len(w) for w in encoded], out=id_offsets[1:])
+    keys = [word.encode('utf-8') for word in word2id]
+    key_offsets = np.zeros(len(keys) + 1, dtype=OFFSET_DTYPE)
+    np.cumsum([len(w) for w in keys], out=key_offsets[1:])
+    key_ids = np.array(list(word2id.values()), dtype=OFFSET_DTYPE)
+    table_size = 1
+    while table_size < 2 * len(word2id) + 1:
+        table_size *= 2
+    table = np.full(table_size, -1, dtype=OFFSET_DTYPE)
+    mask = table_size - 1
+    for entry, word in enumerate(keys):
+        h = zlib.crc32(word) & mask
+        while table[h] >= 0:
+            h = (h + 1) & mask
+        table[h] = entry
+    size, mtime = _source_stamp(path)
+    header = np.array([VERSION, size, mtime, num_ids, len(word2id),
+                       table_size], dtype=HEADER_DTYPE)
+    tmp_path = "%s.%d.tmp" % (out_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(header.tobytes())
+        f.write(id_offsets.tobytes())
+        words = b''.join(encoded)
+        f.write(words + b'\0' * (-len(words) % 8))
+        f.write(key_offsets.tobytes())
+        keys = b''.join(keys)
+        f.write(keys + b'\0' * (-len(keys) % 8))
+        f.write(key_ids.tobytes())
+        f.write(table.tobytes())
+    os.replace(tmp_path, out_path) # Atomic for concurrent workers
+
+
+class CompiledWordMap(object):
+    """Memory-mapped compiled word map. Use ``word_to_id`` and
+    ``id_to_word`` for dict-like access in both directions.
+    """
+
+    def __init__(self, path):
+        """Maps the compiled word map at ``path``.
+
+        Args:
+            path (string): Path to a file written by ``compile_wmap()``
+        """
+        self.path = path
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            raise IOError("%s is not a compiled word map" % path)
+        pos = len(MAGIC)
+        self.header = data[pos:pos + HEADER_SIZE * 8].view(HEADER_DTYPE)
+        version, _, _, num_ids, num_words, table_size = self.header.tolist()
+        if version != VERSION:
+            raise IOError("%s has version %d, expected %d"
+                          % (path, version, VERSION))
+        pos += HEADER_SIZE * 8
+        self.id_offsets = data[pos:pos + (num_ids + 1) * 8].view(OFFSET_DTYPE)
+        pos += (num_ids + 1) * 8
+        self.words = data[pos:pos + int(self.id_offsets[-1])]
+        pos += len(self.words) + (-len(self.words) % 8)
+        self.key_offsets = data[pos:pos + (num_words + 1) * 8].view(
+            OFFSET_DTYPE)
+        pos += (num_words + 1) * 8
+        self.keys = data[pos:pos + int(self.key_offsets[-1])]
+        pos += len(self.keys) + (-len(self.keys) % 8)
+        self.key_ids = data[pos:pos + num_words * 8].view(OFFSET_DTYPE)
+        pos += num_words * 8
+        self.table = data[pos:pos + table_size * 8].view(OFFSET_DTYPE)
+        self.num_ids = num_ids
+        self.num_words = num_words
+        self.ids = np.flatnonzero(np.diff(self.id_offsets))
+        # memoryviews for fast scalar access
+        self._offsets = memoryview(np.asarray(self.id_offsets)).cast('B').cast('q')
+        self._words = memoryview(np.asarray(self.words))
+        self._key_offsets = memoryview(
+            np.asarray(self.key_offsets)).cast('B').cast('q')
+        self._keys = memoryview(np.asarray(self.keys))
+        self._key_ids = memoryview(np.asarray(self.key_ids)).cast('B').cast('q')
+        self._table = memoryview(np.asarray(self.table)).cast('B').cast('q')
+        self._mask = table_size - 1
+        self.word_to_id = WordToId(self)
+        self.id_to_word = IdToWord(self)
+
+    def is_up_to_date(self, source_path):
+        """Returns true if this file was compiled from the current
+        version of the text word map at ``source_path``."""
+        version, size, mtime = self.header[:3].tolist()
+        return (version == VERSION
+                and (size, mtime) == _source_stamp(source_path))
+
+    def lookup_word(self, word):
+        """Returns the ID of ``word`` or -1 if it is not in the map."""
+        word = word.encode('utf-8')
+        table = self._table
+        h = zlib.crc32(word) & self._mask
+        while True:
+            entry = table[h]
+            if entry < 0:
+                return -1
+            start, end = self._key_offsets[entry], self._key_offsets[entry+1]
+            if self._keys[start:end] == word:
+                return self._key_ids[entry]
+            h = (h + 1) & self._mask
+
+    def lookup_id(self, idx):
+        """Returns the word with ID ``idx`` or None."""
+        try:
+            idx = int(idx)
+        except (TypeError, ValueError):
+            return None
+        if not 0 <= idx < self.num_ids:
+            return None
+        start, end = self._offsets[idx], self._offsets[idx+1]
+        if start == end:
+            return None
+        return str(self._words[start:end], 'utf-8')
+
+    def word_array(self, unk="<UNK>"):
+        """Returns an object array of all words indexed by ID with an
+        additional last entry ``unk``, which is also used for IDs
+        without a word."""
+        array = np.full(self.num_ids + 1, unk, dtype=object)
+        present = self.ids.tolist()
+        blob = bytes(self._words)
+        offsets = self.id_offsets.tolist()
+        array[present] = [blob[offsets[i]:offsets[i+1]].decode('utf-8')
+                          for i in present]
+        return array
+
+
+class WordToId(Mapping):
+    """Read-only dict view (word -> ID) of a ``CompiledWordMap``."""
+
+    def __init__(self, wmap):
+        self.wmap = wmap
+
+    def __getitem__(self, word):
+        if not isinstance(word, str):
+            raise KeyError(word)
+        idx = self.wmap.lookup_word(word)
+        if idx < 0:
+            raise KeyError(word)
+        return idx
+
+    def get(self, word, default=None):
+        if not isinstance(word, str):
+            return default
+        idx = self.wmap.lookup_word(word)
+        return default if idx < 0 else idx
+
+    def __contains__(self, word):
+        return isinstance(word, str) and self.wmap.lookup_word(word) >= 0
+
+    def __iter__(self):
+        blob = bytes(self.wmap.keys)
+        offsets = self.wmap.key_offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield blob[start:end].decode('utf-8')
+
+    def __len__(self):
+        return self.wmap.num_words
+
+
+class IdToWord(Mapping):
+    """Read-only dict view (ID -> word) of a ``CompiledWordMap``."""
+
+    def __init__(self, wmap):
+        self.wmap = wmap
+
+    def __getitem__(self, idx):
+        word = self.wmap.lookup_id(idx)
+        if word is None:
+            raise KeyError(idx)
+        return word
+
+    def get(self, idx, default=None):
+        word = self.wmap.lookup_id(idx)
+        return default if word is None else word
+
+    def __contains__(self, idx):
+        return self.wmap.lookup_id(idx) is not None
+
+    def __iter__(self):
+        return iter(self.wmap.ids.tolist())
+
+    def __len__(self):
+        return len(self.wmap.ids)
+
+    def to_array(self):
+        """See ``CompiledWordMap.word_array()``."""
+        return self.wmap.word_array()
+
+
+def load(path):
+    """Returns the compiled version of the text word map at ``path``.
+    The compiled file is (re)built if it does not exist or is out of
+    date.
+
+    Args:
+        path (string): Path to the text word map
+
+    Returns:
+        CompiledWordMap. Memory-mapped word map
+    """
+    bin_path = compiled_path(path)
+    if os.path.exists(bin_path):
+        try:
+            wmap = CompiledWordMap(bin_path)
+            if wmap.is_up_to_date(path):
+                return wmap
+        except (IOError, ValueError) as e:
+            logging.warning("Could not read compiled word map %s: %s"
+                            % (bin_path, e))
+    logging.info("Compiling word map %s to %s" % (path, bin_path))
+    compile_wmap(path, bin_path)
+    return CompiledWordMap(bin_path)
@@ -3,18 +3,19 @@
 # cython: overflowcheck=False, initializedcheck=False, wraparound=False, cdivision=True
 import numpy as np
 
-from libc.stdlib cimport rand
-from libc.math cimport log2, ceil
-cdef extern from "limits.h":
-    int INT_MAX
+from libc.math cimport log, log1p, log2, exp, expm1, ceil, fabs, INFINITY, NAN
 
-ctypedef double (*f_type)(double, double)
-cdef double MAX = float(INT_MAX)
-cdef double NEG_INF = -np.inf
-cdef inline double uniform() nogil:
-    return rand() / MAX
+ctypedef double (*f_type)(double, double) nogil
+cdef double NEG_INF = -INFINITY
 
 cdef class SumHeap:
+    """Binary tree of partial sums for O(log n) updates and sampling.
+    The leaves ``S[d:d+n]`` hold the weights, ``S[1]`` the total. With
+    ``log_space``, weights are log-weights and sums are log-sum-exps.
+
+    Random numbers are drawn from ``np.random``, so samples are
+    reproducible with ``np.random.seed()``.
+    """
     cdef f_type add, minus, div, mult
     cdef readonly:
         double[:] S
@@ -23,18 +24,43 @@ cdef class SumHeap:
         bint log_space
 
     def __init__(self, double[:] w, bint log_space=False):
+        self._setup(w.shape[0], log_space)
+        self.S = np.full(2*self.d, self.zero)           # intermediates + leaves
+        self.heapify(w)
+
+    cdef void _setup(self, int n, bint log_space):
         self.log_space = log_space
         if self.log_space:
-            self.zero = NEG_INF 
+            self.zero = NEG_INF
             self.add, self.minus, self.div, self.mult = logadd, logminus, logdiv, logmult
         else:
             self.zero = 0.
             self.add, self.minus, self.div, self.mult = add, minus, div, mult
-        
-        self.n = w.shape[0]
+        self.n = n
         self.d = int(2**ceil(log2(self.n)))   # number of intermediates
-        self.S = np.full(2*self.d, self.zero)           # intermediates + leaves
-        self.heapify(w)
+
+    @staticmethod
+    def buffer_size(int n):
+        "Length of the buffer of a sumheap with `n` weights."
+        return 2*int(2**ceil(log2(n)))
+
+    @staticmethod
+    def from_buffer(double[:] S, int n, bint log_space=False, bint heapify=True):
+        """Create a sumheap which uses `S` as storage, without copying.
+        `S` must have length `buffer_size(n)`, hold the weights at
+        `S[d:d+n]` and zero (or -inf in log space) in the remaining
+        leaves. The intermediates are computed unless `heapify` is
+        false, e.g. if `S` is the buffer of another sumheap or all
+        weights are zero."""
+        cdef SumHeap heap = SumHeap.__new__(SumHeap)
+        heap._setup(n, log_space)
+        if S.shape[0] != 2*heap.d:
+            raise ValueError("Buffer has length %d, expected %d"
+                             % (S.shape[0], 2*heap.d))
+        heap.S = S
+        if heapify:
+            heap._fix_intermediates()
+        return heap
 
     def __getitem__(self, int k):
         return self.S[self.d + k]
@@ -46,7 +72,10 @@ cdef class SumHeap:
         "Create sumheap from weights `w` in O(n) time."
         d = self.d; n = self.n
         self.S[d:d+n] = w                         # store `w` at leaves.
-        for i in reversed(range(1, d)):
+        self._fix_intermediates()
+
+    cdef void _fix_intermediates(self):
+        for i in reversed(range(1, self.d)):
             self.S[i] = self.add(self.S[2*i], self.S[2*i + 1])
 
     cpdef void update(self, int k, double v):
@@ -57,23 +86,63 @@ cdef class SumHeap:
             i //= 2
             self.S[i] = self.add(self.S[2*i], self.S[2*i + 1])
 
-    cpdef int sample(self, u=None):
-        "Sample from sumheap, O(log n) per sample."
-        cdef double left, p
-        if u is None: u = np.log(uniform()) if self.log_space else uniform()
-        d = self.S.shape[0]//2     # number of internal nodes.
-        p = self.mult(u, self.S[1])  # random probe, p ~ Uniform(0, z)
+    cpdef void update_many(self, long[:] ks, double[:] vs):
+        """Update w[ks[j]] = vs[j] for all j. Each touched parent is
+        fixed once, so this is cheaper than calling `update` for each
+        index if indices share ancestors."""
+        cdef long[:] nodes
+        cdef long m = ks.shape[0], i, j, node
+        if m == 0:
+            return
+        for j in range(m):
+            self.S[self.d + ks[j]] = vs[j]
+        nodes = np.sort(np.asarray(ks) + self.d)
+        while nodes[0] > 1:
+            # Parents of sorted nodes are sorted, so duplicates are adjacent
+            i = 0
+            for j in range(m):
+                node = nodes[j] // 2
+                if i == 0 or nodes[i-1] != node:
+                    nodes[i] = node
+                    i += 1
+                    self.S[node] = self.add(self.S[2*node], self.S[2*node + 1])
+            m = i
+
+    cdef int _sample(self, double p) nogil:
         # Use binary search to find the index of the largest CDF (represented as a
-        # heap) value that is less than a random probe.
+        # heap) value that is less than a random probe p ~ Uniform(0, z).
+        cdef double left
         i = 1
-        while i < d:
+        while i < self.d:
             # Determine if the value is in the left or right subtree.
             i *= 2            # Point at left child
             left = self.S[i]  # Probability mass under left subtree.
             if p > left:      # Value is in right subtree.
                 p = self.minus(p, left)     # Subtract mass from left subtree
                 i += 1        # Point at right child
-        return i - d
+        return i - self.d
+
+    cpdef int sample(self, u=None):
+        """Sample from sumheap, O(log n) per sample. `u` is a uniform
+        random number (its log with `log_space`) and drawn from
+        `np.random` if omitted."""
+        if u is None:
+            u = np.random.random()
+            if self.log_space: u = log(u)
+        return self._sample(self.mult(u, self.S[1]))
+
+    cpdef long[:] sample_many(self, double[:] us):
+        """Draw one sample (with replacement) for each uniform random
+        number in `us`, e.g. `np.random.random(k)`. Unlike `u` in
+        `sample`, `us` are not in log space."""
+        cdef long[:] z = np.zeros(us.shape[0], dtype=int)
+        cdef double total = self.S[1]
+        for j in range(us.shape[0]):
+            if self.log_space:
+                z[j] = self._sample(self.mult(log(us[j]), total))
+            else:
+                z[j] = self._sample(self.mult(us[j], total))
+        return z
 
     cpdef long[:] swor(self, int k):
         "Sample without replacement `k` times."
@@ -85,20 +154,20 @@ cdef class SumHeap:
         return z
 
 
-cdef inline double add(double x, double y):
+cdef inline double add(double x, double y) nogil:
     return x+y
-cdef inline double minus(double x, double y):
+cdef inline double minus(double x, double y) nogil:
     return x-y
-cdef inline double div(double x, double y):
+cdef inline double div(double x, double y) nogil:
     return x/y
-cdef inline double mult(double x, double y):
+cdef inline double mult(double x, double y) nogil:
     return x*y
-cdef inline double logdiv(double x, double y):
+cdef inline double logdiv(double x, double y) nogil:
     return x-y
-cdef inline double logmult(double x, double y):
+cdef inline double logmult(double x, double y) nogil:
     return x+y
 
-cdef double logadd(double x, double y):
+cdef double logadd(double x, double y) nogil:
     if x == NEG_INF:
         return y
     elif y == NEG_INF:
@@ -112,32 +181,31 @@ cdef double logadd(double x, double y):
             r = y
         return r + log1pexp(d)
 
-cdef double logminus(double x, double y):
+cdef double logminus(double x, double y) nogil:
     if x == y:
         return NEG_INF
     if y > x:
-        return np.nan
+        return NAN
     else:
         return x + log1mexp(y-x)
 
 
-cdef double log1pexp(double x):
+cdef inline double log1pexp(double x) nogil:
     if x <= -37:
-        return np.exp(x)
+        return exp(x)
     elif -37 <= x <= 18:
-        return np.log1p(np.exp(x))
+        return log1p(exp(x))
     elif 18 < x <= 33.3:
-        return x + np.exp(-x)
+        return x + exp(-x)
     else:
         return x
 
-cdef double log1mexp(double x):
+cdef inline double log1mexp(double x) nogil:
     if x >= 0:
-        return np.nan
+        return NAN
     else:
-        a = abs(x)
+        a = fabs(x)
         if 0 < a <= 0.693:
-            return np.log(-np.expm1(-a))
+            return log(-expm1(-a))
         else:
-            return np.log1p(-np.exp(-a))
-
+            return log1p(-exp(-a))
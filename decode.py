@@ -16,11 +16,13 @@
 # limitations under the License.
 
 """This is the main runner script for SGNMT decoding. 
-SGNMT can run in three different modes. The standard mode 'file' reads
+SGNMT can run in different modes. The standard mode 'file' reads
 sentences to translate from a plain text file. The mode 'stdin' can be
-used to parse stdin. The last mode 'shell' enables interactive inter-
-action with SGNMT via keyboard. For detailed usage descriptions please
-visit the tutorial home page:
+used to parse stdin. The mode 'shell' enables interactive inter-
+action with SGNMT via keyboard, and 'server' keeps the model loaded
+and decodes requests received over a local socket ('async_server'
+decodes many requests concurrently). For detailed usage
+descriptions please visit the tutorial home page:
 
 http://ucam-smt.github.io/sgnmt/html/tutorial.html
 """
@@ -108,7 +110,20 @@ decoder = decode_utils.create_decoder()
 outputs = decode_utils.create_output_handlers()
 estimator = decode_utils.create_estimator()
 
-if args.input_method == 'file':
+if args.input_method == 'file' and args.src_test_bin:
+    import binary_source
+    trgt = None
+    if args.trgt_test and os.access(args.trgt_test, os.R_OK):
+        with open(args.trgt_test) as f:
+            trgt = [line.strip() for line in f]
+    decode_utils.do_decode(decoder,
+                           outputs,
+                           binary_source.BinarySourceReader(args.src_test_bin),
+                           trgt,
+                           estimator,
+                           args.estimator_iterations,
+                           args.num_log)
+elif args.input_method == 'file':
     if os.access(args.src_test, os.R_OK):
         trgt = None
         if args.trgt_test  and os.access(args.trgt_test, os.R_OK):
@@ -136,6 +151,12 @@ elif args.input_method == "stdin":
                            [line.strip() for line in sys.stdin],
                            estimator,
                            args.estimator_iterations)
+elif args.input_method == "server":
+    import server
+    server.serve(decoder, args)
+elif args.input_method == "async_server":
+    import async_server
+    async_server.serve(decoder, args)
 else: # Interactive mode: shell
     print("Starting interactive mode...")
     print("PID: %d" % os.getpid())
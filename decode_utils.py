@@ -29,8 +29,11 @@ import sys
 import time
 import traceback
 import os
+import signal
 import uuid
 
+import numpy as np
+
 import ui
 import io_utils
 import utils
@@ -185,8 +188,35 @@ def create_output_handlers():
         except KeyError:
             logging.fatal("Output format %s not available. Please double-check"
                           " the --outputs parameter." % name)
+    _flush_on_signal(outputs)
     return outputs
 
+
+def _flush_on_signal(output_handlers):
+    """Installs signal handlers which flush the buffered output of
+    ``output_handlers`` before SGNMT is terminated by SIGINT, SIGTERM,
+    or SIGHUP.
+    
+    Args:
+        output_handlers (list):  List of output handlers
+    """
+    def handler(signum, frame):
+        for output_handler in output_handlers:
+            try:
+                output_handler.flush()
+            except (IOError, ValueError, RuntimeError) as e:
+                logging.error("Could not flush output files: %s" % e)
+        if signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+    for name in ["SIGINT", "SIGTERM", "SIGHUP"]:
+        if hasattr(signal, name):
+            try:
+                signal.signal(getattr(signal, name), handler)
+            except ValueError: # Not called from the main thread
+                pass
+
 def create_estimator():
     if not args.estimator:
         return None
@@ -248,24 +278,21 @@ def get_sentence_indices(range_param, src_sentences):
         yield i
 
 
-def _get_text_output_handler(output_handlers):
-    """Returns the text output handler if in output_handlers, or None."""
+def _write_sentence(output_handlers, sen_idx, hypos, written=None):
+    """Passes the n-best list of a single sentence to all output
+    handlers. Handlers which wrote it successfully are appended to
+    ``written`` if given."""
     for output_handler in output_handlers:
-
-        if isinstance(output_handler, output.TextOutputHandler)\
-                or isinstance(output_handler, output.NBestSeparateOutputHandler):
-            return output_handler
-    return None
-
-def _get_score_output_handler(output_handlers):
-    """Returns the text output handler if in output_handlers, or None."""
-    for output_handler in output_handlers:
-        if isinstance(output_handler, output.ScoreOutputHandler):
-            return output_handler
-    return None
+        try:
+            output_handler.write_sentence(sen_idx, hypos)
+            if written is not None:
+                written.append(output_handler)
+        except IOError as e:
+            logging.error("I/O error %s occurred when creating output files: %s"
+                          % (sys.exc_info()[0], e))
 
 
-def _postprocess_complete_hypos(hypos):
+def _postprocess_complete_hypos(hypos, nbest=None):
     """This function applies the following operations on the list of
     complete hypotheses returned by the Decoder:
 
@@ -275,20 +302,44 @@ def _postprocess_complete_hypos(hypos):
 
     Args:
       hypos (list): List of complete hypotheses
+      nbest (int): Overrides --nbest if not None
 
     Returns:
       list. Postprocessed hypotheses.
     """
+    if nbest is None:
+        nbest = args.nbest
     if args.remove_eos:
         for hypo in hypos:
             if (hypo.trgt_sentence 
                     and hypo.trgt_sentence[-1] == utils.EOS_ID):
                 hypo.trgt_sentence = hypo.trgt_sentence[:-1]
-    if args.nbest > 0:
-        hypos = hypos[:args.nbest]
+    if nbest > 0:
+        hypos = hypos[:nbest]
     return hypos
 
 
+def decode_sentence(decoder, src_sentence, nbest=None):
+    """Decodes a single source sentence in string representation 
+    outside of the main loop in ``do_decode()``. This is used by
+    long-running input methods like the decoding server.
+
+    Args:
+        decoder (Decoder):  Current decoder instance
+        src_sentence (string): Source sentence to translate
+        nbest (int): Overrides --nbest if not None
+
+    Returns:
+        list. Postprocessed hypotheses, at least one.
+    """
+    decoder.apply_predictor_count = 0
+    hypos = decoder.decode(io_utils.encode(src_sentence))
+    if not hypos:
+        logging.error("No translation found for '%s'!" % src_sentence)
+        hypos = [_generate_dummy_hypo()]
+    return _postprocess_complete_hypos(hypos, nbest)
+
+
 def _generate_dummy_hypo():
     return decoding.core.Hypothesis([utils.UNK_ID], 0.0, [0.0]) 
 
@@ -302,7 +353,8 @@ def do_decode(decoder,
               num_log=1):
     """This method contains the main decoding loop. It iterates through
     ``src_sentences`` and applies ``decoder.decode()`` to each of them.
-    At the end, it calls the output handlers to create output files.
+    The n-best list of each sentence is passed to the output handlers
+    as soon as it is available, and the handlers are closed at the end.
     
     Args:
         decoder (Decoder):  Current decoder instance
@@ -310,38 +362,41 @@ def do_decode(decoder,
                                  ``create_output_handlers()``
         src_sentences (list):  A list of strings. The strings are the
                                source sentences with word indices to 
-                               translate (e.g. '1 123 432 2')
+                               translate (e.g. '1 123 432 2'). Can also
+                               be a ``BinarySourceReader`` which yields
+                               already encoded sentences.
     """
     if not decoder.has_predictor():
         logging.fatal("Terminated due to an error in the "
                       "predictor configuration.")
         return
-    all_hypos = []
-    text_output_handler = _get_text_output_handler(output_handlers)
-    if text_output_handler:
-        text_output_handler.open_file()
-    score_output_handler = _get_score_output_handler(output_handlers)
-
     start_time = time.time()
     logging.info("Start time: %s" % start_time)
-    sen_indices = []
     diversity_metrics = []
     not_full = 0
     num_iterations = iterations if estimator and not decoder.is_deterministic() else 1
-    
-    estimates = []
+    estimate_writer = None
+    if estimator:
+        file_name = decoder.name  + '_' + args.fairseq_lang_pair + '_' + estimator.name + '_' +str(args.range) + '_' + str(args.nbest)
+        if hasattr(args, 'inc_prob_estimate_rounds'):
+            file_name += '_' + str(args.inc_prob_estimate_rounds)
+        estimate_writer = estimators.EstimateWriter(file_name, args.estimator_format)
 
     for sen_idx in get_sentence_indices(args.range, src_sentences):
         decoder.set_current_sen_id(sen_idx)
+        written = []
         try:
             src = "0" if src_sentences is False else src_sentences[sen_idx]
-            if len(src.split()) > 1000:
+            if len(src.split() if isinstance(src, str) else src) > 1000:
                 print("Skipping ID", str(sen_idx), ". Too long...")
                 continue
-            src_print = io_utils.src_sentence(src)
-            logging.info("Next sentence (ID: %d): %s" % (sen_idx + 1, src_print))
-            src = io_utils.encode(src)
-            sen_estimates = []
+            if isinstance(src, str):
+                src_print = io_utils.src_sentence(src)
+                logging.info("Next sentence (ID: %d): %s" % (sen_idx + 1, src_print))
+                src = io_utils.encode(src)
+            else: # Already encoded (--src_test_bin)
+                logging.info("Next sentence (ID: %d): %s" % (
+                    sen_idx + 1, " ".join(map(str, src))))
 
             for i in range(num_iterations):
                 start_hypo_time = time.time()
@@ -375,30 +430,30 @@ def do_decode(decoder,
                                                 time.time() - start_hypo_time,
                                                 utils.perplexity(logged_hypo.score_breakdown)))
                 if estimator:
-                    container = []
-                    kau = min(hypos).total_score if decoder.gumbel else None
-                    for h in hypos:
-                        if kau and h.total_score <= kau:
-                            continue
-                        inc_prob = decoder.get_inclusion_prob_estimate(src, h, kau=kau)
-                        model_prob = h.base_score if h.base_score else h.total_score
-                        val = estimator.add_value(h, model_prob - inc_prob, 
-                            ref=trgt_sentences[sen_idx] if trgt_sentences else None)
-                        container.append((model_prob - inc_prob, val))
+                    total_scores = np.array([h.total_score for h in hypos])
+                    base_scores = np.array([h.base_score for h in hypos])
+                    kau = None
+                    keep = np.ones(len(hypos), dtype=bool)
+                    if decoder.gumbel:
+                        # The smallest perturbed score is the threshold
+                        kau = total_scores.min()
+                        keep = total_scores > kau
+                    samples = [h for h, k in zip(hypos, keep) if k]
+                    inc_probs = decoder.get_inclusion_prob_estimates(
+                        src, samples, kau=kau)
+                    model_probs = np.where(base_scores != 0, base_scores,
+                                           total_scores)[keep]
+                    weights = model_probs - inc_probs
+                    vals = estimator.add_values(samples, weights,
+                        ref=trgt_sentences[sen_idx] if trgt_sentences else None)
                     logging.info("Estimator value: %.5f" % (estimator.estimate()))
+                    estimate_writer.write(sen_idx, i, weights, vals, estimator)
                     estimator.reset()
-                    sen_estimates.append(container)
 
 
-            if score_output_handler:
-                try:
-                    score_output_handler.write_score(logged_hypo.score_breakdown)
-                except IOError as e:
-                    logging.error("I/O error %d occurred when creating output files: %s"
-                                % (sys.exc_info()[0], e))
-
             if decoder.nbest > 1:
-                diversity_score = utils.ngram_diversity([io_utils.decode(h.trgt_sentence) for h in hypos])
+                diversity_score = utils.ngram_diversity(
+                    io_utils.decode_batch([h.trgt_sentence for h in hypos]))
                 logging.info("Diversity: score=%f "
                           % (diversity_score))
                 diversity_metrics.append(diversity_score)
@@ -406,17 +461,9 @@ def do_decode(decoder,
                 if len(hypos) < decoder.nbest:
                     not_full += 1
 
-            
-            all_hypos.append(hypos)
-            sen_indices.append(sen_idx)
-            estimates.append(sen_estimates)
-            try:
-                # Write text output as we go
-                if text_output_handler:
-                    text_output_handler.write_hypos([hypos])
-            except IOError as e:
-                logging.error("I/O error %d occurred when creating output files: %s"
-                            % (sys.exc_info()[0], e))
+            if estimate_writer:
+                estimate_writer.flush()
+            _write_sentence(output_handlers, sen_idx, hypos, written)
         except ValueError as e:
             logging.error("Number format error at sentence id %d: %s, "
                           "Stack trace: %s" % (sen_idx+1, 
@@ -434,21 +481,12 @@ def do_decode(decoder,
                                                        sen_idx+1,
                                                        e,
                                                        traceback.format_exc()))
-            try:
-                # Write text output as we go
-                if text_output_handler:
-                    hypos = [_generate_dummy_hypo()]
-                    text_output_handler.write_hypos([hypos])
-            except IOError as e:
-                logging.error("I/O error %d occurred when creating output files: %s"
-                            % (sys.exc_info()[0], e))
-    if estimator:
-        file_name = decoder.name  + '_' + args.fairseq_lang_pair + '_' + estimator.name + '_' +str(args.range) + '_' + str(args.nbest)
-        if hasattr(args, 'inc_prob_estimate_rounds'):
-            file_name += '_' + str(args.inc_prob_estimate_rounds)
-        file_name +=  '.out'
-        with open(file_name, 'w') as f:
-            f.write('\n'.join([str(x) for x in estimates]))
+            # Keep line-aligned outputs in sync with the source sentences
+            missing = [h for h in output_handlers
+                       if h.line_aligned and h not in written]
+            _write_sentence(missing, sen_idx, [_generate_dummy_hypo()])
+    if estimate_writer:
+        estimate_writer.close()
 
     logging.info("Decoding finished. Time: %.2f" % (time.time() - start_time))
     if decoder.nbest > 1:
@@ -456,10 +494,7 @@ def do_decode(decoder,
     print("Total not full:", str(not_full))
     try:
         for output_handler in output_handlers:
-            if output_handler == text_output_handler:
-                output_handler.close_file()
-            else:
-                output_handler.write_hypos(all_hypos, sen_indices)
+            output_handler.close()
     except IOError as e:
         logging.error("I/O error %s occurred when creating output files: %s"
                       % (sys.exc_info()[0], e))
@@ -1,24 +1,26 @@
 """This package contains the central interfaces for the decoder (in the
 ``core`` module ), and the implementations of search strategies
 (``Decoder``).
+
+Decoders are registered by name in ``DECODER_REGISTRY``. The module of
+a decoder is only imported when it is looked up, so new decoders need
+an entry 'module.ClassName' below.
 """
-import os
-import inspect
-import importlib
+import utils
 from .core import Decoder
 
-DECODER_REGISTRY = {}
-
-decoders_dir = os.path.dirname(__file__)
-for file in os.listdir(decoders_dir):
-    path = os.path.join(decoders_dir, file)
-    if not file.startswith('_') and not file.startswith('.') and file.endswith('.py'):
-        model_name = file[:file.find('.py')]
-        module = importlib.import_module('decoding.' + model_name)
-        clsmembers = inspect.getmembers(module, inspect.isclass)
-        for name, _cls in clsmembers:
-        	if issubclass(_cls, Decoder) and not _cls == Decoder:
-        		if not hasattr(_cls, 'name'):
-        			raise ValueError("All decoder classes must have `name` attribute. Culprit: {}".format(name))
-        		else:
-        			DECODER_REGISTRY[_cls.name] = _cls
+DECODER_REGISTRY = utils.LazyRegistry('decoding', {
+    'beam': 'beam.BeamDecoder',
+    'diverse_beam': 'beam.DiverseBeamDecoder',
+    'dijkstra': 'dijkstra.DijkstraDecoder',
+    'dijkstra_ts': 'dijkstra_time_sync.DijkstraTSDecoder',
+    'greedy': 'greedy.GreedyDecoder',
+    'reference': 'reference.ReferenceDecoder',
+    'sampling': 'sampling.SamplingDecoder',
+    'nucleus_sampling': 'sampling.NucleusSamplingDecoder',
+    'basic_swor': 'swor.BasicSworDecoder',
+    'swor': 'swor.SworDecoder',
+    'mem_eff_swor': 'swor.MemEfficientSworDecoder',
+    'cp_swor': 'swor.CPSworDecoder',
+    'p_swor': 'swor.PSworDecoder',
+})
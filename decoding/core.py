@@ -26,6 +26,7 @@ import copy
 import math
 
 import utils
+import sampling_utils
 from utils import NEG_INF, EPS_P
 import numpy as np
 from operator import mul
@@ -211,11 +212,25 @@ class Decoder(object):
         return not self.gumbel
 
     def get_inclusion_prob_estimate(self, src, hypo, kau=None, **kwargs):
+        return self.get_inclusion_prob_estimates(src, [hypo], kau=kau, **kwargs)[0]
+
+    def get_inclusion_prob_estimates(self, src, hypos, kau=None, **kwargs):
+        """Log inclusion probabilities of all hypotheses of a sample
+        set. With --gumbel, these are the probabilities that the
+        perturbed scores exceed the threshold ``kau``, computed in
+        closed form for the whole set (see
+        ``sampling_utils.gumbel_inclusion_log_probs()``). Otherwise,
+        the total scores. Decoders which estimate inclusion
+        probabilities differently should override this.
+
+        Returns:
+            np.array. Log inclusion probability for each hypothesis
+        """
         if self.gumbel:
             assert kau is not None
-            zet = np.exp(hypo.base_score - kau)
-            return hypo.base_score - kau - zet/2 + (zet**2)/24 - (zet**4)/2880 
-        return hypo.total_score
+            return sampling_utils.gumbel_inclusion_log_probs(
+                [hypo.base_score for hypo in hypos], kau)
+        return np.array([hypo.total_score for hypo in hypos])
 
     def add_predictor(self, name, predictor):
         """Adds a predictor to the decoder. This means that this 
@@ -279,23 +294,47 @@ class Decoder(object):
         self.apply_predictor_count += 1
         # Get posteriors
         posterior = self.predictor.predict_next()
+        return self._process_posterior(self.predictor, posterior, hypo, top_n)
+
+    def apply_predictor_batch(self, predictors, top_n=0):
+        """Like ``apply_predictor()``, but for many predictor states at
+        once. ``predictors`` are forks of the predictor of this decoder
+        (see ``Predictor.fork()``) and are evaluated with a single call
+        of ``predict_next_batch()``. Cannot be used with --gumbel.
+
+        Args:
+            predictors (list): Forks of ``self.predictor``
+            top_n (int): If positive, return only the best n words.
+
+        Returns:
+            list. Return values of ``apply_predictor()`` for each
+            predictor
+        """
+        assert not self.gumbel
+        self.apply_predictor_count += len(predictors)
+        posteriors = self.predictor.predict_next_batch(predictors)
+        return [self._process_posterior(predictor, posterior, None, top_n)
+                for predictor, posterior in zip(predictors, posteriors)]
+
+    def _process_posterior(self, predictor, posterior, hypo, top_n):
+        """Turns the return value of ``predict_next()`` into the
+        return value of ``apply_predictor()``."""
         posterior = utils.log_softmax(posterior, temperature=self.temperature)
         # numerical stability check
         assert len(posterior) - np.count_nonzero(posterior) <= 1
         
-        non_zero_words = self._get_non_zero_words(self.predictor,
-                                                  posterior)
+        non_zero_words = self._get_non_zero_words(predictor, posterior)
         if len(non_zero_words) == 0: # Special case: no word is possible
             non_zero_words = set([utils.EOS_ID])
 
         if self.gumbel:
             gumbel_full_posterior = self.gumbelify(hypo, posterior)
             ids, posterior, original_posterior = self.combine_posteriors(
-                non_zero_words, gumbel_full_posterior, self.predictor.get_unk_probability(posterior),
+                non_zero_words, gumbel_full_posterior, predictor.get_unk_probability(posterior),
                 top_n=top_n, original_posterior=posterior) 
         else:
             ids, posterior, original_posterior = self.combine_posteriors(
-                non_zero_words, posterior, self.predictor.get_unk_probability(posterior), top_n=top_n) 
+                non_zero_words, posterior, predictor.get_unk_probability(posterior), top_n=top_n) 
                 
         assert self.allow_unk_in_output or not utils.UNK_ID in ids
         
@@ -2,7 +2,7 @@ import numpy as np
 import time
 import copy
 import logging
-from collections import defaultdict
+from collections import Counter
 from datastructures.sum_heap import SumHeap 
 
 import utils
@@ -26,6 +26,8 @@ class BasicSworDecoder(Decoder):
         super(BasicSworDecoder, self).__init__(decoder_args)
         self.nbest = decoder_args.nbest
         self.early_stopping = decoder_args.early_stopping
+        self.topk = getattr(decoder_args, 'swor_topk', 0)
+        self.batch = getattr(decoder_args, 'swor_batch', 1)
         assert not self.gumbel
         
     def decode(self, src_sentence):
@@ -35,9 +37,12 @@ class BasicSworDecoder(Decoder):
         while len(self.full_hypos) < self.nbest and self.samples_left():
             if np.exp(self.covered_lprob) >= 1.0 - utils.MACHINE_EPS:
                 logging.warn("Samples cover 100% of probability. Behavior beyond this point is undefined")
+            if self.batch > 1:
+                self._sample_batch(self.nbest - len(self.full_hypos))
+                continue
             self.reset_predictor(src_sentence)
             hypo = PartialHypothesis(self.get_predictor_states())
-            hypo, score = self._expand_hypo(hypo)
+            hypo, score = self._expand_hypo(hypo, self.trie)
             self.add_full_hypo(hypo.generate_full_hypothesis())
             self.covered_lprob = utils.log_add(self.covered_lprob, score)
             
@@ -45,61 +50,211 @@ class BasicSworDecoder(Decoder):
         return self.full_hypos
 
     def initialize_predictor(self, src_sentence):
-        self.dists = MapDist()
+        self.trie = TrieNode()
         super().initialize_predictor(src_sentence)
+        self.initial_state = self.predictor.snapshot()
+        # Nodes and word indices of the sampled path
+        self.path_nodes = [None] * (self.max_len + 1)
+        self.path_inds = [0] * (self.max_len + 1)
 
-    def _expand_hypo(self, hypo):
-        if hypo.get_last_word() == utils.EOS_ID or len(hypo) == self.max_len:
-            return hypo, 0.0
-        #assert False
-        prefix = tuple(hypo.trgt_sentence)
-        if not prefix in self.dists:
-            if self.start:
-                # prefix has no longer previously been seen. One deep copy to get started
-                hypo.predictor_states = copy.deepcopy(hypo.predictor_states)
-                self.set_predictor_states(hypo.predictor_states)
-                self.start = False
-            if hypo.word_to_consume is not None:
-                self.consume(hypo.word_to_consume)
-                hypo.word_to_consume = None
+    def _descend(self, hypo, node):
+        """Samples ``hypo`` to the end, starting at trie node ``node``.
+        The visited nodes and sampled indices are recorded in
+        ``path_nodes`` and ``path_inds``. No adjustments are made.
 
-            ids, posterior, _ = self.apply_predictor()
-            # assert not np.any(np.isnan(lprobabilities))
-            self.dists.add_dist(prefix, ids, utils.log_softmax(posterior, self.temperature) , self.get_predictor_states())
-            
-        ids, lprobabilities, adjusted_lprobabilities, states = self.dists.get(prefix)
-        hypo.predictor_states = states
-
-        ind = adjusted_lprobabilities.sample()
-        next_word = ids[ind]
-
-        hypo.score += adjusted_lprobabilities[ind]
-        hypo.score_breakdown.append(lprobabilities[ind])
-        hypo.trgt_sentence += [next_word]
-        hypo.word_to_consume = next_word
-        hypo, score = self._expand_hypo(hypo)
-        score += lprobabilities[ind] 
-        self.dists.adjust(prefix, next_word, score)
+        Returns:
+            (int, TrieNode). Length of the path and the final node
+        """
+        depth = 0
+        while hypo.get_last_word() != utils.EOS_ID and len(hypo) < self.max_len:
+            if node.dist is None:
+                if self.start:
+                    # prefix has no longer previously been seen. One deep copy to get started
+                    hypo.predictor_states = copy.deepcopy(hypo.predictor_states)
+                    self.set_predictor_states(hypo.predictor_states)
+                    self.start = False
+                if hypo.word_to_consume is not None:
+                    self.consume(hypo.word_to_consume)
+                    hypo.word_to_consume = None
+
+                ids, posterior, _ = self.apply_predictor()
+                # assert not np.any(np.isnan(lprobabilities))
+                node.dist = self.create_dist(ids, self.node_lprobabilities(node, posterior), self.get_predictor_states())
+
+            ind = node.dist.sample()
+            ids, lprobabilities, adjusted_lprobabilities, states = node.dist.values()
+            hypo.predictor_states = states
+            next_word = ids[ind]
+
+            hypo.score += adjusted_lprobabilities[ind]
+            hypo.score_breakdown.append(lprobabilities[ind])
+            hypo.trgt_sentence += [next_word]
+            hypo.word_to_consume = next_word
+            self.path_nodes[depth] = node
+            self.path_inds[depth] = ind
+            depth += 1
+            node = node.child(ind)
+        return depth, node
+
+    def node_lprobabilities(self, node, posterior):
+        """Distribution stored at a newly expanded trie node."""
+        return utils.log_softmax(posterior, self.temperature)
+
+    def _expand_hypo(self, hypo, node):
+        depth, node = self._descend(hypo, node)
+        return hypo, self._update_path(hypo, depth, node)
+
+    def _update_path(self, hypo, depth, node):
+        """Removes the sample ``hypo`` from the distributions on its
+        path, which is given by the first ``depth`` entries of
+        ``path_nodes`` and ``path_inds``. ``node`` is the trie node of
+        the complete sample.
+
+        Returns:
+            float. Log-probability which the sample covered
+        """
+        # Adjust the sampled path bottom-up by the probability of the
+        # sampled suffix
+        score = 0.0
+        for d in reversed(range(depth)):
+            dist, ind = self.path_nodes[d].dist, self.path_inds[d]
+            score += dist.lprobabilities[ind]
+            dist.adjust_index(ind, score)
         hypo.base_score = sum(hypo.score_breakdown)
-        return hypo, score
+        return score
+
+    def _sample_batch(self, limit):
+        """Draws --swor_batch samples with replacement from the current
+        (adjusted) distributions in one walk down the trie, and adds the
+        first ``limit`` distinct ones to ``full_hypos``.
+
+        The walk is level by level. The number of samples which pass a
+        node is split among its children by sampling from its
+        distribution, and all nodes of a level which have not been
+        expanded yet are expanded with one batched predictor call (see
+        ``Decoder.apply_predictor_batch()``).
+
+        Drawing with replacement and skipping samples which have been
+        drawn before is the same as sampling without replacement, so the
+        distinct samples in the order of their first draw are distributed
+        exactly like the next samples of the sequential decoder. They are
+        added in this order, with the same scores and adjustments as in
+        ``_expand_hypo()``.
+
+        Args:
+            limit (int): Maximum number of new samples
+        """
+        active = [(self.trie, self.batch, [])]
+        finished = []
+        while active:
+            todo = []
+            for node, count, path in active:
+                if len(path) >= self.max_len or (
+                        path and path[-1][0].dist.ids[path[-1][1]] == utils.EOS_ID):
+                    finished.append((node, count, path))
+                else:
+                    todo.append((node, count, path))
+            self._expand_nodes([(node, path) for node, _, path in todo
+                                if node.dist is None])
+            active = []
+            for node, count, path in todo:
+                counts = Counter(node.dist.sample_many(count).tolist())
+                for ind, child_count in counts.items():
+                    active.append((node.child(ind), child_count,
+                                   path + [(node, ind)]))
+        # Distinct samples in the order of their first draw
+        draws = np.random.permutation(np.repeat(
+            np.arange(len(finished)), [count for _, count, _ in finished]))
+        order = draws[np.sort(np.unique(draws, return_index=True)[1])]
+        for i in order[:limit]:
+            node, _, path = finished[i]
+            hypo = PartialHypothesis()
+            for depth, (path_node, ind) in enumerate(path):
+                ids, lprobabilities, adjusted_lprobabilities, _ = path_node.dist.values()
+                hypo.score += adjusted_lprobabilities[ind]
+                hypo.score_breakdown.append(lprobabilities[ind])
+                hypo.trgt_sentence.append(ids[ind])
+                self.path_nodes[depth] = path_node
+                self.path_inds[depth] = ind
+            score = self._update_path(hypo, len(path), node)
+            self.add_full_hypo(hypo.generate_full_hypothesis())
+            self.covered_lprob = utils.log_add(self.covered_lprob, score)
+
+    def _expand_nodes(self, nodes):
+        """Creates the distributions of trie nodes with one
+        ``apply_predictor_batch()`` call. Each node gets a fork of the
+        predictor with a copy of its parent's state, so this is only
+        cheaper than expanding the nodes one by one if the predictor
+        implements ``predict_next_batch()`` with a single model call.
+
+        Args:
+            nodes (list): (node, path) tuples of nodes without ``dist``,
+                          where ``path`` lists the (node, index) pairs
+                          from the root to the node
+        """
+        if not nodes:
+            return
+        predictors = []
+        for node, path in nodes:
+            predictor = self.predictor.fork()
+            if path:
+                parent, ind = path[-1]
+                predictor.set_state(copy.deepcopy(parent.dist.predictor_states))
+                predictor.consume(parent.dist.ids[ind])
+            else:
+                predictor.restore(self.initial_state)
+            predictors.append(predictor)
+        results = self.apply_predictor_batch(predictors)
+        for (node, _), predictor, (ids, posterior, _) in zip(nodes, predictors, results):
+            node.dist = self.create_dist(ids, self.node_lprobabilities(node, posterior),
+                                         predictor.get_state())
          
+    def create_dist(self, ids, lprobabilities, predictor_states):
+        """Creates the distribution of a trie node. Uses a ``SparseDist``
+        if --swor_topk is set."""
+        if self.topk > 0:
+            return SparseDist(ids, lprobabilities, predictor_states, self.topk)
+        return Dist(ids, lprobabilities, predictor_states)
+
     def reset_predictor(self, src_sentence):
+        """Returns to the predictor state after ``initialize()`` without
+        initializing it again (see ``Predictor.snapshot()``)."""
         self.start = True
-        self.predictor.initialize(src_sentence)
+        self.predictor.restore(self.initial_state)
 
     def samples_left(self):
         if len(self.full_hypos) == 0:
             return True
         if self.early_stopping and np.exp(self.covered_lprob) >= 1.0 - utils.MACHINE_EPS:
             return False
-        start_hash = tuple()
-        _, _, adjusted_lprobabilities, _ = self.dists.get(start_hash)
+        _, _, adjusted_lprobabilities, _ = self.trie.dist.values()
         n, d = adjusted_lprobabilities.n, adjusted_lprobabilities.d
         return np.any(~np.isnan(adjusted_lprobabilities.S[d:d+n]) > utils.NEG_INF )
 
     def is_deterministic(self):
         return False
 
+    @staticmethod
+    def add_args(parser):
+        parser.add_argument("--swor_topk", default=0, type=int,
+                        help="If positive, distributions in the SWOR trie keep "
+                        "explicit entries only for the top k words and for "
+                        "sampled words, and one bucket for the remaining "
+                        "mass. This reduces the memory per visited prefix "
+                        "for large vocabularies. Sampling stays exact. Used "
+                        "by basic_swor and swor.")
+        parser.add_argument("--swor_batch", default=1, type=int,
+                        help="Number of samples (with replacement) drawn in "
+                        "one walk down the SWOR trie. Prefixes which are "
+                        "visited for the first time on one level of a walk "
+                        "are expanded with one predict_next_batch call, and "
+                        "duplicates are skipped. Samples are still exactly "
+                        "without replacement. Only faster than 1 with "
+                        "predictors which evaluate batches in one model call "
+                        "(e.g. fairseq), since every new prefix needs a "
+                        "predictor fork and a copy of its parent's state. "
+                        "Used by basic_swor and swor.")
+
 
 class SworDecoder(BasicSworDecoder):
     name = "swor"
@@ -116,39 +271,20 @@ class SworDecoder(BasicSworDecoder):
         """
         super(SworDecoder, self).__init__(decoder_args)
 
-    def _expand_hypo(self, hypo):
-        if hypo.get_last_word() == utils.EOS_ID or len(hypo) == self.max_len:
-            return hypo, self.dists.marg(tuple(hypo.trgt_sentence))
-        prefix = tuple(hypo.trgt_sentence)
-        if not prefix in self.dists:
-            if self.start:
-                # prefix has no longer previously been seen. One deep copy to get started
-                hypo.predictor_states = copy.deepcopy(hypo.predictor_states)
-                self.set_predictor_states(hypo.predictor_states)
-                self.start = False
-            if hypo.word_to_consume is not None:
-                self.consume(hypo.word_to_consume)
-                hypo.word_to_consume = None
-            
-            ids, posterior, _ = self.apply_predictor()
-            marg = self.dists.marg(prefix)
-            lprobabilities = utils.log_softmax(posterior, self.temperature) + marg
-            self.dists.add_dist(prefix, ids, lprobabilities, self.get_predictor_states())
-
-        ids, lprobabilities, adjusted_lprobabilities, states = self.dists.get(prefix)
-        hypo.predictor_states = states
-
-        ind = adjusted_lprobabilities.sample()
-        next_word = ids[ind]
+    def node_lprobabilities(self, node, posterior):
+        """Distributions store joint probabilities of the prefix and
+        the next word."""
+        return utils.log_softmax(posterior, self.temperature) + node.marg()
 
-        hypo.score += adjusted_lprobabilities[ind]
-        hypo.score_breakdown.append(lprobabilities[ind])
-        hypo.trgt_sentence += [next_word]
-        hypo.word_to_consume = next_word
-        hypo, final = self._expand_hypo(hypo)
-        self.dists.adjust(prefix, next_word, final)
-        hypo.base_score = hypo.score_breakdown[-1]
-        return hypo, final
+    def _update_path(self, hypo, depth, node):
+        # The sampled sentence's joint probability is removed from all
+        # prefixes on the path
+        final = node.marg()
+        for d in reversed(range(depth)):
+            self.path_nodes[d].dist.adjust_index(self.path_inds[d], final)
+        if depth:
+            hypo.base_score = hypo.score_breakdown[-1]
+        return final
 
 
 class MemEfficientSworDecoder(BasicSworDecoder):
@@ -165,43 +301,58 @@ class MemEfficientSworDecoder(BasicSworDecoder):
                                    from the configuration API.
         """
         super(MemEfficientSworDecoder, self).__init__(decoder_args)
+        self.batch = 1 # Needs the distributions in the trie
 
     
-    def _expand_hypo(self, hypo):
-        if hypo.get_last_word() == utils.EOS_ID or len(hypo) == self.max_len:
-            return hypo, 0.0
-        if hypo.word_to_consume is not None:
-            self.consume(hypo.word_to_consume)
-            hypo.word_to_consume = None
-        prefix = tuple(hypo.trgt_sentence)
-        ids, posterior, _ = self.apply_predictor()
-        lprobabilities = utils.log_softmax(posterior, self.temperature)
-        adjusted_lprobabilities = self.adjust_probabilities(lprobabilities, prefix, ids)
-
-        ind = sampling_utils.log_multinomial_sample(adjusted_lprobabilities)
-        next_word = ids[ind]
-
-        hypo.score += adjusted_lprobabilities[ind]
-        hypo.score_breakdown.append(lprobabilities[ind])
-        hypo.trgt_sentence += [next_word]
-        hypo.word_to_consume = next_word
-        hypo, score = self._expand_hypo(hypo)
-        score += lprobabilities[ind] 
-        self.ids[prefix][next_word] = utils.log_add(score, self.ids[prefix][next_word])
+    def _expand_hypo(self, hypo, node=None):
+        # Only stores adjustments in ``self.prefixes``, not in the trie
+        path = []
+        prefix = PrefixIndex.ROOT
+        while hypo.get_last_word() != utils.EOS_ID and len(hypo) < self.max_len:
+            if hypo.word_to_consume is not None:
+                self.consume(hypo.word_to_consume)
+                hypo.word_to_consume = None
+            ids, posterior, _ = self.apply_predictor()
+            lprobabilities = utils.log_softmax(posterior, self.temperature)
+            adjusted_lprobabilities = self.adjust_probabilities(lprobabilities, prefix, ids)
+
+            ind = sampling_utils.log_multinomial_sample(adjusted_lprobabilities)
+            next_word = ids[ind]
+
+            hypo.score += adjusted_lprobabilities[ind]
+            hypo.score_breakdown.append(lprobabilities[ind])
+            hypo.trgt_sentence += [next_word]
+            hypo.word_to_consume = next_word
+            path.append((prefix, next_word, lprobabilities[ind]))
+            prefix = self.prefixes.child(prefix, next_word)
+        score = 0.0
+        for prefix, next_word, lprob in reversed(path):
+            score += lprob
+            self.prefixes.add(prefix, next_word, score)
         hypo.base_score = sum(hypo.score_breakdown)
         return hypo, score
         
 
-    def adjust_probabilities(self, lprobabilities, hash_rep, ids):
+    def adjust_probabilities(self, lprobabilities, prefix, ids):
+        """Removes the mass of the samples so far from the distribution
+        ``lprobabilities`` over ``ids`` (sorted) after the prefix with
+        ID ``prefix`` in ``self.prefixes``. Returns ``lprobabilities``
+        itself if nothing was sampled after this prefix yet."""
+        words, masses = self.prefixes.adjustments(prefix)
+        if not len(words):
+            return lprobabilities
+        if len(ids) and ids[0] == 0 and ids[-1] == len(ids) - 1:
+            inds = words # Full vocabulary: position = word
+        else:
+            inds = np.searchsorted(ids, words)
         lprobabilities = np.copy(lprobabilities)
-        for k, val in self.ids[hash_rep].items():
-            ind = utils.binary_search(ids, k)
-            lprobabilities[ind] = utils.log_minus(lprobabilities[ind], val)
+        lprobabilities[inds] = utils.log_minus_array(lprobabilities[inds], masses)
         return lprobabilities
 
     def initialize_predictor(self, src_sentence):
-        self.ids = defaultdict(lambda: defaultdict(lambda: utils.NEG_INF))
+        self.prefixes = PrefixIndex()
         self.src_sentence = src_sentence
+        self.root_dist = None
         super().initialize_predictor(self.src_sentence)
 
     def samples_left(self):
@@ -209,11 +360,12 @@ class MemEfficientSworDecoder(BasicSworDecoder):
             return True
         if self.early_stopping and np.exp(self.covered_lprob) >= 1.0 - utils.MACHINE_EPS:
             return False
-        self.reset_predictor(self.src_sentence)
-        ids, posterior, _ = self.apply_predictor()
-        start_hash = tuple()
-        lprobabilities = utils.log_softmax(posterior, self.temperature)
-        adjusted_lprobabilities = self.adjust_probabilities(lprobabilities, start_hash, ids)
+        if self.root_dist is None: # Constant for the sentence
+            self.reset_predictor(self.src_sentence)
+            ids, posterior, _ = self.apply_predictor()
+            self.root_dist = ids, utils.log_softmax(posterior, self.temperature)
+        ids, lprobabilities = self.root_dist
+        adjusted_lprobabilities = self.adjust_probabilities(lprobabilities, PrefixIndex.ROOT, ids)
         return np.any(~np.isnan(adjusted_lprobabilities) > utils.NEG_INF )
 
 
@@ -234,8 +386,54 @@ class CPSworDecoder(Decoder):
         self.nbest = decoder_args.nbest
         self.early_stopping = decoder_args.early_stopping
         self.estimate_rounds = decoder_args.inc_prob_estimate_rounds
+        self.estimate_workers = getattr(decoder_args, 'inc_prob_workers', 0)
+        self.estimate_combined = getattr(decoder_args, 'inc_prob_combined', False)
         self.sample_beam = decoder_args.sub_beam if decoder_args.sub_beam else self.nbest
+        self.decoder_args = decoder_args
+        self.predictor_name = None
+        self.rng = np.random
+        self.cache = None
+        self.pool = None
         assert not self.gumbel
+
+    def __del__(self):
+        self.shutdown_pool()
+
+    def add_predictor(self, name, predictor):
+        super().add_predictor(name, predictor)
+        self.predictor_name = name
+
+    def estimate_worker_spec(self):
+        """Returns a picklable description of this decoder from which
+        the worker processes of --inc_prob_workers build their own
+        decoder (see ``_init_estimate_worker()``). Predictors in
+        ``PREDICTOR_REGISTRY`` are given by name and created from the
+        arguments in each worker, so their models are loaded there
+        instead of being pickled. Other predictors are pickled.
+        """
+        import predictors
+        if self.predictor_name in predictors.PREDICTOR_REGISTRY:
+            predictor = self.predictor_name
+        else:
+            predictor = self.predictor
+        return (self.name, self.decoder_args, self.predictor_name, predictor,
+                (utils.GO_ID, utils.EOS_ID, utils.UNK_ID))
+
+    def shutdown_pool(self):
+        """Stops the worker processes of --inc_prob_workers, if any."""
+        pool, self.pool = getattr(self, 'pool', None), None
+        if pool is not None:
+            import atexit
+            atexit.unregister(pool.shutdown)
+            pool.shutdown()
+
+    def initialize_predictor(self, src_sentence):
+        super().initialize_predictor(src_sentence)
+        self.src_sentence = src_sentence
+        self.initial_state = self.predictor.snapshot()
+        # Posteriors and predictor states by prefix, reused by the
+        # Monte-Carlo rounds of the inclusion probability estimates
+        self.cache = {} if self.estimate_rounds > 1 else None
     
     def decode(self, src_sentence):
         self.initialize_predictor(src_sentence)
@@ -267,7 +465,8 @@ class CPSworDecoder(Decoder):
         scores = np.array(scores)
         inds, cur_beam_prob, inc_probs = CPSworDecoder.log_sample_k_dpp(scores, 
                                                         self.nbest,
-                                                        include_last=include_last)
+                                                        include_last=include_last,
+                                                        rng=self.rng)
         assert len(inds) == min(len(scores), self.nbest)
         self.beam_prob += cur_beam_prob
         for i in inds:
@@ -283,14 +482,22 @@ class CPSworDecoder(Decoder):
         Returns:
             list. List of child hypotheses
         """
-        self.set_predictor_states(copy.deepcopy(hypo.predictor_states))
-        if not hypo.word_to_consume is None: # Consume if cheap expand
-            self.consume(hypo.word_to_consume)
+        prefix = tuple(hypo.trgt_sentence)
+        cached = self.cache.get(prefix) if self.cache is not None else None
+        if cached is not None:
+            ids, posterior, new_states = cached
             hypo.word_to_consume = None
+        else:
+            self.set_predictor_states(copy.deepcopy(hypo.predictor_states))
+            if not hypo.word_to_consume is None: # Consume if cheap expand
+                self.consume(hypo.word_to_consume)
+                hypo.word_to_consume = None
 
-        ids, posterior, original_posterior = self.apply_predictor(hypo, limit)
-        #assert hypo.predictor_states != self.get_predictor_states()
-        new_states = self.get_predictor_states()
+            ids, posterior, original_posterior = self.apply_predictor(hypo, limit)
+            #assert hypo.predictor_states != self.get_predictor_states()
+            new_states = self.get_predictor_states()
+            if self.cache is not None:
+                self.cache[prefix] = ids, posterior, new_states
         new_hypos = [hypo.cheap_expand(
                         trgt_word,
                         hypo.score,
@@ -298,22 +505,86 @@ class CPSworDecoder(Decoder):
                         breakdown=posterior[idx],
                         states=new_states
                         ) for idx, trgt_word in enumerate(ids)]
+        if return_dist:
+            return new_hypos, posterior
         return new_hypos
 
     def get_inclusion_prob_estimate(self, src_sentence, trgt, **kwargs):
+        return self.get_inclusion_prob_estimates(src_sentence, [trgt], **kwargs)[0]
+
+    def get_inclusion_prob_estimates(self, src_sentence, hypos, **kwargs):
+        """Monte-Carlo estimates of the inclusion probabilities of
+        ``hypos`` with --inc_prob_estimate_rounds rounds each. Each round
+        is one constrained decode of one hypothesis. Round i of
+        hypothesis j uses its own ``np.random.Generator`` seeded with
+        (seed, j, i), so rounds are independent of each other and the
+        estimates do not depend on where or in which order rounds run.
+
+        Rounds run in this process, or on a pool of --inc_prob_workers
+        processes. Each worker builds its own decoder and predictor and
+        initializes the predictor (e.g. runs the encoder) once for each
+        sentence it gets rounds of. Encoder outputs and posterior caches
+        are not shared between processes. A task holds one round of one
+        hypothesis, or with --inc_prob_combined one round of every
+        hypothesis, which saves task overhead and lets the rounds share
+        the posterior cache of their worker.
+        """
         if self.estimate_rounds == 1:
-            return trgt.total_score
-        estimates = []
-        for i in range(self.estimate_rounds):
+            return np.array([trgt.total_score for trgt in hypos])
+        targets = [trgt.trgt_sentence for trgt in hypos]
+        if self.estimate_combined:
+            tasks = [(targets, [(self.seed, j, i) for j in range(len(targets))])
+                     for i in range(self.estimate_rounds)]
+        else:
+            tasks = [([target], [(self.seed, j, i)])
+                     for j, target in enumerate(targets)
+                     for i in range(self.estimate_rounds)]
+        if self.estimate_workers > 0:
+            if self.pool is None:
+                import atexit
+                import concurrent.futures
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    self.estimate_workers, initializer=_init_estimate_worker,
+                    initargs=(self.estimate_worker_spec(),))
+                atexit.register(self.pool.shutdown)
+            futures = [self.pool.submit(_run_estimate_task, src_sentence, task_targets, seeds)
+                       for task_targets, seeds in tasks]
+            results = [future.result() for future in futures]
+        else:
+            results = [self.run_estimate_task(src_sentence, task_targets, seeds)
+                       for task_targets, seeds in tasks]
+        if self.estimate_combined:
+            estimates = np.array(results).T
+        else:
+            estimates = np.array(results).reshape(len(hypos), self.estimate_rounds)
+        return np.logaddexp.reduce(estimates, axis=1) - np.log(self.estimate_rounds)
+
+    def run_estimate_task(self, src_sentence, targets, seeds):
+        """Runs one Monte-Carlo round for each of ``targets``. The
+        predictor is only initialized if ``src_sentence`` is not the
+        current sentence, so all rounds of a sentence in this process
+        share the encoder output and the posterior cache.
+
+        Args:
+            src_sentence (list): Source sentence
+            targets (list): Target sentences
+            seeds (list): Seed of the random generator for each target
+
+        Returns:
+            list. Log inclusion probability estimate for each target
+        """
+        if self.cache is None or src_sentence != self.src_sentence:
             self.initialize_predictor(src_sentence)
-            np.random.seed(seed=self.seed*self.nbest+i)
-            estimates.append(self.monte_carlo_inclusion_prob_estimate(src_sentence, trgt))
-        # reset seed
-        np.random.seed(seed=self.seed)
-        return utils.logsumexp(estimates) - np.log(self.estimate_rounds)
+        estimates = []
+        for target, seed in zip(targets, seeds):
+            self.rng = np.random.default_rng(seed)
+            self.predictor.restore(self.initial_state)
+            estimates.append(self.monte_carlo_inclusion_prob_estimate(src_sentence, target))
+        self.rng = np.random
+        return estimates
 
-    def monte_carlo_inclusion_prob_estimate(self, src_sentence, trgt):
-        self.trgt_sentence = trgt.trgt_sentence + [utils.EOS_ID] if trgt.trgt_sentence[-1] != utils.EOS_ID else trgt.trgt_sentence
+    def monte_carlo_inclusion_prob_estimate(self, src_sentence, trgt_sentence):
+        self.trgt_sentence = trgt_sentence + [utils.EOS_ID] if trgt_sentence[-1] != utils.EOS_ID else trgt_sentence
 
         it = 0
         self.beam_prob = 0.
@@ -353,7 +624,7 @@ class CPSworDecoder(Decoder):
         return False
 
     @staticmethod
-    def log_sample_k_dpp(log_lambdas, k, include_last=False):
+    def log_sample_k_dpp(log_lambdas, k, include_last=False, rng=np.random):
         N = len(log_lambdas)
         if k >= N:
             return range(N), 0., [0.]*N
@@ -372,7 +643,7 @@ class CPSworDecoder(Decoder):
                 return J, CPSworDecoder.log_beam_prob(log_lambdas, log_E, J), inc_probs
 
         for n in range(N,0,-1):
-            u = np.random.uniform()
+            u = rng.uniform()
             thresh = log_lambdas[n-1] + log_E[k-1,n-1] - log_E[k,n]  
             if np.log(u) < thresh:
                 J.append(n-1)
@@ -411,6 +682,17 @@ class CPSworDecoder(Decoder):
         parser.add_argument("--inc_prob_estimate_rounds", default=1, type=int,
                         help="Number of rounds to use when creating inclusion probability"
                         "estimate")
+        parser.add_argument("--inc_prob_workers", default=0, type=int,
+                        help="Number of worker processes for the rounds of "
+                        "the inclusion probability estimates. 0 runs them in "
+                        "the decoding process. Each worker loads its own "
+                        "predictor and runs the encoder once per sentence.")
+        parser.add_argument("--inc_prob_combined", default=False, type='bool',
+                        help="Run each round of the inclusion probability "
+                        "estimates for all samples of a sentence in one task, "
+                        "instead of one task per sample and round. Each "
+                        "sample still gets its own constrained decode, but "
+                        "they share the expanded prefixes of their worker.")
 
 class PSworDecoder(CPSworDecoder):
     name = "p_swor"
@@ -438,12 +720,17 @@ class PSworDecoder(CPSworDecoder):
             it += 1
             next_hypos = []
             next_scores = []
+            expanded = []
+            dists = []
             for hypo in hypos:
                 if hypo.get_last_word() == utils.EOS_ID:
                     self.add_full_hypo(hypo.generate_full_hypothesis()) 
                     continue 
                 expansions, dist = self._expand_hypo(hypo, return_dist=True)
-                c = sampling_utils.get_const(dist + hypo.score, desired_k)
+                expanded.append((hypo, expansions))
+                dists.append(dist + hypo.score)
+            consts = sampling_utils.get_consts(dists, desired_k)
+            for (hypo, expansions), c in zip(expanded, consts):
                 c /= hypo.base_score
                 c = np.power(c, 1./(self.max_len - len(hypo)))
                 hypo.base_score *= c
@@ -471,59 +758,259 @@ class PSworDecoder(CPSworDecoder):
 
     @staticmethod
     def log_sample_poisson(log_lambdas, k=1, normalize=True):
-        J = []
-        
         inc_probs = np.log(k) + log_lambdas 
         if normalize:
             inc_probs -= utils.logsumexp(log_lambdas)
         
-        for i,l in enumerate(inc_probs):
-            u = np.random.uniform() 
-            if np.log(u) < l:
-                J.append(i)
+        u = np.random.uniform(size=len(inc_probs))
+        J = np.flatnonzero(np.log(u) < inc_probs).tolist()
         return J, inc_probs
 
-class MapDist(object):
-
-    def __init__(self):
-        self.dist_map = {}
-
-    def __contains__(self, key):
-        return tuple(key) in self.dist_map
+_estimate_decoder = None
+
+
+def _init_estimate_worker(spec):
+    """Builds the decoder of a worker process from
+    ``CPSworDecoder.estimate_worker_spec()``."""
+    global _estimate_decoder
+    import decoding
+    import predictors
+    name, decoder_args, predictor_name, predictor, reserved_ids = spec
+    utils.GO_ID, utils.EOS_ID, utils.UNK_ID = reserved_ids
+    if isinstance(predictor, str):
+        predictor = predictors.PREDICTOR_REGISTRY[predictor](decoder_args)
+    _estimate_decoder = decoding.DECODER_REGISTRY[name](decoder_args)
+    _estimate_decoder.add_predictor(predictor_name, predictor)
+
+
+def _run_estimate_task(src_sentence, targets, seeds):
+    """``CPSworDecoder.run_estimate_task()`` in a worker process."""
+    return _estimate_decoder.run_estimate_task(src_sentence, targets, seeds)
+
+
+class TrieNode(object):
+    """Node of the prefix trie which stores the SWOR distributions. The
+    decoders walk down the trie one token at a time, so a prefix is
+    never hashed or sliced. ``dist`` is the ``Dist`` over the next
+    words of the prefix, and is None until the prefix is expanded.
+    Children are keyed by the index of their word in ``dist``. Nodes
+    also keep the ``Dist`` of their parent and their index in it, so
+    the current probability of the prefix is available without a
+    lookup (and without parent pointers).
+    """
+    __slots__ = ('children', 'dist', 'parent_dist', 'index')
+
+    def __init__(self, parent_dist=None, index=None):
+        self.children = {}
+        self.dist = None
+        self.parent_dist = parent_dist
+        self.index = index
+
+    def child(self, index):
+        """Returns the child for the word at ``index`` of ``dist``,
+        creating it if necessary."""
+        node = self.children.get(index)
+        if node is None:
+            node = self.children[index] = TrieNode(self.dist, index)
+        return node
+
+    def marg(self):
+        """Returns the current (adjusted) log-probability of this node
+        in the distribution of its parent, or 0 for the root."""
+        if self.parent_dist is None:
+            return 0
+        return self.parent_dist.adjusted_lprobabilities[self.index]
 
-    def add_dist(self, prefix, ids, dist, states):
-        self.dist_map[prefix] = Dist(ids, dist, states)
 
-    def adjust(self, prefix, next_word, val):
-        self.dist_map[prefix].adjust(next_word, val)
+class PrefixIndex(object):
+    """Adjustments of ``MemEfficientSworDecoder``. Prefixes are
+    hash-consed: each distinct prefix gets an integer ID, and the ID of
+    a prefix extended by a word is looked up by (prefix ID, word), so
+    prefixes are never stored or hashed as tuples. Memory is thus
+    proportional to the number of distinct prefixes. For each prefix,
+    the sampled next words and the log-mass which has been removed
+    from them are kept in two parallel arrays.
+    """
 
-    def get(self, prefix):
-        return self.dist_map[prefix].values()
+    ROOT = 0
+    """ID of the empty prefix."""
 
-    def marg(self, prefix):
-        if not prefix[:-1] in self.dist_map:
-            return 0
-        return self.dist_map[prefix[:-1]].get_current(prefix[-1])
+    def __init__(self):
+        self.children = {}
+        self.words = [np.zeros(0, dtype=np.int64)]
+        self.masses = [np.zeros(0)]
+
+    def child(self, prefix, word):
+        """Returns the ID of ``prefix`` extended by ``word``."""
+        key = (prefix, word)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = len(self.words)
+            self.words.append(np.zeros(0, dtype=np.int64))
+            self.masses.append(np.zeros(0))
+        return child
+
+    def add(self, prefix, word, lmass):
+        """Removes ``lmass`` (log) from ``word`` after ``prefix``."""
+        words = self.words[prefix]
+        pos = np.flatnonzero(words == word)
+        if len(pos):
+            masses = self.masses[prefix]
+            masses[pos[0]] = utils.log_add(lmass, masses[pos[0]])
+        else:
+            self.words[prefix] = np.append(words, word)
+            self.masses[prefix] = np.append(self.masses[prefix], lmass)
+
+    def adjustments(self, prefix):
+        """Returns the sampled words after ``prefix`` and their removed
+        log-masses as two arrays."""
+        return self.words[prefix], self.masses[prefix]
 
 
 class Dist(object):
 
     def __init__(self, ids, lprobabilities, predictor_states):
         self.ids = ids
+        n = len(lprobabilities)
         self.lprobabilities = SumHeap(lprobabilities, log_space=True)
-        self.adjustments = SumHeap(np.full_like(lprobabilities, utils.NEG_INF, dtype=np.float64), log_space=True)
+        self.adjustments = SumHeap.from_buffer(
+            np.full(SumHeap.buffer_size(n), utils.NEG_INF), n,
+            log_space=True, heapify=False)
         self.predictor_states = copy.deepcopy(predictor_states)
-        self.adjusted_lprobabilities = SumHeap(lprobabilities, log_space=True)
+        self.adjusted_lprobabilities = SumHeap.from_buffer(
+            np.array(self.lprobabilities.S), n, log_space=True, heapify=False)
     
     def get_current(self, k):
         ind = utils.binary_search(self.ids, k)
         return self.adjusted_lprobabilities[ind]
 
     def adjust(self, k, val):
-        ind = utils.binary_search(self.ids, k)
+        self.adjust_index(utils.binary_search(self.ids, k), val)
+
+    def adjust_index(self, ind, val):
         self.adjustments[ind] = utils.log_add(self.adjustments[ind], val)
         self.adjusted_lprobabilities[ind] = utils.log_minus(self.lprobabilities[ind], self.adjustments[ind])
 
+    def sample(self):
+        return self.adjusted_lprobabilities.sample()
+
+    def sample_many(self, k):
+        """Returns ``k`` indices sampled with replacement."""
+        return np.asarray(self.adjusted_lprobabilities.sample_many(np.random.random(k)))
+
+    def values(self):
+        return self.ids, self.lprobabilities, self.adjusted_lprobabilities, self.predictor_states
+
+
+class SparseDist(object):
+    """Sparse version of ``Dist``. Instead of three SumHeaps over the
+    full vocabulary, it keeps explicit entries (slots) only for the top
+    k words and for words which have been sampled, plus one "rest" slot
+    with the mass of all other words. These words are never adjusted,
+    so the rest mass is just the sum of their probabilities, kept in a
+    log-space ``SumHeap`` over the full distribution (the tail). If the
+    sampler lands in the rest slot, a word is drawn from the tail in
+    proportion to its probability and gets its own slot, both in
+    O(log V). Thus, samples follow exactly the same distribution as
+    with ``Dist``.
+
+    Slot indices are stable, so ``values()`` and ``sample()`` can be
+    used like with ``Dist``. The rest slot (0) is never returned by
+    ``sample()``.
+    """
+
+    REST = 0
+
+    def __init__(self, ids, lprobabilities, predictor_states, k):
+        lprobabilities = np.array(lprobabilities, dtype=np.float64)
+        if len(ids) and ids[0] == 0 and ids[-1] == len(ids) - 1:
+            self.all_ids = None # Sorted full vocabulary: position = word
+        else:
+            self.all_ids = np.asarray(ids, dtype=np.int64)
+        self.predictor_states = copy.deepcopy(predictor_states)
+        n = len(lprobabilities)
+        if k < n:
+            top = np.sort(np.argpartition(-lprobabilities, k-1)[:k])
+        else:
+            top = np.arange(n)
+        capacity = 2
+        while capacity < len(top) + 2:
+            capacity *= 2
+        self.ids = [None] + [ids[i] for i in top]
+        self.slots = {w: slot for slot, w in enumerate(self.ids) if slot}
+        self.lprobabilities = np.full(capacity, utils.NEG_INF)
+        self.lprobabilities[1:len(top)+1] = lprobabilities[top]
+        self.adjustments = np.full(capacity, utils.NEG_INF)
+        # Log-probabilities of the words without a slot
+        tail = np.full(SumHeap.buffer_size(n), utils.NEG_INF)
+        d = len(tail) // 2
+        tail[d:d+n] = lprobabilities
+        tail[d + top] = utils.NEG_INF
+        self.tail = SumHeap.from_buffer(tail, n, log_space=True)
+        self.lprobabilities[self.REST] = self.tail.S[1]
+        self.adjusted_lprobabilities = SumHeap(self.lprobabilities.copy(), log_space=True)
+
+    def _split(self, pos):
+        """Moves the word at position ``pos`` of the full distribution
+        from the rest bucket to a new slot."""
+        slot = len(self.ids)
+        if slot == len(self.lprobabilities):
+            self._grow()
+        word = pos if self.all_ids is None else int(self.all_ids[pos])
+        self.ids.append(word)
+        self.slots[word] = slot
+        self.lprobabilities[slot] = self.tail[pos]
+        self.tail.update(pos, utils.NEG_INF)
+        self.lprobabilities[self.REST] = self.tail.S[1]
+        self.adjusted_lprobabilities.update_many(
+            np.array([self.REST, slot]), self.lprobabilities[[self.REST, slot]])
+        return slot
+
+    def _grow(self):
+        capacity = 2*len(self.lprobabilities)
+        n, d = self.adjusted_lprobabilities.n, self.adjusted_lprobabilities.d
+        adjusted = np.full(SumHeap.buffer_size(capacity), utils.NEG_INF)
+        adjusted[capacity:capacity+n] = self.adjusted_lprobabilities.S[d:d+n]
+        for name in ['lprobabilities', 'adjustments']:
+            old = getattr(self, name)
+            new = np.full(capacity, utils.NEG_INF)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.adjusted_lprobabilities = SumHeap.from_buffer(adjusted, capacity, log_space=True)
+
+    def get_current(self, k):
+        slot = self.slots.get(k)
+        if slot is None:
+            if self.all_ids is None:
+                return self.tail[k]
+            return self.tail[utils.binary_search(self.all_ids, k)]
+        return self.adjusted_lprobabilities[slot]
+
+    def adjust(self, k, val):
+        self.adjust_index(self.slots[k], val)
+
+    def adjust_index(self, ind, val):
+        self.adjustments[ind] = utils.log_add(self.adjustments[ind], val)
+        self.adjusted_lprobabilities[ind] = utils.log_minus(self.lprobabilities[ind], self.adjustments[ind])
+
+    def sample(self):
+        ind = self.adjusted_lprobabilities.sample()
+        if ind != self.REST:
+            return ind
+        return self._split(self.tail.sample())
+
+    def sample_many(self, k):
+        """Returns ``k`` slots sampled with replacement."""
+        inds = np.asarray(self.adjusted_lprobabilities.sample_many(np.random.random(k)))
+        rest = np.flatnonzero(inds == self.REST)
+        if len(rest):
+            # All words are drawn from the tail before any is split
+            positions = np.asarray(
+                self.tail.sample_many(np.random.random(len(rest))))
+            slots = {pos: self._split(pos) for pos in set(positions.tolist())}
+            inds[rest] = [slots[pos] for pos in positions.tolist()]
+        return inds
+
     def values(self):
         return self.ids, self.lprobabilities, self.adjusted_lprobabilities, self.predictor_states
 
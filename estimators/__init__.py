@@ -1,20 +1,9 @@
-import os
-import inspect
-import importlib
-from .core import Estimator
+import utils
+from .core import Estimator, EstimateWriter, SAMPLE_DTYPE
 
-ESTIMATOR_REGISTRY = {}
-
-estimator_dir = os.path.dirname(__file__)
-for file in os.listdir(estimator_dir):
-    path = os.path.join(estimator_dir, file)
-    if not file.startswith('_') and not file.startswith('.') and file.endswith('.py'):
-        name = file[:file.find('.py')]
-        module = importlib.import_module('estimators.' + name)
-        clsmembers = inspect.getmembers(module, inspect.isclass)
-        for name, _cls in clsmembers:
-        	if issubclass(_cls, Estimator) and not _cls == Estimator:
-        		if not hasattr(_cls, 'name'):
-        			raise ValueError("All estimators classes must have `name` attribute. Culprit: {}".format(name))
-        		else:
-        			ESTIMATOR_REGISTRY[_cls.name] = _cls
+# Estimator modules are only imported when looked up. New estimators
+# need an entry 'module.ClassName' here.
+ESTIMATOR_REGISTRY = utils.LazyRegistry('estimators', {
+    'bleu': 'core.BleuScoreEstimator',
+    'entropy': 'core.ModelEntropyEstimator',
+})
@@ -2,35 +2,95 @@ import utils
 import io_utils
 import numpy as np
 
+
+SAMPLE_DTYPE = np.dtype([('sen_id', '<i4'), ('iteration', '<i4'),
+	('log_weight', '<f8'), ('value', '<f8')])
+"""Record type of the samples in binary estimator output files."""
+
+
 class Estimator:
 	"""
 	Computations in log space!!
+
+	Samples are accumulated in batches. The estimator keeps the log of
+	the total weight, the log of the sum of squared weights (for the
+	effective sample size) and the weighted mean and variance of the
+	values. Batches are merged with the parallel (Chan et al.) variant
+	of Welford's algorithm, where weights only enter as ratios of log
+	weights, so they never over- or underflow.
 	"""
 
 	def __init__(self, args):
-		self._count = 0
-		self._weight = self._total = utils.NEG_INF
 		self.normalize = not args.no_normalization
-		self.sign = 1
+		self.reset()
 
 	def add_value(self, hypo, weight, **kwargs):
 		raise NotImplementedError
 
+	def add_values(self, hypos, weights, **kwargs):
+		"""Adds all samples of a sentence at once. Subclasses can override
+		this to compute the values in a batch. Returns the list of values."""
+		return [self.add_value(h, w, **kwargs) for h, w in zip(hypos, weights)]
+
 	def increment(self, value, weight):
-		log_value = np.log(abs(value)) if value else utils.NEG_INF
-		sign = 1 if value >= 0 else -1
-		self.sign, self._total = utils.signed_log_add(self._total, log_value + weight, self.sign, sign)
-		self._weight = utils.log_add(self._weight, weight)
-		self._count += 1
+		self.increment_batch([value], [weight])
+
+	def increment_batch(self, values, weights):
+		"""Adds samples with ``values`` and log ``weights``."""
+		values = np.asarray(values, dtype=np.float64)
+		weights = np.asarray(weights, dtype=np.float64)
+		self._count += len(values)
+		log_w = np.logaddexp.reduce(weights) if len(weights) else utils.NEG_INF
+		if log_w == utils.NEG_INF:
+			return
+		rel = np.exp(weights - log_w)
+		mean = np.dot(rel, values)
+		var = np.dot(rel, (values - mean)**2)
+		log_w2 = np.logaddexp.reduce(2*weights)
+		if self._weight == utils.NEG_INF:
+			self._weight, self._weight2 = log_w, log_w2
+			self._mean, self._var = mean, var
+			return
+		total = np.logaddexp(self._weight, log_w)
+		frac = np.exp(log_w - total)
+		delta = mean - self._mean
+		self._var = (1-frac)*self._var + frac*var + frac*(1-frac)*delta**2
+		self._mean += frac*delta
+		self._weight = total
+		self._weight2 = np.logaddexp(self._weight2, log_w2)
 
 	def estimate(self):
 		if self.normalize:
-			return self.sign*np.exp(self._total - self._weight)
-		return self.sign*np.exp(self._total)
+			return self._mean
+		return self._mean*np.exp(self._weight)
+
+	def effective_sample_size(self):
+		"""Kish's effective sample size of the weights."""
+		if self._weight == utils.NEG_INF:
+			return 0.
+		return np.exp(2*self._weight - self._weight2)
+
+	def variance(self):
+		"""Weighted variance of the values."""
+		return self._var
+
+	def confidence_interval(self, z=1.96):
+		"""Normal approximation of the confidence interval of
+		``estimate()`` based on the effective sample size. The default
+		``z`` gives a 95% interval."""
+		ess = self.effective_sample_size()
+		if ess <= 0:
+			return utils.NEG_INF, -utils.NEG_INF
+		half = z*np.sqrt(self._var/ess)
+		if not self.normalize:
+			half *= np.exp(self._weight)
+		est = self.estimate()
+		return est - half, est + half
 
 	def reset(self):
 		self._count = 0
-		self._weight = self._total = utils.NEG_INF
+		self._weight = self._weight2 = utils.NEG_INF
+		self._mean = self._var = 0.
 
 	@staticmethod
 	def add_args(parser):
@@ -40,29 +100,147 @@ class Estimator:
 			help="Use importance sampling techniques for building estimators")
 
 
+class EstimateWriter(object):
+	"""Streams estimator samples and per-iteration summaries to disk
+	while decoding, one sentence at a time.
+
+	In 'csv' format, ``<path>.csv`` contains one line per sample
+	(sen_id, iteration, log_weight, value) and ``<path>.summary.csv``
+	one line per estimator iteration (sen_id, iteration, count,
+	estimate, std, ess, ci_low, ci_high). In 'bin' format, samples are
+	appended to ``<path>.bin`` as ``SAMPLE_DTYPE`` records, which can be
+	loaded with ``np.fromfile(path, dtype=SAMPLE_DTYPE)``. The summary
+	is always written as CSV.
+	"""
+
+	SUMMARY_HEADER = "sen_id,iteration,count,estimate,std,ess,ci_low,ci_high\n"
+
+	def __init__(self, path, fmt='csv'):
+		"""Opens the output files.
+
+		Args:
+			path (string): Path prefix of the output files
+			fmt (string): 'csv' or 'bin'
+		"""
+		self.fmt = fmt
+		if fmt == 'bin':
+			self.samples = open(path + '.bin', 'wb')
+		else:
+			self.samples = open(path + '.csv', 'w')
+			self.samples.write("sen_id,iteration,log_weight,value\n")
+		self.summary = open(path + '.summary.csv', 'w')
+		self.summary.write(self.SUMMARY_HEADER)
+
+	def write(self, sen_id, iteration, weights, values, estimator):
+		"""Writes the samples of one estimator iteration and the summary
+		of ``estimator`` (before it is reset)."""
+		records = np.zeros(len(values), dtype=SAMPLE_DTYPE)
+		records['sen_id'] = sen_id
+		records['iteration'] = iteration
+		records['log_weight'] = weights
+		records['value'] = values
+		if self.fmt == 'bin':
+			records.tofile(self.samples)
+		else:
+			np.savetxt(self.samples, records, fmt=['%d', '%d', '%.17g', '%.17g'],
+				delimiter=',')
+		low, high = estimator.confidence_interval()
+		self.summary.write("%d,%d,%d,%.17g,%.17g,%.17g,%.17g,%.17g\n" % (
+			sen_id, iteration, estimator._count, estimator.estimate(),
+			np.sqrt(estimator.variance()), estimator.effective_sample_size(),
+			low, high))
+
+	def flush(self):
+		self.samples.flush()
+		self.summary.flush()
+
+	def close(self):
+		self.samples.close()
+		self.summary.close()
+
+
 class BleuScoreEstimator(Estimator):
 
 	
 	name='bleu'
 	def __init__(self, args):
-		from mosestokenizer import MosesDetokenizer
-
 		super(BleuScoreEstimator, self).__init__(args)
-		trgt_language = args.trgt_language
-		self.detokenizer = MosesDetokenizer(trgt_language) 
+		self.bleu_space = args.bleu_space
+		self.detokenizer = None
+		if self.bleu_space == 'detok':
+			from mosestokenizer import MosesDetokenizer
+			trgt_language = args.trgt_language
+			self.detokenizer = MosesDetokenizer(trgt_language) 
+		self._word_ids = {}
+		self.executor = None
+		if args.bleu_workers > 0:
+			import concurrent.futures
+			pool = (concurrent.futures.ProcessPoolExecutor if args.bleu_pool == 'process'
+				else concurrent.futures.ThreadPoolExecutor)
+			self.executor = pool(max_workers=args.bleu_workers)
+		self._ref = self._scorer = None
+
+	def get_scorer(self, ref):
+		"""Reference statistics are computed once per sentence, not once
+		per sample."""
+		if ref is not self._ref:
+			self._ref = ref
+			if self.bleu_space == 'detok':
+				self._scorer = utils.SentenceBleuScorer(ref, self.detokenizer)
+			else:
+				self._scorer = utils.IdBleuScorer(self.token_ids([ref])[0])
+		return self._scorer
+
+	def token_ids(self, sentences):
+		"""Token ID sequences for ``IdBleuScorer``: word IDs assigned by
+		this estimator for --bleu_space word, target IDs for id."""
+		if self.bleu_space == 'word':
+			word_ids = self._word_ids
+			return [[word_ids.setdefault(w, len(word_ids)) for w in sen.split()]
+				for sen in sentences]
+		sentences = [io_utils.encode_trg(sen) if isinstance(sen, str) else sen
+			for sen in sentences]
+		return [sen[:-1] if sen and sen[-1] == utils.EOS_ID else sen
+			for sen in sentences]
 
 	def add_value(self, hypo, weight, ref=None):
+		return self.add_values([hypo], [weight], ref=ref)[0]
+
+	def add_values(self, hypos, weights, ref=None):
 		if not ref:
-			return 0
-		sen = io_utils.decode(hypo.trgt_sentence)
-		value = utils.sentence_bleu(sen, ref, self.detokenizer)
-		self.increment(value, weight)
-		return value
+			return [0] * len(hypos)
+		scorer = self.get_scorer(ref)
+		if self.bleu_space == 'id':
+			values = scorer.score_batch(self.token_ids([h.trgt_sentence for h in hypos])).tolist()
+		else:
+			sens = io_utils.decode_batch([h.trgt_sentence for h in hypos])
+			if self.bleu_space == 'word':
+				values = scorer.score_batch(self.token_ids(sens)).tolist()
+			else:
+				values = scorer.score_batch(sens, self.executor)
+		self.increment_batch(values, weights)
+		return values
 
 	@staticmethod
 	def add_args(parser):
 		Estimator.add_args(parser)
 		parser.add_argument("--trgt_language", default=None, type=str)
+		parser.add_argument("--bleu_space", default="detok", choices=['detok', 'word', 'id'],
+			help="Which tokens BLEU is computed on.\n\n"
+			"* 'detok': sacrebleu on Moses detokenized hypotheses and "
+			"references (slowest)\n"
+			"* 'word': postprocessed words (e.g. after merging BPE), "
+			"vectorized on word IDs\n"
+			"* 'id': target token IDs (e.g. BPE units) as the decoder "
+			"sees them, vectorized without decoding to strings")
+		parser.add_argument("--bleu_workers", default=0, type=int,
+			help="Number of workers which compute the BLEU scores of the "
+			"samples of a sentence in parallel. 0 computes them in the "
+			"main thread.")
+		parser.add_argument("--bleu_pool", default="process", choices=['process', 'thread'],
+			help="Type of the worker pool for --bleu_workers. BLEU "
+			"computation is pure Python, so processes are usually faster "
+			"than threads.")
 
 
 class ModelEntropyEstimator(Estimator):
@@ -72,7 +250,10 @@ class ModelEntropyEstimator(Estimator):
 		super(ModelEntropyEstimator, self).__init__(args)
 
 	def add_value(self, hypo, weight, **kwargs):
-		value = -hypo.base_score if hypo.base_score else -hypo.total_score
-		self.increment(value, weight)
-		return value
+		return self.add_values([hypo], [weight])[0]
+
+	def add_values(self, hypos, weights, **kwargs):
+		values = [-h.base_score if h.base_score else -h.total_score for h in hypos]
+		self.increment_batch(values, weights)
+		return values
 
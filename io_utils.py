@@ -24,8 +24,17 @@ representations, and output files also contain indexed sentences.
 import logging
 import utils
 import codecs
+import collections
+import heapq
+import itertools
 import re
 import os
+import sys
+import threading
+
+import numpy as np
+
+import binary_wmap
 
 
 def encode(sentence, target=False):
@@ -57,6 +66,19 @@ def encode_trg(trg_sentence):
     return encoder.encode_trg(trg_sentence)
 
 
+def encode_batch(sentences):
+    """Converts a list of sentences in string representation to lists
+    of token IDs. This method calls ``encoder.encode_batch()``.
+
+    Args:
+        sentences (list): Input sentences (strings)
+
+    Returns:
+        List of lists of integers.
+    """
+    return encoder.encode_batch(sentences)
+
+
 def decode(trg_sentence):
     """Converts the target sentence represented as sequence of token
     IDs to a string representation. This method calls
@@ -71,6 +93,21 @@ def decode(trg_sentence):
     return decoder.decode(trg_sentence)
 
 
+def decode_batch(trg_sentences):
+    """Converts a list of target sentences represented as sequences of
+    token IDs (e.g. an n-best list) to strings. This is faster than
+    calling ``decode()`` for each sentence. This method calls
+    ``decoder.decode_batch()``.
+
+    Args:
+        trg_sentences (list): Sequences of integers (token IDs)
+
+    Returns:
+        List of strings.
+    """
+    return decoder.decode_batch(trg_sentences)
+
+
 def initialize(args):
     """Initializes the ``io`` module, including loading word maps and
     other resources needed for encoding and decoding. Subsequent calls
@@ -95,11 +132,14 @@ def initialize(args):
     elif args.preprocessing == "char":
         encoder = CharEncoder()
     elif args.preprocessing == "bpe":
-        encoder = BPEEncoder(args.bpe_codes)
+        encoder = BPEEncoder(args.bpe_codes, cache_size=args.bpe_cache_size,
+                             cache_path=args.bpe_cache_path)
     elif args.preprocessing == "bpe@@":
-        encoder = BPEEncoder(args.bpe_codes, "@@", True)
+        encoder = BPEEncoder(args.bpe_codes, "@@", True,
+                             args.bpe_cache_size, args.bpe_cache_path)
     elif args.preprocessing == "bpe_":
-        encoder = BPEEncoder(args.bpe_codes, "▁", True)
+        encoder = BPEEncoder(args.bpe_codes, "▁", True,
+                             args.bpe_cache_size, args.bpe_cache_path)
     else:
         raise NotImplementedError("Unknown preprocessing")
     if args.postprocessing == "id":
@@ -152,6 +192,18 @@ class Encoder(object):
     def encode_trg(self, trg_sentence):
         raise NotImplementedError
 
+    def encode_batch(self, src_sentences):
+        """Applies ``encode()`` to each sentence in ``src_sentences``.
+        Subclasses may override this with a faster implementation.
+
+        Args:
+            src_sentences (list): Input sentences (strings)
+
+        Returns:
+            List of lists of integers.
+        """
+        return [self.encode(src_sentence) for src_sentence in src_sentences]
+
 
 class Decoder(object):
     """"Super class for IO decoders."""
@@ -168,6 +220,58 @@ class Decoder(object):
         """
         raise NotImplementedError
 
+    def decode_batch(self, trg_sentences):
+        """Applies ``decode()`` to each sentence in ``trg_sentences``.
+        Subclasses may override this with a faster implementation.
+
+        Args:
+            trg_sentences (list): Sequences of integers (token IDs)
+
+        Returns:
+            List of strings.
+        """
+        return [self.decode(trg_sentence) for trg_sentence in trg_sentences]
+
+
+class WordMapDecoder(Decoder):
+    """Super class for decoders which look up each token ID in
+    ``trg_wmap`` and join the resulting strings with ``join()``.
+    ``decode_batch()`` looks up the tokens of all sentences at once in
+    an array version of the word map (see ``get_trg_wmap_array()``)
+    instead of calling ``dict.get`` for each token.
+    """
+
+    def join(self, words):
+        """Joins the strings of the tokens of a sentence.
+
+        Args:
+            words (list): Target words (strings)
+
+        Returns:
+            string.
+        """
+        raise NotImplementedError
+
+    def decode(self, trg_sentence):
+        if isinstance(trg_wmap, dict):
+            return self.join([trg_wmap.get(w, "<UNK>") for w in trg_sentence])
+        words = get_trg_wmap_array()
+        unk_idx = len(words) - 1
+        return self.join([words[w] if 0 <= w < unk_idx else words[unk_idx]
+                          for w in trg_sentence])
+
+    def decode_batch(self, trg_sentences):
+        lengths = [len(trg_sentence) for trg_sentence in trg_sentences]
+        ids = np.fromiter(itertools.chain.from_iterable(trg_sentences),
+                          dtype=np.int64, count=sum(lengths))
+        words = get_trg_wmap_array()
+        unk_idx = len(words) - 1
+        ids[(ids < 0) | (ids > unk_idx)] = unk_idx
+        words = words[ids].tolist()
+        offsets = np.cumsum([0] + lengths).tolist()
+        return [self.join(words[offsets[i]:offsets[i+1]])
+                for i in range(len(trg_sentences))]
+
 
 class IDEncoder(Encoder):
     """Encoder for ID mapping."""
@@ -175,6 +279,10 @@ class IDEncoder(Encoder):
     def encode(self, src_sentence):
         return [int(w) for w in src_sentence.split()]
 
+    def encode_batch(self, src_sentences):
+        return [list(map(int, src_sentence.split()))
+                for src_sentence in src_sentences]
+
 
 class IDDecoder(Decoder):
     """"Decoder for ID mapping."""
@@ -194,12 +302,18 @@ class WordEncoder(Encoder):
         return [trg_wmap_rev.get(w, utils.UNK_ID) 
                 for w in trg_sentence.split()]
 
+    def encode_batch(self, src_sentences):
+        get = src_wmap.get
+        unk_id = utils.UNK_ID
+        return [[get(w, unk_id) for w in src_sentence.split()]
+                for src_sentence in src_sentences]
+
 
-class WordDecoder(Decoder):
+class WordDecoder(WordMapDecoder):
     """"Decoder for word based mapping."""
 
-    def decode(self, trg_sentence):
-        return " ".join(trg_wmap.get(w, "<UNK>") for w in trg_sentence)
+    def join(self, words):
+        return " ".join(words)
 
 class BartDecoder(Decoder):
     """"Decoder for word based mapping."""
@@ -216,21 +330,44 @@ class CharEncoder(Encoder):
                 for c in src_sentence.replace(" ", "_")]
 
 
-class CharDecoder(Decoder):
+class CharDecoder(WordMapDecoder):
     """"Decoder for char mapping."""
 
-    def decode(self, trg_sentence):
-        return "".join(
-              trg_wmap.get(c, "<UNK>") for c in trg_sentence).replace("_", " ")
+    def join(self, words):
+        return "".join(words).replace("_", " ")
 
 
 # The BPE implementation is adapted from Rico Sennrich's subword_nmt 
 # repository:
 # https://github.com/rsennrich/subword-nmt
+#
+# Instead of searching the best pair and rebuilding the word after each
+# merge, merges are applied to a linked list of symbols with a priority
+# queue of (rank, position) entries. Entries of merged symbols become
+# stale and are skipped when popped. As in subword_nmt, all occurrences
+# of the best pair are merged from left to right before new pairs are
+# considered, so the segmentation is the same.
+
+BPE_CACHE_SIZE = 100000
+"""Default number of words in the in-memory BPE cache."""
+
 
 class BPE(object):
 
-    def __init__(self, codes_path, separator='@@', remove_eow=False):
+    def __init__(self, codes_path, separator='@@', remove_eow=False,
+                 cache_size=BPE_CACHE_SIZE, cache_path=None):
+        """Loads BPE codes.
+
+        Args:
+            codes_path (string): Path to the codes file
+            separator (string): Appended to non-final subword units
+            remove_eow (bool): Remove end-of-word symbols
+            cache_size (int): Maximum number of words in the in-memory
+                              LRU cache of segmentations
+            cache_path (string): Path to an SQLite database for caching
+                                 segmentations across runs and worker
+                                 processes. Disabled if empty
+        """
 
         with codecs.open(codes_path, encoding='utf-8') as codes:
             codes.seek(0)
@@ -258,7 +395,12 @@ class BPE(object):
 
         self.separator = separator
 
-        self.cache = {}
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock() # Servers encode in many threads
+        self.disk_cache = None
+        if cache_path:
+            self.disk_cache = BPEDiskCache(cache_path, codes_path, remove_eow)
 
         self.remove_eow = remove_eow
 
@@ -315,66 +457,154 @@ class BPE(object):
         """Encode word based on list of BPE merge operations, which are applied consecutively
         """
 
-        if orig in self.cache:
-            return self.cache[orig]
-  
-        if self.version == (0, 1):
-            word = tuple(orig) + ('</w>',)
-        elif self.version == (0, 2): # more consistent handling of word-final segments
-            word = tuple(orig[:-1]) + ( orig[-1] + '</w>',)
-        else:
-            raise NotImplementedError
-
-        pairs = self.get_pairs(word)
-
-        if not pairs:
-            return orig
-
-        while True:
-            bigram = min(pairs, key = lambda pair: self.bpe_codes.get(pair, float('inf')))
-            if bigram not in self.bpe_codes:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word)-1 and word[i+1] == second:
-                    new_word.append(first+second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
+        with self.cache_lock:
+            word = self.cache.get(orig)
+            if word is not None:
+                self.cache.move_to_end(orig)
+                return word
+        if self.disk_cache is not None:
+            word = self.disk_cache.get(orig)
+        if word is None:
+            if self.version == (0, 1):
+                word = tuple(orig) + ('</w>',)
+            elif self.version == (0, 2): # more consistent handling of word-final segments
+                word = tuple(orig[:-1]) + ( orig[-1] + '</w>',)
             else:
-                pairs = self.get_pairs(word)
+                raise NotImplementedError
+
+            if len(word) < 2:
+                return orig
+
+            word = self.merge(word)
+
+            if self.remove_eow:
+                # don't print end-of-word symbols
+                if word[-1] == '</w>':
+                    word = word[:-1]
+                elif word[-1].endswith('</w>'):
+                    word = word[:-1] + (word[-1].replace('</w>',''),)
+            if self.disk_cache is not None:
+                self.disk_cache.put(orig, word)
+
+        with self.cache_lock:
+            self.cache[orig] = word
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return word
 
-        if self.remove_eow:
-            # don't print end-of-word symbols
-            if word[-1] == '</w>':
-                word = word[:-1]
-            elif word[-1].endswith('</w>'):
-                word = word[:-1] + (word[-1].replace('</w>',''),)
+    def merge(self, word):
+        """Applies the BPE merge operations to a tuple of symbols.
 
-        self.cache[orig] = word
-        return word
+        Args:
+            word (tuple): Symbols (variable-length strings)
+
+        Returns:
+            tuple. Symbols after applying all merges
+        """
+        symbols = list(word)
+        nxt = list(range(1, len(symbols))) + [-1]
+        prv = list(range(-1, len(symbols) - 1))
+        heap = []
+        for i in range(len(symbols) - 1):
+            rank = self.bpe_codes.get((symbols[i], symbols[i+1]))
+            if rank is not None:
+                heap.append((rank, i))
+        heapq.heapify(heap)
+        while heap:
+            rank, i = heapq.heappop(heap)
+            positions = {i}
+            while heap and heap[0][0] == rank:
+                positions.add(heapq.heappop(heap)[1])
+            merged = []
+            for i in sorted(positions):
+                j = nxt[i]
+                if j < 0 or self.bpe_codes.get((symbols[i], symbols[j])) != rank:
+                    continue # Stale entry
+                symbols[i] += symbols[j]
+                symbols[j] = None
+                nxt[i] = nxt[j]
+                if nxt[i] >= 0:
+                    prv[nxt[i]] = i
+                merged.append(i)
+            for i in merged:
+                for left, right in ((prv[i], i), (i, nxt[i])):
+                    if left >= 0 and right >= 0:
+                        rank = self.bpe_codes.get((symbols[left], symbols[right]))
+                        if rank is not None:
+                            heapq.heappush(heap, (rank, left))
+        return tuple(s for s in symbols if s is not None)
+
+
+class BPEDiskCache(object):
+    """Persistent word -> segmentation cache in an SQLite database. The
+    database can be shared by several worker processes and runs, and
+    the cache by several threads.
+    Segmentations are stored in a table specific to the codes file and
+    the ``remove_eow`` setting.
+    """
+
+    COMMIT_EVERY = 1000
+    """Number of new segmentations collected before writing them."""
+
+    def __init__(self, path, codes_path, remove_eow):
+        """Opens or creates the database at ``path``.
+
+        Args:
+            path (string): Path to the SQLite database
+            codes_path (string): Path to the BPE codes file
+            remove_eow (bool): ``remove_eow`` setting of the BPE
+        """
+        import atexit
+        import hashlib
+        import sqlite3
+        with open(codes_path, 'rb') as f:
+            codes_hash = hashlib.sha1(f.read()).hexdigest()[:16]
+        self.table = "bpe_%s_%d" % (codes_hash, int(remove_eow))
+        self.db = sqlite3.connect(path, timeout=60.0, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS %s (word TEXT PRIMARY "
+                        "KEY, segmentation TEXT)" % self.table)
+        self.db.commit()
+        self.pending = []
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def get(self, word):
+        """Returns the cached segmentation of ``word`` as tuple, or
+        None if it is not in the database."""
+        with self.lock:
+            row = self.db.execute("SELECT segmentation FROM %s WHERE word=?"
+                                  % self.table, (word,)).fetchone()
+        return None if row is None else tuple(row[0].split(' '))
+
+    def put(self, word, segmentation):
+        """Adds the segmentation of ``word``. New entries are written
+        in chunks of ``COMMIT_EVERY``."""
+        with self.lock:
+            self.pending.append((word, ' '.join(segmentation)))
+            if len(self.pending) >= self.COMMIT_EVERY:
+                self._write_pending()
+
+    def flush(self):
+        """Writes all pending segmentations to the database."""
+        with self.lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        if self.pending:
+            self.db.executemany("INSERT OR IGNORE INTO %s VALUES (?, ?)"
+                                % self.table, self.pending)
+            self.db.commit()
+            self.pending = []
 
 
 class BPEEncoder(Encoder):
     """Encoder for BPE mapping."""
 
-    def __init__(self, codes_path, separator='', remove_eow=False):
-        self.bpe = BPE(codes_path, separator, remove_eow)
+    def __init__(self, codes_path, separator='', remove_eow=False,
+                 cache_size=BPE_CACHE_SIZE, cache_path=None):
+        self.bpe = BPE(codes_path, separator, remove_eow, cache_size,
+                       cache_path)
 
     def encode(self, src_sentence):
         bpe_str = self.bpe.segment(src_sentence)
@@ -390,27 +620,24 @@ class BPEEncoder(Encoder):
         return bpe_int
 
 
-class BPEDecoder(Decoder):
+class BPEDecoder(WordMapDecoder):
     """"Decoder for BPE mapping SGNMT style."""
 
-    def decode(self, trg_sentence):
-        return "".join(
-           trg_wmap.get(w, "<UNK>") for w in trg_sentence).replace("</w>", " ")
+    def join(self, words):
+        return "".join(words).replace("</w>", " ")
 
 
-class BPEAtAtDecoder(Decoder):
+class BPEAtAtDecoder(WordMapDecoder):
     """"Decoder for BPE mapping with @@ separator."""
 
-    def decode(self, trg_sentence):
-        return " ".join(
-           trg_wmap.get(w, "<UNK>") for w in trg_sentence).replace("@@ ", "")
+    def join(self, words):
+        return " ".join(words).replace("@@ ", "")
 
-class BPEUndDecoder(Decoder):
+class BPEUndDecoder(WordMapDecoder):
     """"Decoder for BPE mapping with @@ separator."""
 
-    def decode(self, trg_sentence):
-        return " ".join(
-           trg_wmap.get(w, "<UNK>") for w in trg_sentence).replace(" ", "").replace("▁", " ")
+    def join(self, words):
+        return " ".join(words).replace(" ", "").replace("▁", " ")
 
 
 # Word maps
@@ -425,12 +652,52 @@ trg_wmap = {}
 
 trg_wmap_rev = {}
 
+_trg_wmap_array = (None, 0, None)
+"""``trg_wmap`` dict, its size, and its array version."""
+
+
+def get_trg_wmap_array():
+    """Returns ``trg_wmap`` as NumPy object array, i.e. entry ``i``
+    is the target word with ID ``i``. The last entry is '<UNK>' and
+    used for all IDs which are not in ``trg_wmap``. The array is built
+    on the first call after loading a new ``trg_wmap``.
+
+    Returns:
+        np.ndarray. Target words indexed by ID
+    """
+    global _trg_wmap_array
+    wmap, size, words = _trg_wmap_array
+    if wmap is not trg_wmap or size != len(trg_wmap):
+        if isinstance(trg_wmap, binary_wmap.IdToWord):
+            words = trg_wmap.to_array()
+        else:
+            ids = [i for i in trg_wmap if i >= 0]
+            words = np.full(max(ids, default=-1) + 2, "<UNK>", dtype=object)
+            words[ids] = [trg_wmap[i] for i in ids]
+        _trg_wmap_array = (trg_wmap, len(trg_wmap), words)
+    return words
+
 def src_sentence(src):
     if 'bart' in globals():
         return bart.decode(src)
     return src
+def _load_compiled_wmap(path):
+    """Returns the compiled version of the text word map at ``path``
+    (see the ``binary_wmap`` module), or None if it cannot be used.
+    """
+    try:
+        return binary_wmap.load(path)
+    except (IOError, OSError, ValueError) as e:
+        logging.warning("Could not use compiled word map for %s (%s). "
+                        "Loading text word map." % (path, e))
+    return None
+
+
 def load_src_wmap(path):
-    """Loads a source side word map from the file system.
+    """Loads a source side word map from the file system. The text
+    word map is compiled to a memory-mapped binary file next to it on
+    first use, which is much faster to load and shared between
+    processes.
     
     Args:
         path (string): Path to the word map (Format: word id)
@@ -442,6 +709,10 @@ def load_src_wmap(path):
     if not path:
         src_wmap = {}
         return src_wmap
+    compiled = _load_compiled_wmap(path)
+    if compiled is not None:
+        src_wmap = compiled.word_to_id
+        return src_wmap
     with open(path) as f:
         src_wmap = dict(map(lambda e: (e[0], int(e[-1])),
                         [line.strip().split() for line in f]))
@@ -467,7 +738,8 @@ def load_bart_decoder(path):
     bart = encoders.build_bpe(args)
 
 def load_trg_wmap(path):
-    """Loads a target side word map from the file system.
+    """Loads a target side word map from the file system. Like
+    ``load_src_wmap()``, this uses a compiled version of the word map.
     
     Args:
         path (string): Path to the word map (Format: word id)
@@ -476,13 +748,18 @@ def load_trg_wmap(path):
         dict. Source word map (key: id, value: word)
     """
     global trg_wmap
+    global trg_wmap_rev
     if not path:
         trg_wmap = {}
         return trg_wmap
+    compiled = _load_compiled_wmap(path)
+    if compiled is not None:
+        trg_wmap = compiled.id_to_word
+        trg_wmap_rev = compiled.word_to_id
+        return trg_wmap
     with open(path) as f:
         trg_wmap = dict(map(lambda e: (int(e[-1]), e[0]),
                         [line.strip().split() for line in f]))
-    global trg_wmap_rev
     trg_wmap_rev = {v:k for k,v in trg_wmap.items()}
     return trg_wmap
 
@@ -31,11 +31,12 @@ import errno
 import logging
 import utils
 import io_utils
+import binary_nbest
 import numpy as np
 import codecs
-from collections import defaultdict
 import inspect
 import importlib
+import time
 
 def _mkdir(path, name):
     try:
@@ -49,17 +50,87 @@ def _mkdir(path, name):
 
 
 class OutputHandler(object):
-    """Interface for output handlers. """
+    """Interface for output handlers. Output handlers are fed one
+    sentence at a time with ``write_sentence()`` while decoding is in
+    progress, and ``close()`` is called once after the last sentence.
+    Implementations should not keep hypotheses of previous sentences
+    around so that memory usage does not grow with the corpus size.
+
+    Writes to open files are buffered. Implementations call
+    ``sentence_written()`` after each sentence, which flushes the
+    files returned by ``open_files()`` according to --output_flush_every
+    and --output_flush_interval. Files are always flushed on ``close()``.
+
+    Handlers with ``line_aligned`` write one line per sentence. If
+    decoding a sentence fails, they get a dummy hypothesis so that
+    their lines stay aligned with the source sentences.
+    """
+    line_aligned = False
     
-    def __init__(self):
-        """ Empty constructor """
-        pass
+    def __init__(self, args=None):
+        """Reads the flush policy from ``args``. 
+
+        Args:
+            args (object): SGNMT configuration. If None, files are
+                           flushed after every sentence.
+        """
+        self.flush_every = getattr(args, "output_flush_every", 1)
+        self.flush_interval = getattr(args, "output_flush_interval", 0.0)
+        self.unflushed = 0
+        self.last_flush_time = time.time()
     
     @abstractmethod
+    def write_sentence(self, sen_idx, hypos):
+        """This method writes the n-best list of a single sentence to
+        the file system. The configuration parameters such as output
+        paths should already have been provided via constructor
+        arguments.
+        
+        Args:
+            sen_idx (int): Sentence index (0-indexed)
+            hypos (list): nbest list of hypotheses for this sentence
+        
+        Raises:
+            IOError. If something goes wrong while writing to the disk
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Finishes writing. Called once after the last sentence has 
+        been passed to ``write_sentence()``. Subsequent calls of
+        ``write_sentence()`` start a new output.
+        
+        Raises:
+            IOError. If something goes wrong while writing to the disk
+        """
+        pass
+
+    def open_files(self):
+        """Returns the list of currently open file objects which need
+        to be flushed. """
+        return []
+
+    def flush(self):
+        """Flushes all open files to the file system. """
+        for f in self.open_files():
+            f.flush()
+        self.unflushed = 0
+        self.last_flush_time = time.time()
+
+    def sentence_written(self):
+        """Should be called by implementations after each sentence.
+        Flushes open files if --output_flush_every sentences have been
+        written or --output_flush_interval seconds have passed since
+        the last flush. """
+        self.unflushed += 1
+        if (self.flush_every > 0 and self.unflushed >= self.flush_every) \
+                or (self.flush_interval > 0 and 
+                    time.time() - self.last_flush_time >= self.flush_interval):
+            self.flush()
+
     def write_hypos(self, all_hypos, sen_indices=None):
-        """This method writes output files to the file system. The
-        configuration parameters such as output paths should already
-        have been provided via constructor arguments.
+        """Writes all n-best lists in ``all_hypos`` at once by calling
+        ``write_sentence()`` for each of them followed by ``close()``.
         
         Args:
             all_hypos (list): list of nbest lists of hypotheses
@@ -68,102 +139,278 @@ class OutputHandler(object):
         Raises:
             IOError. If something goes wrong while writing to the disk
         """
-        raise NotImplementedError
+        if sen_indices is None:
+            sen_indices = range(len(all_hypos))
+        for sen_idx, hypos in zip(sen_indices, all_hypos):
+            self.write_sentence(sen_idx, hypos)
+        self.close()
 
 
 class TextOutputHandler(OutputHandler):
     """Writes the first best hypotheses to a plain text file """
     name = 'text'
+    line_aligned = True
     def __init__(self, path, args):
         """Creates a plain text output handler to write to ``path`` """
-        super(TextOutputHandler, self).__init__()
+        super(TextOutputHandler, self).__init__(args)
         self.path = path
+        self.f = None
         
-    def write_hypos(self, all_hypos, sen_indices=None):
-        """Writes the hypotheses in ``all_hypos`` to ``path`` """
-        if self.f is not None:
-            for hypos in all_hypos:
-                self.f.write(io_utils.decode(hypos[0].trgt_sentence))
-                self.f.write("\n")
-                self.f.flush()
-        else:
-            with codecs.open(self.path, "w", encoding='utf-8') as f:
-                for hypos in all_hypos:
-                    f.write(io_utils.decode(hypos[0].trgt_sentence))
-                    f.write("\n")
-                    self.f.flush()
+    def write_sentence(self, sen_idx, hypos):
+        """Writes the best hypothesis in ``hypos`` to ``path`` """
+        if self.f is None:
+            self.open_file()
+        self.f.write(io_utils.decode(hypos[0].trgt_sentence))
+        self.f.write("\n")
+        self.sentence_written()
 
     def open_file(self):
         self.f = codecs.open(self.path, "w", encoding='utf-8')
 
-    def close_file(self):
-        self.f.close()
+    def open_files(self):
+        return [] if self.f is None else [self.f]
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
 
 class ScoreOutputHandler(OutputHandler):
-    """Writes the first best hypotheses to a plain text file """
+    """Writes the score breakdown of the first best hypotheses to a 
+    plain text file """
     name = 'score'
     def __init__(self, path, args):
         """Creates a plain text output handler to write to ``path`` """
-        super(ScoreOutputHandler, self).__init__()
+        super(ScoreOutputHandler, self).__init__(args)
         self.path = path
-        self.open_file()
+        self.f = None
         
     def write_score(self, score):
-        """Writes the hypotheses in ``all_hypos`` to ``path`` """
-        def write(f_, score):
-            f_.write(str([s[0][0] for s in score]))
-            f_.write("\n")
-            f_.flush()
+        """Writes the score breakdown ``score`` to ``path`` """
+        if self.f is None:
+            self.open_file()
+        self.f.write(str([s[0][0] for s in score]))
+        self.f.write("\n")
+        self.sentence_written()
 
-        if self.f is not None:
-            write(self.f, score)
-        else:
-            with codecs.open(self.path, "w", encoding='utf-8') as f:
-                write(f, score)
-
-    def write_hypos(self, all_hypos, sen_indices=None):
-        pass
+    def write_sentence(self, sen_idx, hypos):
+        """Writes the score breakdown of the best hypothesis """
+        self.write_score(hypos[0].score_breakdown)
 
     def open_file(self):
         self.f = codecs.open(self.path, "w", encoding='utf-8')
 
-    def close_file(self):
-        self.f.close()
+    def open_files(self):
+        return [] if self.f is None else [self.f]
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
 
 
 class NBestSeparateOutputHandler(OutputHandler):
     """Produces n-best files with hypotheses at respecitve positions
     """
     name = 'nbest_sep'
+    line_aligned = True
     def __init__(self, path, args):
         """
         Args:
             path (string):  Path to the n-best file to write
             N: n-best 
         """
-        super(NBestSeparateOutputHandler, self).__init__()
+        super(NBestSeparateOutputHandler, self).__init__(args)
         self.paths = [path + '_' + str(i) + '.txt' for i in range(max(args.nbest,1))]
+        self.f = None
         
-    def write_hypos(self, all_hypos, sen_indices=None):
-        """Writes the hypotheses in ``all_hypos`` to ``path`` """
-        if not self.f:
+    def write_sentence(self, sen_idx, hypos):
+        """Writes the i-th hypothesis in ``hypos`` to the i-th file. 
+        Short n-best lists are padded with their last hypothesis. """
+        if self.f is None:
             self.open_file()
-        for hypos in all_hypos:
-            while len(hypos) < len(self.f):
-                hypos.append(hypos[-1])
-            for i in range(len(self.f)):
-                self.f[i].write(io_utils.decode(hypos[i].trgt_sentence))
-                self.f[i].write("\n")
-                self.f[i].flush()
+        translations = io_utils.decode_batch(
+            [hypo.trgt_sentence for hypo in hypos[:len(self.f)]])
+        for i in range(len(self.f)):
+            self.f[i].write(translations[min(i, len(translations) - 1)])
+            self.f[i].write("\n")
+        self.sentence_written()
 
     def open_file(self):
         self.f = []
         for p in self.paths:
             self.f.append(codecs.open(p, "w", encoding='utf-8'))
 
-    def close_file(self):
-        for f in self.f:
-            f.close()
+    def open_files(self):
+        return [] if self.f is None else self.f
+
+    def close(self):
+        if self.f is not None:
+            for f in self.f:
+                f.close()
+            self.f = None
+
+
+class BinaryNBestOutputHandler(OutputHandler):
+    """Writes full n-best lists in the columnar binary format described
+    in the ``binary_nbest`` module. The output directory can be read
+    with ``binary_nbest.BinaryNBestReader`` without parsing text.
+    """
+    name = 'nbest_bin'
+    def __init__(self, path, args):
+        """
+        Args:
+            path (string):  Path to the n-best directory to create
+        """
+        super(BinaryNBestOutputHandler, self).__init__(args)
+        self.path = path
+        self.f = None
+
+    def write_sentence(self, sen_idx, hypos):
+        """Appends the n-best list ``hypos`` to the column files """
+        if self.f is None:
+            self.open_file()
+        cols = binary_nbest.COLUMNS
+        tokens = [np.asarray(hypo.trgt_sentence, dtype=cols[binary_nbest.TOKENS])
+                  for hypo in hypos]
+        breakdowns = [binary_nbest.flatten_breakdown(hypo.score_breakdown)
+                      for hypo in hypos]
+        self.n_hypos += len(hypos)
+        self._write(binary_nbest.SEN_INDICES, [sen_idx])
+        self._write(binary_nbest.SEN_OFFSETS, [self.n_hypos])
+        self._write(binary_nbest.HYPO_OFFSETS,
+                    self.n_tokens + np.cumsum([len(t) for t in tokens]))
+        self._write(binary_nbest.TOTAL_SCORES,
+                    [hypo.total_score for hypo in hypos])
+        self._write(binary_nbest.BASE_SCORES,
+                    [hypo.base_score or 0. for hypo in hypos])
+        self._write(binary_nbest.BREAKDOWN_OFFSETS,
+                    self.n_breakdown + np.cumsum([len(b) for b in breakdowns]))
+        if tokens:
+            self._write(binary_nbest.TOKENS, np.concatenate(tokens))
+            self._write(binary_nbest.BREAKDOWN, np.concatenate(breakdowns))
+        self.n_tokens += sum(len(t) for t in tokens)
+        self.n_breakdown += sum(len(b) for b in breakdowns)
+        self.sentence_written()
+
+    def _write(self, file_name, values):
+        values = np.asarray(values, dtype=binary_nbest.COLUMNS[file_name])
+        self.f[file_name].write(values.tobytes())
+
+    def open_file(self):
+        _mkdir(self.path, "nbest_bin")
+        self.f = {file_name: open(os.path.join(self.path, file_name), "wb")
+                  for file_name in binary_nbest.COLUMNS}
+        self.n_hypos = self.n_tokens = self.n_breakdown = 0
+        for file_name in [binary_nbest.SEN_OFFSETS, binary_nbest.HYPO_OFFSETS,
+                          binary_nbest.BREAKDOWN_OFFSETS]:
+            self._write(file_name, [0])
+
+    def open_files(self):
+        return [] if self.f is None else list(self.f.values())
+
+    def close(self):
+        if self.f is not None:
+            for f in self.f.values():
+                f.close()
+            self.f = None
+
+
+def ngram_posteriors(token_seqs, scores, min_order, max_order):
+    """Computes MBR-style ngram posteriors for a single n-best list. 
+    Each sequence is padded with ``utils.GO_ID`` and ``utils.EOS_ID``.
+    For each position, we extract the ngrams of order ``min_order`` to
+    ``max_order`` ending there (shorter ones at the sentence start).
+    The posterior of an ngram is the renormalized probability mass of
+    all sequences containing it.
+
+    N-grams are identified by exact integer keys: the tokens (plus one,
+    so that n-grams of different orders differ) packed into int64 codes
+    with ``utils.ngram_codes()`` if they fit, and the ranks of the
+    padded n-grams among all distinct n-grams otherwise. Posteriors are
+    accumulated with ``np.logaddexp.reduceat`` over the sorted keys, so
+    there is no Python loop over ngrams.
+    
+    Args:
+        token_seqs (list): List of token ID sequences (n-best list)
+        scores (list): Log-likelihoods of the sequences
+        min_order (int):  Minimum order of extracted ngrams
+        max_order (int):  Maximum order of extracted ngrams
+    
+    Returns:
+        (starts, ends, tokens, posteriors) tuple. The i-th ngram is
+        ``tokens[starts[i]:ends[i]]`` with log posterior 
+        ``posteriors[i]``. N-grams are in order of their first 
+        occurrence in ``token_seqs``.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    normed_scores = scores - utils.log_sum(scores)
+    seqs = [np.concatenate(([utils.GO_ID], seq, [utils.EOS_ID])).astype(np.int64)
+            for seq in token_seqs]
+    lengths = np.array([len(seq) for seq in seqs])
+    tokens = np.concatenate(seqs)
+    hypo_ids = np.repeat(np.arange(len(seqs)), lengths)
+    # 0-indexed position of each token within its sequence
+    seq_pos = np.arange(len(tokens)) - np.repeat(np.cumsum(lengths) - lengths,
+                                                  lengths)
+    bits = max(1, int(tokens.max() + 1).bit_length())
+    packed = bits * max_order <= 63
+    keys, ends, orders = [], [], []
+    for order in range(1, max_order + 1):
+        valid = seq_pos >= order - 1
+        if order < min_order: # Only truncated ngrams at sentence start
+            valid = seq_pos == order - 1
+        idx = np.nonzero(valid)[0]
+        starts = idx + 1 - order
+        if packed:
+            codes = utils.ngram_codes(tokens[None, :] + 1, order, bits)[0]
+            keys.append(codes[starts])
+        else:
+            # Rows of tokens padded with -1, ranked after concatenation
+            window = np.full((len(idx), max_order), -1, dtype=np.int64)
+            window[:, :order] = tokens[starts[:, None] + np.arange(order)]
+            keys.append(window)
+        ends.append(idx + 1)
+        orders.append(np.full(len(idx), order))
+    if packed:
+        keys = np.concatenate(keys)
+    else:
+        keys = np.unique(np.concatenate(keys), axis=0,
+                         return_inverse=True)[1].reshape(-1)
+    ends = np.concatenate(ends)
+    orders = np.concatenate(orders)
+    # Rank in which the ngrams are visited: by hypo, position, order
+    ranks = ends * (max_order + 1) + orders
+    perm = np.lexsort((ranks, keys))
+    keys, ends, orders, ranks = keys[perm], ends[perm], orders[perm], ranks[perm]
+    hypos = hypo_ids[ends - 1]
+    new_key = np.ones(len(keys), dtype=bool)
+    new_key[1:] = keys[1:] != keys[:-1]
+    # Count each hypothesis only once per ngram
+    keep = new_key.copy()
+    keep[1:] |= hypos[1:] != hypos[:-1]
+    group_starts = np.nonzero(new_key[keep])[0]
+    posteriors = np.logaddexp.reduceat(normed_scores[hypos[keep]], group_starts)
+    first = np.nonzero(new_key)[0]
+    order_by_rank = np.argsort(ranks[first], kind='stable')
+    first = first[order_by_rank]
+    return (ends[first] - orders[first], ends[first], tokens,
+            posteriors[order_by_rank])
+
+
+def write_ngram_file(path, token_seqs, scores, min_order, max_order):
+    """Writes the ngram posteriors of a single n-best list to ``path``
+    in the format ``<ngram> : <posterior>``. See ``ngram_posteriors()``.
+    """
+    starts, ends, tokens, posteriors = ngram_posteriors(
+        token_seqs, scores, min_order, max_order)
+    probs = np.minimum(1.0, np.exp(posteriors))
+    tokens = tokens.tolist()
+    with open(path, "w") as f:
+        f.writelines("%s : %f\n" % (' '.join(map(str, tokens[s:e])), p)
+                     for s, e, p in zip(starts.tolist(), ends.tolist(), probs))
+
 
 class NgramOutputHandler(OutputHandler):
     """This output handler extracts MBR-style ngram posteriors from the 
@@ -171,6 +418,9 @@ class NgramOutputHandler(OutputHandler):
     be loglikelihoods, which we renormalize to make sure that we operate on a
     valid distribution. The scores produced by the output handler are 
     probabilities of an ngram being in the translation.
+
+    If --ngram_workers is positive, ngram files are computed and written
+    by a pool of worker processes while decoding continues.
     """
     name = 'ngram'
     def __init__(self, path, args):
@@ -180,43 +430,58 @@ class NgramOutputHandler(OutputHandler):
             path (string):  Path to the ngram directory to create
             min_order (int):  Minimum order of extracted ngrams
             max_order (int):  Maximum order of extracted ngrams
+            ngram_workers (int): Number of worker processes
         """
-        super(NgramOutputHandler, self).__init__()
+        super(NgramOutputHandler, self).__init__(args)
         self.path = path
         self.min_order = args.min_order
         self.max_order = args.max_order
+        self.num_workers = getattr(args, "ngram_workers", 0)
         self.file_pattern = path + "/%d.txt" 
+        self.dir_created = False
+        self.pool = None
+        self.pending = []
       
-    def write_hypos(self, all_hypos, sen_indices):
-        """Writes ngram files for each sentence in ``all_hypos``.
+    def write_sentence(self, sen_idx, hypos):
+        """Writes the ngram file for a single sentence.
         
         Args:
-            all_hypos (list): list of nbest lists of hypotheses
-            sen_indices (list): List of sentence indices (0-indexed)
+            sen_idx (int): Sentence index (0-indexed)
+            hypos (list): nbest list of hypotheses for this sentence
         
         Raises:
             OSError. If the directory could not be created
             IOError. If something goes wrong while writing to the disk
         """
-        _mkdir(self.path, "ngram")
-        for sen_idx, hypos in zip(sen_indices, all_hypos):
-            sen_idx += 1
-            total = utils.log_sum([hypo.total_score for hypo in hypos])
-            normed_scores = [hypo.total_score - total for hypo in hypos]
-            ngrams = defaultdict(dict)
-            # Collect ngrams
-            for hypo_idx, hypo in enumerate(hypos):
-                sen_eos = [utils.GO_ID] + hypo.trgt_sentence + [utils.EOS_ID]
-                for pos in range(1, len(sen_eos) + 1):
-                    hist = sen_eos[:pos]
-                    for order in range(self.min_order, self.max_order + 1):
-                        ngram = ' '.join(map(str, hist[-order:]))
-                        ngrams[ngram][hypo_idx] = True
-            with open(self.file_pattern % sen_idx, "w") as f:
-                for ngram, hypo_indices in ngrams.items():
-                    ngram_score = np.exp(utils.log_sum(
-                       [normed_scores[hypo_idx] for hypo_idx in hypo_indices]))
-                    f.write("%s : %f\n" % (ngram, min(1.0, ngram_score)))
+        if not self.dir_created:
+            _mkdir(self.path, "ngram")
+            self.dir_created = True
+        job = (self.file_pattern % (sen_idx + 1),
+               [hypo.trgt_sentence for hypo in hypos],
+               [hypo.total_score for hypo in hypos],
+               self.min_order,
+               self.max_order)
+        if self.num_workers <= 0:
+            write_ngram_file(*job)
+            return
+        if self.pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(self.num_workers)
+        # Bound the number of queued n-best lists to keep memory constant
+        while len(self.pending) >= 2 * self.num_workers:
+            self.pending.pop(0).result()
+        self.pending.append(self.pool.submit(write_ngram_file, *job))
+
+    def close(self):
+        if self.pool is not None:
+            try:
+                for future in self.pending:
+                    future.result()
+            finally:
+                self.pool.shutdown()
+                self.pool = None
+                self.pending = []
+        self.dir_created = False
 
 OUTPUT_REGISTRY = {}
 
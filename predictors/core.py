@@ -19,6 +19,7 @@ for bounded and unbounded vocabulary predictors.
 """
 
 from abc import abstractmethod
+import copy
 
 import utils
 
@@ -124,6 +125,61 @@ class Predictor(object):
         raise NotImplementedError
     
     
+    def snapshot(self):
+        """Returns a copy of the current predictor state which can be
+        loaded any number of times with ``restore()``. Decoders which
+        start over from the initial state many times per sentence (like
+        the SWOR decoders) take a snapshot after ``initialize()`` and
+        restore it instead of calling ``initialize()`` again, which
+        would for example run the NMT encoder again. Data which is
+        constant for a sentence (like encoder outputs) is not part of
+        the snapshot; it remains valid until the next ``initialize()``.
+        The default implementation copies ``get_state()``. Predictors
+        with sentence dependent data which is not covered by
+        ``get_state()`` should override this.
+
+        Returns:
+            object. Snapshot for ``restore()``
+        """
+        return copy.deepcopy(self.get_state())
+
+    def restore(self, snapshot):
+        """Returns to a state saved with ``snapshot()``. The snapshot
+        itself is not modified and can be restored again.
+
+        Args:
+            snapshot (object): Return value of ``snapshot()``
+        """
+        self.set_state(copy.deepcopy(snapshot))
+
+    def fork(self):
+        """Creates a new predictor instance which shares everything 
+        which is independent of the current sentence (e.g. model
+        parameters) with this predictor, but has its own state. Forks
+        can be initialized with different source sentences and used
+        concurrently as long as calls to the model are serialized, for
+        example with ``predict_next_batch()``.
+        
+        Returns:
+            Predictor. Predictor with the same model
+        """
+        return copy.copy(self)
+
+    def predict_next_batch(self, predictors):
+        """Calls ``predict_next()`` on each predictor in ``predictors``.
+        All predictors must be forks of this predictor (see ``fork()``)
+        but may be in different states and initialized with different
+        source sentences. Predictors which can evaluate their model on
+        many states at once should override this method.
+        
+        Args:
+            predictors (list): Forks of this predictor
+        
+        Returns:
+            list. Return values of ``predict_next()`` of each predictor
+        """
+        return [predictor.predict_next() for predictor in predictors]
+    
     def get_unk_probability(self, posterior):
         """This function defines the probability of all words which are
         not in ``posterior``. This is usually used to combine open and
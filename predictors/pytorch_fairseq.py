@@ -18,7 +18,9 @@
 
 https://github.com/pytorch/fairseq
 
-The fairseq predictor can read any model trained with fairseq.
+The fairseq predictor can read any model trained with fairseq. torch and
+fairseq are imported when the first predictor is created, so that
+parsing the predictor arguments does not load them.
 """
 
 import logging
@@ -27,10 +29,6 @@ import os
 import utils
 from predictors.core import Predictor
 
-from fairseq import checkpoint_utils, options, tasks
-from fairseq import utils as fairseq_utils
-from fairseq.sequence_generator import EnsembleModel
-import torch
 import numpy as np
 import copy
 
@@ -39,17 +37,23 @@ import copy
 FAIRSEQ_INITIALIZED = False
 """Set to true by _initialize_fairseq() after first constructor call."""
 
+TIME_MAJOR_FIELDS = ('encoder_out', 'encoder_states')
+"""Fields of fairseq encoder outputs with layout T x B x C. All other
+tensors in encoder outputs and incremental states are batch major."""
+
 
 def _initialize_fairseq(user_dir):
     global FAIRSEQ_INITIALIZED
     if not FAIRSEQ_INITIALIZED:
         logging.info("Setting up fairseq library...")
+        from fairseq import utils as fairseq_utils
         if user_dir:
             args = type("", (), {"user_dir": user_dir})()
             fairseq_utils.import_user_module(args)
         FAIRSEQ_INITIALIZED = True
 
 def get_fairseq_args(model_path, lang_pair):
+    from fairseq import options
     parser = options.get_generation_parser()
     input_args = ["--path", model_path, os.path.dirname(model_path)]
     if lang_pair:
@@ -58,6 +62,53 @@ def get_fairseq_args(model_path, lang_pair):
     return options.parse_args_and_arch(parser, input_args)
 
 
+def _batch_dim(name, dim):
+    return 1 if name in TIME_MAJOR_FIELDS else dim
+
+
+def _concat_batch(items, dim=0):
+    """Concatenates nested encoder outputs or incremental states (dicts,
+    lists, (named) tuples and tensors) of batch size 1 along the batch
+    dimension. All items must have the same structure."""
+    import torch
+    first = items[0]
+    if first is None:
+        return None
+    if torch.is_tensor(first):
+        return torch.cat(items, dim)
+    if isinstance(first, dict):
+        return {k: _concat_batch([item[k] for item in items], _batch_dim(k, dim))
+                for k in first}
+    if hasattr(first, '_fields'): # EncoderOut of older fairseq versions
+        return type(first)(*[
+            _concat_batch([getattr(item, k) for item in items], _batch_dim(k, dim))
+            for k in first._fields])
+    if isinstance(first, (list, tuple)):
+        return type(first)(_concat_batch(list(parts), dim)
+                           for parts in zip(*items))
+    return first
+
+
+def _select_batch(batch, i, dim=0):
+    """Inverse of ``_concat_batch()``: Returns entry ``i`` of ``batch``
+    with batch size 1. Tensors are copied, as views would keep (and
+    ``copy.deepcopy()`` would copy) the storage of the whole batch."""
+    import torch
+    if batch is None:
+        return None
+    if torch.is_tensor(batch):
+        return batch.narrow(dim, i, 1).clone()
+    if isinstance(batch, dict):
+        return {k: _select_batch(v, i, _batch_dim(k, dim))
+                for k, v in batch.items()}
+    if hasattr(batch, '_fields'):
+        return type(batch)(*[_select_batch(getattr(batch, k), i, _batch_dim(k, dim))
+                             for k in batch._fields])
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_select_batch(v, i, dim) for v in batch)
+    return batch
+
+
 class FairseqPredictor(Predictor):
     """Predictor for using fairseq models."""
     name = 'fairseq'
@@ -73,6 +124,9 @@ class FairseqPredictor(Predictor):
                                  use GPU.
         """
         super(FairseqPredictor, self).__init__()
+        import torch
+        from fairseq import tasks
+        from fairseq.sequence_generator import EnsembleModel
         _initialize_fairseq(args.fairseq_user_dir)
         self.use_cuda = torch.cuda.is_available() and args.n_cpu_threads < 0
 
@@ -94,6 +148,7 @@ class FairseqPredictor(Predictor):
 
     def load_models(self, model_path, task):
         logging.info('Loading fairseq model(s) from {}'.format(model_path))
+        from fairseq import checkpoint_utils
         models, _ = checkpoint_utils.load_model_ensemble(
             model_path.split(':'),
             task=task,
@@ -113,32 +168,75 @@ class FairseqPredictor(Predictor):
         """Fetch posterior[utils.UNK_ID]"""
         return utils.common_get(posterior, utils.UNK_ID, utils.NEG_INF)
         
-    @torch.no_grad()  
     def predict_next(self):
         """Call the fairseq model."""
+        import torch
         inputs = torch.LongTensor([self.consumed])
         
         if self.use_cuda:
             inputs = inputs.cuda()
-        lprobs, _  = self.model.forward_decoder(
-            inputs, self.encoder_outs, self.incremental_states)
+        with torch.no_grad():
+            lprobs, _  = self.model.forward_decoder(
+                inputs, self.encoder_outs, self.incremental_states)
         lprobs[:, self.pad_id] = utils.NEG_INF
         return np.array(lprobs[0].cpu() if self.use_cuda else lprobs[0], dtype=np.float64)
+
+    def predict_next_batch(self, predictors):
+        """Calls the fairseq model once for each group of forks which
+        have consumed the same number of words and were initialized
+        with source sentences of the same length. Encoder outputs and
+        incremental states within a group are concatenated along the
+        batch dimension, so no padding is needed. The incremental
+        states of each fork are updated as in ``predict_next()``.
+        """
+        import torch
+        groups = {}
+        for idx, predictor in enumerate(predictors):
+            key = (len(predictor.consumed), predictor.src_length)
+            groups.setdefault(key, []).append(idx)
+        posteriors = [None] * len(predictors)
+        for indices in groups.values():
+            group = [predictors[idx] for idx in indices]
+            if len(group) == 1:
+                posteriors[indices[0]] = group[0].predict_next()
+                continue
+            inputs = torch.LongTensor([p.consumed for p in group])
+            if self.use_cuda:
+                inputs = inputs.cuda()
+            encoder_outs = [_concat_batch([p.encoder_outs[m] for p in group])
+                            for m in range(len(self.models))]
+            incremental_states = [
+                _concat_batch([p.incremental_states[m] for p in group])
+                for m in range(len(self.models))]
+            with torch.no_grad():
+                lprobs, _ = self.model.forward_decoder(
+                    inputs, encoder_outs, incremental_states)
+            lprobs[:, self.pad_id] = utils.NEG_INF
+            lprobs = np.array(lprobs.cpu() if self.use_cuda else lprobs,
+                              dtype=np.float64)
+            for i, (idx, p) in enumerate(zip(indices, group)):
+                for m in range(len(self.models)):
+                    p.incremental_states[m].clear()
+                    p.incremental_states[m].update(
+                        _select_batch(incremental_states[m], i))
+                posteriors[idx] = lprobs[i]
+        return posteriors
     
-    @torch.no_grad()   
     def initialize(self, src_sentence):
         """Initialize source tensors, reset consumed."""
-
+        import torch
         src_tokens = torch.LongTensor([
             utils.oov_to_unk(src_sentence + [utils.EOS_ID],
                              self.src_vocab_size)])
-        src_lengths = torch.LongTensor([len(src_sentence) + 1])
+        self.src_length = len(src_sentence) + 1
+        src_lengths = torch.LongTensor([self.src_length])
         if self.use_cuda:
             src_tokens = src_tokens.cuda()
             src_lengths = src_lengths.cuda()
-        self.encoder_outs = self.model.forward_encoder({
-            'src_tokens': src_tokens,
-            'src_lengths': src_lengths})
+        with torch.no_grad():
+            self.encoder_outs = self.model.forward_encoder({
+                'src_tokens': src_tokens,
+                'src_lengths': src_lengths})
 
         self.consumed = [utils.GO_ID or utils.EOS_ID]
         self.reset_states()
@@ -155,17 +253,24 @@ class FairseqPredictor(Predictor):
     def get_empty_str_prob(self):
         return self.get_initial_dist()[utils.EOS_ID].item()
 
-    @torch.no_grad()   
     def get_initial_dist(self):
+        import torch
         inputs = torch.LongTensor([[utils.GO_ID or utils.EOS_ID]])
         if self.use_cuda:
             inputs = inputs.cuda()
         
-        lprobs, _ = self.model.forward_decoder(
-            inputs, self.encoder_outs
-        )
+        with torch.no_grad():
+            lprobs, _ = self.model.forward_decoder(
+                inputs, self.encoder_outs
+            )
         return np.array(lprobs[0].cpu() if self.use_cuda else lprobs[0], dtype=np.float64)
 
+    def fork(self):
+        """Shares the models but not the incremental decoder states."""
+        predictor = copy.copy(self)
+        predictor.incremental_states = [{} for _ in self.models]
+        return predictor
+
     def get_state(self):
         """The predictor state is the complete history."""
         return self.consumed, self.incremental_states
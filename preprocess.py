@@ -0,0 +1,34 @@
+"""This script encodes --src_test once with the SGNMT input pipeline
+(--preprocessing, --bpe_codes, --src_wmap, ...) and writes the token IDs
+to the binary source file --src_test_bin. decode.py memory-maps this
+file if --src_test_bin is set, so workers do not tokenize the test set
+again. Takes the same options as decode.py, e.g.:
+
+    python preprocess.py --src_test data/valid.de \\
+        --src_test_bin data/valid.de.bin --preprocessing word \\
+        --src_wmap data/wmaps/wmap.bpe.de
+
+See the ``binary_source`` module for the file format.
+"""
+
+import logging
+import sys
+
+import binary_source
+import decode_utils
+import io_utils
+from ui import get_args
+
+
+args = get_args()
+decode_utils.base_init(args)
+if not args.src_test or not args.src_test_bin:
+    logging.fatal("Please specify the input with --src_test and the "
+                  "output path with --src_test_bin.")
+    sys.exit(1)
+io_utils.initialize(args)
+with open(args.src_test) as f:
+    sentences = [io_utils.encode(line.strip()) for line in f]
+binary_source.write_corpus(args.src_test_bin, sentences)
+logging.info("Wrote %d encoded sentences (%d tokens) to %s" % (
+    len(sentences), sum(len(s) for s in sentences), args.src_test_bin))
@@ -1,5 +1,4 @@
 import numpy as np
-import scipy.optimize as opt
 import utils
 from bisect import bisect
 import logging
@@ -13,6 +12,20 @@ def gumbel_max_sample(x, seed=None):
     z = np.random.gumbel(loc=0, scale=1, size=x.shape)
     return np.nanargmax(x + z)
 
+def gumbel_inclusion_log_probs(log_probs, kappa):
+    """
+    Log-probabilities that Gumbel perturbed scores G_i ~ Gumbel(log_probs[i])
+    exceed the threshold kappa, i.e. log(1 - exp(-exp(log_probs[i] - kappa))),
+    for a whole n-best list at once. Computed with the stable
+    ``log1mexp`` instead of a truncated series. Below
+    log_probs - kappa = -40 the result equals log_probs - kappa up to
+    rounding, which is used directly since exp() would underflow.
+    """
+    x = np.asarray(log_probs, dtype=np.float64) - kappa
+    with np.errstate(over='ignore'):
+        log_probs = utils.log1mexp_array(-np.exp(x))
+    return np.where(x < -40, x, log_probs)
+
 def exponential_sample(x, seed=None):
     """
     probability distribution over discrete random variable
@@ -103,10 +116,55 @@ def get_const(log_lambdas, desired_k):
     """
     program for finding constant that gives us inclusion probabilities summing to 'desired_k'
     """
-    base_inc_probs = np.log(desired_k) + log_lambdas 
-    remaining_prob = 1 - np.exp(utils.logsumexp(log_lambdas))
-    c = desired_k/expected_k(base_inc_probs)
-    start = c*desired_k
-    results = opt.minimize(lambda x: (desired_k - (expected_k(log_lambdas + x) + desired_k*remaining_prob))**2, np.log(start))
-    return np.exp(results.x[0])
+    return get_consts([log_lambdas], desired_k)[0]
+
+def get_consts(log_lambdas, desired_k):
+    """
+    Batched version of ``get_const()``. For each distribution, finds the
+    constant c for which the Poisson inclusion probabilities
+    min(1, c*lambda_i) sum to desired_k times the mass of the
+    distribution (i.e. desired_k*(1 - remaining_prob)).
+
+    The expected sample size is monotone and piecewise linear in c:
+    if the m largest lambdas are clipped at 1, it is m + c*S_m where
+    S_m is the sum of the other lambdas. The breakpoints (c = 1/lambda_i)
+    bracket the root, and within the bracket it has the closed form
+    c = (target - m)/S_m. All brackets of all distributions are
+    evaluated at once. If desired_k exceeds the number of candidates,
+    returns the smallest c which includes all of them.
 
+    Args:
+        log_lambdas (list): Log-probability arrays (may differ in length)
+        desired_k (float): Expected sample size
+
+    Returns:
+        np.array. One constant per distribution
+    """
+    n = max(len(l) for l in log_lambdas)
+    l = np.full((len(log_lambdas), n), utils.NEG_INF)
+    for row, log_lambda in zip(l, log_lambdas):
+        row[:len(log_lambda)] = log_lambda
+    l = -np.sort(-l, axis=1) # Descending
+    # log_rest[:, m] = log(S_m)
+    log_rest = np.logaddexp.accumulate(l[:, ::-1], axis=1)[:, ::-1]
+    m = np.arange(n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_target = np.log(desired_k) + log_rest[:, :1]
+        log_c = np.log(np.exp(log_target) - m) - log_rest
+        log_c[:, 0] = log_target[:, 0] - log_rest[:, 0]
+        # m entries clipped (c*lambda >= 1) and entry m not clipped
+        # (c*lambda <= 1). If the other entries have less than 1 ulp of
+        # mass, c*lambda_m rounds to exactly 1, so both bounds are
+        # inclusive. The bracket with the smallest violation is chosen
+        # in case rounding violates a bound by a few ulps.
+        violation = np.maximum(l + log_c, 0.)
+        violation[:, 1:] += np.maximum(-(l[:, :-1] + log_c[:, 1:]), 0.)
+        violation[~np.isfinite(log_c)] = np.inf
+    log_c = log_c[np.arange(len(l)), np.argmin(violation, axis=1)]
+    # Not enough candidates: include all of them
+    num_finite = np.isfinite(l).sum(axis=1)
+    include_all = (log_target[:, 0] >= np.log(np.maximum(num_finite, 1))) \
+                  | ~np.isfinite(violation.min(axis=1))
+    log_c[include_all] = -l[include_all,
+                            np.maximum(num_finite[include_all] - 1, 0)]
+    return np.exp(log_c)
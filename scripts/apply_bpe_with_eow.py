@@ -16,6 +16,8 @@ or --postprocessing is set to 'bpe', and the original format (with
 @@ and without </w>) when it is set to 'bpe@@'.
 """
 
+from __future__ import unicode_literals, division
+
 """Use operations learned with learn_bpe.py to encode a new text.
 The text will not be smaller, but use only a fixed vocabulary, with rare words
 encoded as variable-length sequences of subword units.
@@ -25,8 +27,6 @@ Rico Sennrich, Barry Haddow and Alexandra Birch (2015). Neural Machine Translati
 Proceedings of the 54th Annual Meeting of the Association for Computational Linguistics (ACL 2016). Berlin, Germany.
 """
 
-from __future__ import unicode_literals, division
-
 import sys
 import os
 import inspect
@@ -0,0 +1,422 @@
+"""This module implements the 'server' input method of decode.py. The
+server keeps the predictor (and thus the model) resident in memory and
+accepts decoding requests over a local socket, so that clients do not
+pay the start up costs of SGNMT for every call.
+
+The protocol is line-based: Each request is a single line containing
+a JSON object, and the server answers with one JSON line per request.
+Supported request fields are
+
+    sentence (string): Source sentence (required)
+    decoder (string): Decoding strategy, defaults to --decoder
+    beam (int): Beam size, defaults to --beam
+    nbest (int): Number of returned hypotheses, defaults to --nbest
+    temperature (float): Temperature, defaults to --temperature
+    id (object): Returned unchanged in the response
+
+The response contains the ``id``, the list of ``hypos`` (each with
+``translation``, ``tokens``, ``score`` and ``base_score``), and the
+``queue_time``, ``decode_time`` and ``latency`` of the request in
+seconds. If the request could not be processed, the response contains
+an ``error`` field instead of ``hypos``.
+
+Requests are collected in a queue by the connection threads. The
+decoding thread takes up to --server_max_batch requests at once, waiting
+at most --server_batch_wait milliseconds after the first one, and groups
+them by decoder configuration. The requests of a group are micro-batched:
+each of them is decoded in its own thread with a fork of the resident
+predictor, and a ``LockstepBatcher`` evaluates the model calls of all
+threads of the group with one ``Predictor.predict_next_batch()`` call
+as soon as every thread which has not finished yet is waiting for a
+call. Unlike the ``async_server`` module, the server does not start
+decoding new requests while a group is being decoded.
+"""
+
+import argparse
+import concurrent.futures
+import copy
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+import traceback
+
+import io_utils
+import decoding
+import decode_utils
+
+
+DECODER_CACHE_SIZE = 8
+"""Maximum number of decoder configurations kept alive."""
+
+
+def request_config(fields, args):
+    """Returns the decoder configuration of a request as hashable tuple
+    (decoder, beam, nbest, temperature). Missing fields are taken from
+    ``args``.
+
+    Args:
+        fields (dict): Request fields (see module docstring)
+        args (object): SGNMT configuration
+    """
+    return (fields.get("decoder", args.decoder),
+            int(fields.get("beam", args.beam)),
+            int(fields.get("nbest", args.nbest)),
+            float(fields.get("temperature", args.temperature)))
+
+
+def create_decoder(args, config, predictor):
+    """Creates a decoder for a request configuration which uses 
+    ``predictor`` instead of loading a new one.
+
+    Args:
+        args (object): SGNMT configuration
+        config (tuple): (decoder, beam, nbest, temperature)
+        predictor (Predictor): Predictor to add to the decoder
+
+    Returns:
+        Decoder. New decoder instance
+    """
+    name, beam, nbest, temperature = config
+    decoder_args = copy.copy(args)
+    # Fill in defaults of decoder specific arguments
+    parser = argparse.ArgumentParser()
+    decoding.DECODER_REGISTRY[name].add_args(parser)
+    for key, val in vars(parser.parse_args([])).items():
+        if not hasattr(decoder_args, key):
+            setattr(decoder_args, key, val)
+    decoder_args.decoder = name
+    decoder_args.beam = beam
+    decoder_args.nbest = nbest
+    decoder_args.temperature = temperature
+    decoder = decoding.DECODER_REGISTRY[name](decoder_args)
+    decoder.add_predictor(args.predictor, predictor)
+    return decoder
+
+
+def hypos_to_json(hypos):
+    """Converts an n-best list to the ``hypos`` field of a response."""
+    translations = io_utils.decode_batch([hypo.trgt_sentence for hypo in hypos])
+    return [{"translation": translation,
+             "tokens": [int(w) for w in hypo.trgt_sentence],
+             "score": float(hypo.total_score),
+             "base_score": float(hypo.base_score or 0.)}
+            for hypo, translation in zip(hypos, translations)]
+
+
+class Request(object):
+    """A single decoding request received by the server."""
+
+    def __init__(self, fields):
+        """Creates a new request from the parsed JSON object.
+
+        Args:
+            fields (dict): Request fields (see module docstring)
+        """
+        self.fields = fields
+        self.received = time.time()
+        self.done = threading.Event()
+        self.response = None
+
+    def config(self, args):
+        """Returns the decoder configuration of this request as
+        hashable tuple (decoder, beam, nbest, temperature)."""
+        return request_config(self.fields, args)
+
+    def respond(self, response):
+        self.response = response
+        self.done.set()
+
+
+class LockstepBatcher(object):
+    """Evaluates the model calls of a fixed group of decoding threads
+    in batches. A batch is evaluated as soon as every thread of the
+    group which has not called ``finish()`` yet is waiting for a call,
+    so there is no timeout. The batch is evaluated by the thread which
+    completes it, with ``async_server.Batcher.execute()``. Predictors
+    of the threads are ``async_server.BatchedPredictor`` instances.
+    """
+
+    def __init__(self, predictor, num_threads):
+        """
+        Args:
+            predictor (Predictor): Resident predictor. Calls are
+                                   evaluated with its
+                                   ``predict_next_batch()``
+            num_threads (int): Number of decoding threads in the group
+        """
+        import async_server
+        self.batcher = async_server.Batcher(predictor, num_threads, 0.0)
+        self.active = num_threads
+        self.waiting = 0
+        self.pending = []
+        self.cond = threading.Condition()
+
+    @property
+    def batch_sizes(self):
+        """Number of ``predict_next()`` calls in each batch."""
+        return self.batcher.batch_sizes
+
+    def call(self, predictor, method, *args):
+        """Schedules ``predictor.method(*args)`` and blocks until it has
+        been evaluated.
+
+        Returns:
+            object. Return value of the call
+        """
+        return self.call_many([(predictor, method, args)])[0]
+
+    def call_many(self, calls):
+        """Like ``call()`` for a list of (predictor, method, args)
+        tuples, which are evaluated in the same batch.
+
+        Returns:
+            list. Return values of the calls
+        """
+        futures = [concurrent.futures.Future() for _ in calls]
+        with self.cond:
+            self.pending.extend((predictor, method, args, future) for
+                                (predictor, method, args), future in zip(calls, futures))
+            self.waiting += 1
+            self._execute_if_complete()
+            while not all(future.done() for future in futures):
+                self.cond.wait()
+        return [future.result() for future in futures]
+
+    def finish(self):
+        """Must be called by each thread of the group after its last
+        call, also if decoding failed."""
+        with self.cond:
+            self.active -= 1
+            self._execute_if_complete()
+
+    def _execute_if_complete(self):
+        if self.pending and self.waiting >= self.active:
+            batch, self.pending, self.waiting = self.pending, [], 0
+            self.batcher.execute(batch)
+            self.cond.notify_all()
+
+
+class DecodeServer(object):
+    """Decodes requests from a queue with a resident predictor."""
+
+    def __init__(self, decoder, args):
+        """Creates a server which reuses the predictor of ``decoder``.
+
+        Args:
+            decoder (Decoder): Decoder created with the SGNMT config.
+                               Its predictor is shared by all decoder
+                               configurations requested by clients.
+            args (object): SGNMT configuration
+        """
+        self.args = args
+        self.predictor = decoder.predictor
+        self.decoders = {self._config_of(args): decoder}
+        self.requests = queue.Queue()
+        self.max_batch = max(1, args.server_max_batch)
+        self.batch_wait = args.server_batch_wait / 1000.0
+        self.decode_threads = concurrent.futures.ThreadPoolExecutor(self.max_batch)
+        self.batch_sizes = []
+
+    def _config_of(self, args):
+        return (args.decoder, args.beam, args.nbest, args.temperature)
+
+    def get_decoder(self, config):
+        """Returns a decoder for ``config``, creating it if necessary.
+        New decoders share the resident predictor.
+
+        Args:
+            config (tuple): (decoder, beam, nbest, temperature)
+        """
+        if config in self.decoders:
+            decoder = self.decoders.pop(config)
+        else:
+            decoder = create_decoder(self.args, config, self.predictor)
+            if len(self.decoders) >= DECODER_CACHE_SIZE:
+                self.decoders.pop(next(iter(self.decoders)))
+        self.decoders[config] = decoder # Most recently used at the end
+        return decoder
+
+    def next_batch(self):
+        """Blocks until a request is available and returns up to
+        ``max_batch`` requests, waiting at most ``batch_wait`` seconds
+        for further requests after the first one."""
+        batch = [self.requests.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.requests.get(timeout=timeout))
+                else:
+                    batch.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def process_batch(self, batch):
+        """Decodes all requests in ``batch``, grouped by decoder
+        configuration, and sends the responses."""
+        groups = {}
+        for request in batch:
+            try:
+                groups.setdefault(request.config(self.args), []).append(request)
+            except (KeyError, TypeError, ValueError) as e:
+                request.respond({"id": request.fields.get("id"),
+                                 "error": "Invalid request: %s" % e})
+        for config, requests in groups.items():
+            try:
+                decoder = self.get_decoder(config)
+            except Exception as e:
+                logging.error("Could not create decoder %s: %s" % (config, e))
+                for request in requests:
+                    request.respond({"id": request.fields.get("id"),
+                                     "error": "Invalid decoder config: %s" % e})
+                continue
+            if len(requests) == 1:
+                requests[0].respond(self.process_request(decoder, config, requests[0]))
+            else:
+                self.process_group(config, requests)
+
+    def process_group(self, config, requests):
+        """Decodes several requests with the same decoder configuration
+        concurrently and micro-batches their model calls with a
+        ``LockstepBatcher``. Sends the responses."""
+        import async_server
+        batcher = LockstepBatcher(self.predictor, len(requests))
+
+        def process(request):
+            try:
+                predictor = async_server.BatchedPredictor(self.predictor.fork(),
+                                                          batcher)
+                decoder = create_decoder(self.args, config, predictor)
+                return self.process_request(decoder, config, request)
+            except Exception as e:
+                logging.error("Could not create decoder %s: %s" % (config, e))
+                return {"id": request.fields.get("id"),
+                        "error": "Invalid decoder config: %s" % e}
+            finally:
+                batcher.finish()
+
+        responses = list(self.decode_threads.map(process, requests))
+        self.batch_sizes.extend(batcher.batch_sizes)
+        for request, response in zip(requests, responses):
+            request.respond(response)
+
+    def process_request(self, decoder, config, request):
+        """Decodes a single request and returns the response dict."""
+        start_time = time.time()
+        try:
+            hypos = decode_utils.decode_sentence(
+                decoder, request.fields["sentence"].strip(), nbest=config[2])
+            response = {"hypos": hypos_to_json(hypos)}
+        except Exception as e:
+            logging.error("Error while processing request: %s Stack trace: %s"
+                          % (e, traceback.format_exc()))
+            response = {"error": "%s: %s" % (type(e).__name__, e)}
+        end_time = time.time()
+        response["id"] = request.fields.get("id")
+        response["queue_time"] = start_time - request.received
+        response["decode_time"] = end_time - start_time
+        response["latency"] = end_time - request.received
+        logging.info("Request (ID: %s): latency=%.3f queue_time=%.3f "
+                     "decode_time=%.3f num_expansions=%d" % (
+                         response["id"], response["latency"],
+                         response["queue_time"], response["decode_time"],
+                         decoder.apply_predictor_count))
+        return response
+
+    def run(self):
+        """Processes requests until interrupted."""
+        while True:
+            self.process_batch(self.next_batch())
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """Reads JSON lines from a client connection and enqueues them."""
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                fields = json.loads(line.decode('utf-8'))
+                if not isinstance(fields, dict) or "sentence" not in fields:
+                    raise ValueError("Request must be a JSON object with a "
+                                     "'sentence' field")
+            except ValueError as e:
+                self._send({"error": "Invalid request: %s" % e})
+                continue
+            request = Request(fields)
+            self.server.decode_server.requests.put(request)
+            request.done.wait()
+            self._send(request.response)
+
+    def _send(self, response):
+        self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+        self.wfile.flush()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class _UnixServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def create_socket_server(address):
+    """Creates the socket server listening on ``address``.
+
+    Args:
+        address (string): Either 'unix:<path>' for a Unix domain socket
+                          or '<host>:<port>' for a TCP socket.
+
+    Returns:
+        socketserver.BaseServer. Server which has not been started yet
+    """
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.remove(path)
+        return _UnixServer(path, _RequestHandler)
+    host, port = address.rsplit(":", 1)
+    return _TCPServer((host, int(port)), _RequestHandler)
+
+
+def serve(decoder, args):
+    """Starts the decoding server and processes requests until it is
+    interrupted. The socket is served in a background thread, decoding
+    runs in the calling thread.
+
+    Args:
+        decoder (Decoder): Decoder created with the SGNMT config
+        args (object): SGNMT configuration
+    """
+    decode_server = DecodeServer(decoder, args)
+    socket_server = create_socket_server(args.server_address)
+    socket_server.decode_server = decode_server
+    thread = threading.Thread(target=socket_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info("Listening on %s (PID: %d)" % (args.server_address,
+                                                 os.getpid()))
+    try:
+        decode_server.run()
+    except KeyboardInterrupt:
+        logging.info("Shutting down server...")
+    finally:
+        socket_server.shutdown()
+        socket_server.server_close()
+        if args.server_address.startswith("unix:"):
+            try:
+                os.remove(args.server_address[len("unix:"):])
+            except OSError:
+                pass
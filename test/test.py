@@ -318,12 +318,1228 @@ def test_sampling():
         assert sum(abs(x-y))/len(x) < 0.01
 
 
+def _dummy_decoder(decoder_args, name, vocab_size=VOCAB_SIZE, seed=SEED):
+    """Returns the decoder ``name`` with a ``DummyPredictor``."""
+    decoder = decoding.DECODER_REGISTRY[name](decoder_args)
+    decoder.add_predictor("dummy", DummyPredictor(seed, vocab_size=vocab_size))
+    return decoder
+
+
+def test_streaming_output():
+    import copy
+    import decode_utils
+    import io_utils
+    import output
+
+    class RecordingOutputHandler(output.OutputHandler):
+        name = 'recording'
+        def __init__(self, events, line_aligned):
+            super(RecordingOutputHandler, self).__init__()
+            self.events = events
+            self.line_aligned = line_aligned
+        def write_sentence(self, sen_idx, hypos):
+            self.events.append((self, sen_idx, [h.trgt_sentence for h in hypos]))
+        def close(self):
+            self.events.append((self, 'close', None))
+
+    class FailingDecoder(object):
+        """Raises on the second sentence."""
+        def __init__(self, decoder):
+            self.decoder = decoder
+        def decode(self, src):
+            if src == [5, 6]:
+                raise RuntimeError("decoding failed")
+            return self.decoder.decode(src)
+        def __getattr__(self, name):
+            return getattr(self.decoder, name)
+
+    decode_args = copy.copy(args)
+    decode_args.range = ""
+    decode_args.nbest = 1
+    decode_utils.args = decode_args
+    io_utils.initialize(decode_args)
+    events = []
+    aligned = RecordingOutputHandler(events, True)
+    other = RecordingOutputHandler(events, False)
+    decoder = FailingDecoder(_dummy_decoder(decode_args, 'greedy'))
+    decode_utils.do_decode(decoder, [aligned, other], ["4 5", "5 6", "7"])
+    # Each sentence is written as soon as it is decoded
+    assert [(h, i) for h, i, _ in events] == [
+        (aligned, 0), (other, 0), (aligned, 1), (aligned, 2), (other, 2),
+        (aligned, 'close'), (other, 'close')]
+    # Only the line-aligned handler gets a dummy hypothesis for the failure
+    assert events[2][2] == [[utils.UNK_ID]]
+    for _, _, sentences in [events[0], events[3]]:
+        assert len(sentences) == 1 and sentences[0]
+
+
+def test_output_flush():
+    import copy
+    import shutil
+    import signal
+    import tempfile
+    import decode_utils
+    import io_utils
+    import output
+
+    def on_disk(path):
+        with open(path) as f:
+            return f.read()
+
+    hypos = [decoding.core.Hypothesis([4, 5], -1.0, [-0.5, -0.5])]
+    flush_args = copy.copy(args)
+    flush_args.preprocessing = "id"
+    io_utils.initialize(flush_args)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "out.txt")
+        flush_args.output_flush_every = 2
+        flush_args.output_flush_interval = 0.0
+        handler = output.TextOutputHandler(path, flush_args)
+        handler.write_sentence(0, hypos)
+        assert on_disk(path) == ""
+        handler.write_sentence(1, hypos)
+        assert on_disk(path) == "4 5\n4 5\n"
+        handler.close()
+
+        # Time-based flushing only
+        flush_args.output_flush_every = 0
+        flush_args.output_flush_interval = 0.05
+        handler = output.TextOutputHandler(path, flush_args)
+        handler.write_sentence(0, hypos)
+        assert on_disk(path) == ""
+        time.sleep(0.1)
+        handler.write_sentence(1, hypos)
+        assert on_disk(path) == "4 5\n4 5\n"
+        handler.write_sentence(2, hypos)
+        assert on_disk(path) == "4 5\n4 5\n"
+        handler.close()
+        assert on_disk(path) == "4 5\n4 5\n4 5\n"
+
+        # Buffered output is flushed on SIGINT
+        flush_args.output_flush_interval = 0.0
+        handler = output.TextOutputHandler(path, flush_args)
+        handler.write_sentence(0, hypos)
+        names = [n for n in ["SIGINT", "SIGTERM", "SIGHUP"] if hasattr(signal, n)]
+        originals = [signal.getsignal(getattr(signal, n)) for n in names]
+        try:
+            decode_utils._flush_on_signal([handler])
+            try:
+                signal.getsignal(signal.SIGINT)(signal.SIGINT, None)
+                assert False, "SIGINT handler did not raise KeyboardInterrupt"
+            except KeyboardInterrupt:
+                pass
+        finally:
+            for name, original in zip(names, originals):
+                signal.signal(getattr(signal, name), original)
+        assert on_disk(path) == "4 5\n"
+        handler.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_binary_nbest():
+    import copy
+    import shutil
+    import tempfile
+    import binary_nbest
+    import output
+
+    rng = np.random.RandomState(SEED)
+    nbest_lists = []
+    for n in [3, 1, 0, 2]:
+        hypos = []
+        for _ in range(n):
+            length = rng.randint(0, 6)
+            breakdown = rng.uniform(-5, 0, size=length)
+            hypos.append(decoding.core.Hypothesis(
+                rng.randint(0, 40000, size=length).tolist(),
+                float(breakdown.sum()), breakdown.tolist(),
+                base_score=float(rng.uniform(-10, 0))))
+        nbest_lists.append(hypos)
+    # Breakdowns with (score, weight) tuples are reduced to scores
+    nbest_lists[3][0].score_breakdown = [
+        [(s, 1.0)] for s in nbest_lists[3][0].score_breakdown]
+    sen_indices = [7, 0, 3, 12]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "nbest")
+        handler = output.BinaryNBestOutputHandler(path, copy.copy(args))
+        handler.write_hypos(nbest_lists, sen_indices)
+        reader = binary_nbest.BinaryNBestReader(path)
+        assert len(reader) == len(nbest_lists)
+        for j, (sen_idx, hypos) in enumerate(zip(sen_indices, nbest_lists)):
+            assert reader.sentence_index(j) == sen_idx
+            assert reader.num_hypos(j) == len(hypos)
+            np.testing.assert_allclose(reader.sentence_total_scores(j),
+                                       [h.total_score for h in hypos], rtol=1e-6)
+            for i, hypo in enumerate(hypos):
+                assert reader.tokens(j, i).tolist() == hypo.trgt_sentence
+                np.testing.assert_allclose(reader.total_score(j, i),
+                                           hypo.total_score, rtol=1e-6)
+                np.testing.assert_allclose(reader.base_score(j, i),
+                                           hypo.base_score, rtol=1e-6)
+                np.testing.assert_allclose(
+                    reader.score_breakdown(j, i),
+                    binary_nbest.flatten_breakdown(hypo.score_breakdown))
+            try:
+                reader.tokens(j, len(hypos))
+                assert False, "Expected IndexError"
+            except IndexError:
+                pass
+        assert len(reader.score_breakdown(3, 0)) == len(nbest_lists[3][0].trgt_sentence)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_ngram_posteriors():
+    import output
+
+    def naive_posteriors(token_seqs, scores, min_order, max_order):
+        normed = np.asarray(scores) - utils.log_sum(scores)
+        posteriors = collections.OrderedDict()
+        for seq, score in zip(token_seqs, normed):
+            seq = [utils.GO_ID] + list(seq) + [utils.EOS_ID]
+            seen = set()
+            for pos in range(len(seq)):
+                for order in range(1, max_order + 1):
+                    if pos < order - 1 or (order < min_order and pos != order - 1):
+                        continue
+                    ngram = tuple(seq[pos - order + 1:pos + 1])
+                    if ngram not in seen:
+                        seen.add(ngram)
+                        posteriors[ngram] = np.logaddexp(
+                            posteriors.get(ngram, utils.NEG_INF), score)
+        return posteriors
+
+    rng = np.random.RandomState(SEED)
+    # Small vocabularies have many shared ngrams, large ones (2^30) do
+    # not fit into packed int64 codes
+    for vocab_size, max_order in [(5, 4), (40000, 4), (2**30, 3), (3, 1)]:
+        for _ in range(20):
+            token_seqs = [rng.randint(0, vocab_size, size=rng.randint(0, 8)).tolist()
+                          for _ in range(rng.randint(1, 6))]
+            if vocab_size > 1000: # Force shared ngrams
+                token_seqs.append(list(token_seqs[0]))
+            scores = rng.uniform(-10, 0, size=len(token_seqs))
+            min_order = rng.randint(1, max_order + 1)
+            want = naive_posteriors(token_seqs, scores, min_order, max_order)
+            starts, ends, tokens, posteriors = output.ngram_posteriors(
+                token_seqs, scores, min_order, max_order)
+            got = [tuple(tokens[s:e].tolist()) for s, e in zip(starts, ends)]
+            assert got == list(want), (got, list(want))
+            np.testing.assert_allclose(posteriors, list(want.values()))
+
+
+def test_server_batching():
+    import copy
+    import decode_utils
+    import io_utils
+    import server
+
+    server_args = copy.copy(args)
+    server_args.decoder = "greedy"
+    server_args.nbest = 1
+    server_args.server_max_batch = 4
+    decode_utils.args = server_args
+    io_utils.initialize(server_args)
+    decoder = _dummy_decoder(server_args, "greedy")
+    sentences = ["4 5", "6", "7 8 9", "10 11"]
+    want = [server.hypos_to_json(decode_utils.decode_sentence(decoder, s))
+            for s in sentences]
+    decode_server = server.DecodeServer(decoder, server_args)
+    requests = [server.Request({"sentence": s, "id": i})
+                for i, s in enumerate(sentences)]
+    decode_server.process_batch(requests)
+    for i, request in enumerate(requests):
+        assert request.done.is_set()
+        assert request.response["id"] == i
+        assert request.response["hypos"] == want[i], request.response
+    # Greedy decoding of all four sentences runs in lockstep until the
+    # first one is finished
+    assert decode_server.batch_sizes[0] == len(sentences)
+    assert sum(decode_server.batch_sizes) > max(decode_server.batch_sizes)
+
+
+def test_async_server_batching():
+    import asyncio
+    import copy
+    import decode_utils
+    import io_utils
+    import async_server
+    import server
+
+    server_args = copy.copy(args)
+    server_args.decoder = "greedy"
+    server_args.nbest = 1
+    server_args.server_max_batch = 4
+    server_args.server_batch_wait = 50.0
+    server_args.server_max_concurrent = 4
+    decode_utils.args = server_args
+    io_utils.initialize(server_args)
+    decoder = _dummy_decoder(server_args, "greedy")
+    sentences = ["4 5", "6", "7 8 9", "10 11"]
+    want = [server.hypos_to_json(decode_utils.decode_sentence(decoder, s))
+            for s in sentences]
+    decode_server = async_server.AsyncDecodeServer(decoder, server_args)
+
+    async def run():
+        batcher = decode_server.batcher.start(asyncio.get_running_loop())
+        responses = await asyncio.gather(*[
+            decode_server.process_request({"sentence": s, "id": i})
+            for i, s in enumerate(sentences)])
+        batcher.cancel()
+        return responses
+
+    responses = asyncio.run(run())
+    for i, response in enumerate(responses):
+        assert response["id"] == i
+        assert response["hypos"] == want[i], response
+    # Full batches are evaluated without waiting for --server_batch_wait
+    assert max(decode_server.batcher.batch_sizes) == len(sentences)
+    assert decode_server.stats()["latency"]["count"] == len(sentences)
+
+
+def test_lazy_imports():
+    import json
+    import subprocess
+
+    # Heavy optional dependencies which decoding with the greedy decoder
+    # must not import
+    heavy_modules = ['torch', 'fairseq', 'scipy.optimize', 'scipy.stats',
+                     'sacrebleu', 'mosestokenizer', 'sortedcontainers',
+                     'pandas']
+    code = ("import json, sys; sys.argv = ['decode.py', '--decoder', 'greedy']; "
+            "import decode_utils, decoding, estimators, output, ui; "
+            "decoding.DECODER_REGISTRY[ui.get_args().decoder]; "
+            "print(json.dumps(sorted(sys.modules)))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.run([sys.executable, '-c', code], cwd=root,
+                          stdout=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    imported = set(json.loads(proc.stdout.splitlines()[-1]))
+    assert 'decoding.greedy' in imported
+    heavy = sorted(set(heavy_modules) & imported)
+    assert not heavy, "Heavy modules imported: %s" % ", ".join(heavy)
+
+def test_binary_source():
+    import copy
+    import shutil
+    import tempfile
+    import binary_source
+    import decode_utils
+    import io_utils
+    import output
+
+    sentences = [[4, 5, 6], [], [70000, 7], [8]]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, "src.bin")
+        binary_source.write_corpus(path, sentences)
+        reader = binary_source.BinarySourceReader(path)
+        assert len(reader) == len(sentences)
+        assert [reader[j] for j in range(len(reader))] == sentences
+        try:
+            reader[len(sentences)]
+            assert False, "Expected IndexError"
+        except IndexError:
+            pass
+        empty_path = os.path.join(tmp_dir, "empty.bin")
+        binary_source.write_corpus(empty_path, [])
+        assert len(binary_source.BinarySourceReader(empty_path)) == 0
+        text_path = os.path.join(tmp_dir, "src.txt")
+        with open(text_path, "w") as f:
+            f.write("4 5 6\n")
+        try:
+            binary_source.BinarySourceReader(text_path)
+            assert False, "Expected IOError"
+        except IOError:
+            pass
+
+        # Decoding the binary file gives the same output as the text
+        decode_args = copy.copy(args)
+        decode_args.range = ""
+        decode_args.nbest = 1
+        decode_utils.args = decode_args
+        io_utils.initialize(decode_args)
+        text_sentences = ["4 5 6", "7 8", "9"]
+        binary_source.write_corpus(path, [io_utils.encode(s) for s in text_sentences])
+        out_paths = []
+        for src_sentences in [text_sentences, binary_source.BinarySourceReader(path)]:
+            out_paths.append(os.path.join(tmp_dir, "out%d.txt" % len(out_paths)))
+            handler = output.TextOutputHandler(out_paths[-1], decode_args)
+            decode_utils.do_decode(_dummy_decoder(decode_args, "greedy"),
+                                   [handler], src_sentences)
+        with open(out_paths[0]) as f_text, open(out_paths[1]) as f_bin:
+            text_output = f_text.read()
+            assert text_output.count("\n") == len(text_sentences)
+            assert text_output == f_bin.read()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _learn_bpe_codes(path, text, num_merges, version=(0, 2)):
+    """Learns BPE merge operations on ``text`` like subword-nmt's
+    learn_bpe.py and writes them to ``path``."""
+    def merge(word, pair):
+        out, i = [], 0
+        while i < len(word):
+            if i < len(word) - 1 and (word[i], word[i+1]) == pair:
+                out.append(word[i] + word[i+1])
+                i += 2
+            else:
+                out.append(word[i])
+                i += 1
+        return tuple(out)
+
+    words = collections.Counter()
+    for word, count in collections.Counter(text.split()).items():
+        if version == (0, 1):
+            words[tuple(word) + ('</w>',)] += count
+        else:
+            words[tuple(word[:-1]) + (word[-1] + '</w>',)] += count
+    codes = []
+    for _ in range(num_merges):
+        pairs = collections.Counter()
+        for word, count in words.items():
+            for pair in zip(word, word[1:]):
+                pairs[pair] += count
+        if not pairs:
+            break
+        best = max(sorted(pairs), key=lambda pair: pairs[pair])
+        codes.append(best)
+        merged = collections.Counter()
+        for word, count in words.items():
+            merged[merge(word, best)] += count
+        words = merged
+    with open(path, "w", encoding="utf-8") as f:
+        if version == (0, 2):
+            f.write("#version: 0.2\n")
+        f.writelines("%s %s\n" % pair for pair in codes)
+
+
+def test_bpe():
+    import importlib.util
+    import shutil
+    import tempfile
+    import io_utils
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(
+        "apply_bpe_with_eow", os.path.join(root, "scripts", "apply_bpe_with_eow.py"))
+    apply_bpe = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(apply_bpe)
+
+    def expected(reference, words, separator, eow):
+        """Segmentation of ``words`` by the reference implementation,
+        with end-of-word symbols removed like in ``io_utils.BPE``."""
+        output = []
+        for word in words:
+            segments = tuple(reference.segment_tokens([word]))
+            if eow and segments[-1] == '</w>':
+                segments = segments[:-1]
+            elif eow:
+                segments = segments[:-1] + (segments[-1].replace('</w>', ''),)
+            output.extend([s + separator for s in segments[:-1]] + [segments[-1]])
+        return output
+
+    with open(os.path.join(root, "README.md"), encoding="utf-8") as f:
+        text = f.read()
+    # Learn on every other line and segment all lines, so that there are
+    # words with unseen characters and merges
+    lines = [l.strip() for l in text.splitlines() if l.strip()]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for version in [(0, 1), (0, 2)]:
+            codes_path = os.path.join(tmp_dir, "codes%d" % version[1])
+            _learn_bpe_codes(codes_path, " ".join(lines[::2]), 500, version)
+            with open(codes_path, encoding="utf-8") as codes:
+                reference = apply_bpe.BPE(codes)
+            for separator in ['', '@@']:
+                for eow in [False, True]:
+                    cache_path = os.path.join(tmp_dir, "cache%d.db" % version[1])
+                    bpes = [io_utils.BPE(codes_path, separator, eow),
+                            io_utils.BPE(codes_path, separator, eow, cache_size=3),
+                            io_utils.BPE(codes_path, separator, eow,
+                                         cache_path=cache_path)]
+                    # The second pass hits the in-memory or the disk cache
+                    for _ in range(2):
+                        for line in lines:
+                            words = [w for w in line.split(' ') if w]
+                            want = expected(reference, words, separator, eow)
+                            for bpe in bpes:
+                                got = bpe.segment_tokens(words)
+                                assert got == want, (version, separator, eow, got, want)
+                        bpes[2].disk_cache.flush()
+                        # Fresh instance which reads from the disk cache
+                        bpes[2] = io_utils.BPE(codes_path, separator, eow,
+                                               cache_size=1, cache_path=cache_path)
+                    word = max(text.split(), key=len)
+                    assert bpes[2].disk_cache.get(word) == bpes[0].encode(word)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_batch_encode_decode():
+    import copy
+    import shutil
+    import tempfile
+    import io_utils
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        wmap_path = os.path.join(tmp_dir, "wmap")
+        with open(wmap_path, "w", encoding="utf-8") as f:
+            f.write("<epsilon> 0\n<s> 1\n</s> 2\n<unk> 3\nhaus 4\nbaum 5\n"
+                    "h 6\na 7\n_ 8\nhaus</w> 9\nba@@ 10\num 11\n▁der 12\n")
+        sentences = ["haus baum", "", "baum  maus haus", "ha us"]
+        id_sentences = [[4, 5], [], [9, 10, 11, 12, 3, 13, -1, 99], [6, 7, 8, 6]]
+        io_args = copy.copy(args)
+        io_args.wmap = wmap_path
+        for preprocessing, postprocessing in [
+                ("id", "id"), ("word", "word"), ("char", "char"),
+                ("word", "bpe"), ("word", "bpe@@"), ("word", "bpe_")]:
+            io_args.preprocessing = preprocessing
+            io_args.postprocessing = postprocessing
+            io_utils.initialize(io_args)
+            src = [" ".join(map(str, s)) for s in id_sentences] \
+                if preprocessing == "id" else sentences
+            assert io_utils.encode_batch(src) == [io_utils.encode(s) for s in src]
+            # Compiled word map and plain dict
+            for trg_wmap in [io_utils.trg_wmap, dict(io_utils.trg_wmap.items())]:
+                io_utils.trg_wmap = trg_wmap
+                want = [io_utils.decode(s) for s in id_sentences]
+                assert io_utils.decode_batch(id_sentences) == want, postprocessing
+            assert io_utils.decode_batch([]) == []
+        assert io_utils.get_trg_wmap_array()[3] == "<unk>"
+    finally:
+        io_utils.load_src_wmap(None)
+        io_utils.load_trg_wmap(None)
+        shutil.rmtree(tmp_dir)
+
+
+def test_compiled_wmaps():
+    import shutil
+    import tempfile
+    import binary_wmap
+
+    wmaps = {
+        "plain": "<epsilon> 0\n<s> 1\n</s> 2\n<unk> 3\nhaus 4\nbaum 5\n",
+        "shared_ids": "a 0\nb 1\nc 1\nd 2\n",
+        "repeated_words": "a 0\nb 1\na 2\n",
+        "gaps": "x 3\ny 7\n",
+        "unicode": "äpfel 0\nstraße 1\n▁der 2\n",
+    }
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, content in wmaps.items():
+            path = os.path.join(tmp_dir, name)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(content)
+            # Dicts built by the text loaders in io_utils
+            entries = [line.split() for line in content.splitlines()]
+            word2id = dict((e[0], int(e[-1])) for e in entries)
+            id2word = dict((int(e[-1]), e[0]) for e in entries)
+            # First call compiles the word map, second call maps it
+            for _ in range(2):
+                wmap = binary_wmap.load(path)
+                assert dict(wmap.word_to_id.items()) == word2id, name
+                assert dict(wmap.id_to_word.items()) == id2word, name
+                assert len(wmap.word_to_id) == len(word2id), name
+                assert len(wmap.id_to_word) == len(id2word), name
+                for word, idx in word2id.items():
+                    assert wmap.word_to_id[word] == idx and word in wmap.word_to_id
+                for idx, word in id2word.items():
+                    assert wmap.id_to_word.get(idx) == word
+                assert "".join(word2id) + "_" not in wmap.word_to_id
+                assert wmap.id_to_word.get(max(id2word) + 1) is None
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_sentence_bleu():
+    from concurrent.futures import ThreadPoolExecutor
+    import sacrebleu
+
+    hypos = ["the cat sat on the mat", "a cat sat on a mat .", "", "mat",
+             "the the the the", "on the mat sat the cat", "dog"]
+    references = [["the cat sat on the mat"],
+                  ["the cat sat on the mat", "there is a cat on the mat ."]]
+    for detokenizer in [None, lambda tokens: "".join(tokens)]:
+        for refs in references:
+            detok_refs = refs if detokenizer is None \
+                else [detokenizer(r.split()) for r in refs]
+            detok_hypos = hypos if detokenizer is None \
+                else [detokenizer(h.split()) for h in hypos]
+            want = [sacrebleu.sentence_bleu(h, detok_refs).score
+                    for h in detok_hypos]
+            scorer = utils.SentenceBleuScorer(refs, detokenizer)
+            assert [scorer.score(h) for h in hypos] == want
+            assert [utils.sentence_bleu(h, refs, detokenizer)
+                    for h in hypos] == want
+            assert scorer.score_batch(hypos) == want
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                assert scorer.score_batch(hypos, executor) == want
+
+
+def test_id_bleu():
+    import sacrebleu
+
+    rng = np.random.RandomState(0)
+    for num_refs in [1, 2, 3]:
+        for _ in range(20):
+            refs = [list(rng.randint(4, 12, size=rng.randint(1, 15)))
+                    for _ in range(num_refs)]
+            # Tokens 0-3 never occur in the references
+            hypos = [list(rng.randint(0, 12, size=rng.randint(0, 15)))
+                     for _ in range(10)]
+            hypos += [refs[0], refs[0] + refs[0], [], [refs[0][0]] * 5]
+            str_refs = [" ".join(map(str, r)) for r in refs]
+            bleus = [sacrebleu.sentence_bleu(" ".join(map(str, h)), str_refs,
+                                             tokenize="none") for h in hypos]
+            want = np.array([b.score for b in bleus])
+            scorer = utils.IdBleuScorer(refs if num_refs > 1 else refs[0])
+            got = scorer.score_batch(hypos)
+            assert np.allclose(got, want, rtol=1e-9, atol=1e-9), (got, want)
+            assert np.isclose(scorer.score(hypos[0]), want[0])
+            matrix, lengths = utils.token_matrix(hypos)
+            assert np.allclose(scorer.score_batch(matrix, lengths), want)
+            # Match statistics agree with sacrebleu's own
+            stats = [[b.sys_len, b.ref_len] + b.counts + b.totals
+                     for b in bleus]
+            assert (scorer.stats(hypos) == np.array(stats)).all()
+            assert np.allclose(utils.bleu_from_stats(stats), want)
+
+
+def test_ngram_diversity():
+    def distinct_ngrams(hypos, n):
+        # Strings as in utils.ngrams(), where "" is one empty word
+        hypos = [h.split(' ') if isinstance(h, str) else h for h in hypos]
+        all_ngrams = [tuple(h[i:i+n]) for h in hypos
+                      for i in range(len(h) - n + 1)]
+        return float(len(set(all_ngrams)))/len(all_ngrams) if all_ngrams else 0
+
+    rng = np.random.RandomState(0)
+    for vocab_size in [3, 50, 5000]:
+        for _ in range(30):
+            id_hypos = [list(rng.randint(vocab_size, size=rng.randint(0, 12)))
+                        for _ in range(rng.randint(1, 8))]
+            str_hypos = [" ".join("w%d" % w for w in h) for h in id_hypos]
+            str_hypos.append("a  b a")
+            for hypos in [id_hypos, str_hypos]:
+                # 5000 words do not fit 5-grams into 62 bits
+                for n in [1, 2, 5]:
+                    assert utils.distinct_ngrams(hypos, n) == \
+                        distinct_ngrams(hypos, n)
+                want = sum(distinct_ngrams(hypos, n) for n in range(1, 5)) / 4
+                assert utils.ngram_diversity(hypos) == want
+    assert utils.ngram_diversity([]) == 0
+    assert utils.distinct_ngrams([[], []], 2) == 0
+
+
+def test_estimators():
+    import argparse
+    import shutil
+    import tempfile
+    import estimators
+
+    rng = np.random.RandomState(0)
+    batches = [(rng.normal(size=size), rng.normal(size=size) - 700.)
+               for size in [1, 5, 0, 20, 3]]
+    values = np.concatenate([v for v, _ in batches])
+    weights = np.concatenate([w for _, w in batches])
+    # Reference in plain floats, shifted by the largest log weight
+    w = np.exp(weights - weights.max())
+    mean = np.dot(w, values) / w.sum()
+    var = np.dot(w, (values - mean)**2) / w.sum()
+    ess = w.sum()**2 / (w**2).sum()
+    for normalize in [True, False]:
+        estimator = estimators.Estimator(
+            argparse.Namespace(no_normalization=not normalize))
+        for i, (v, lw) in enumerate(batches):
+            if i % 2:
+                for value, weight in zip(v, lw):
+                    estimator.increment(value, weight)
+            else:
+                estimator.increment_batch(v, lw)
+        want = mean if normalize \
+            else np.dot(np.exp(weights + 700.), values) * np.exp(-700.)
+        assert np.isclose(estimator.estimate(), want, rtol=1e-9, atol=0)
+        assert np.isclose(estimator.variance(), var, rtol=1e-9)
+        assert np.isclose(estimator.effective_sample_size(), ess, rtol=1e-9)
+        low, high = estimator.confidence_interval()
+        assert low < estimator.estimate() < high
+        assert estimator._count == len(values)
+        estimator.reset()
+        assert estimator.effective_sample_size() == 0.
+        assert estimator.confidence_interval() == (utils.NEG_INF, utils.INF)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        estimator = estimators.Estimator(
+            argparse.Namespace(no_normalization=False))
+        for fmt in ["csv", "bin"]:
+            path = os.path.join(tmp_dir, fmt)
+            writer = estimators.EstimateWriter(path, fmt)
+            records = []
+            for sen_id, (v, lw) in enumerate(batches):
+                estimator.increment_batch(v, lw)
+                writer.write(sen_id, 2, lw, v, estimator)
+                writer.flush()
+                records.extend((sen_id, 2, weight, value)
+                               for weight, value in zip(lw, v))
+                estimator.reset()
+            writer.close()
+            want = np.array(records, dtype=estimators.SAMPLE_DTYPE)
+            if fmt == "bin":
+                got = np.fromfile(path + ".bin", dtype=estimators.SAMPLE_DTYPE)
+            else:
+                got = np.loadtxt(path + ".csv", delimiter=",", skiprows=1,
+                                 dtype=estimators.SAMPLE_DTYPE, ndmin=1)
+            assert (got == want).all()
+            summary = np.genfromtxt(path + ".summary.csv", delimiter=",",
+                                    names=True)
+            assert summary["sen_id"].tolist() == list(range(len(batches)))
+            assert summary["count"].tolist() == [len(v) for v, _ in batches]
+            assert np.isclose(summary["estimate"][-1], batches[-1][0].dot(
+                np.exp(batches[-1][1] - np.logaddexp.reduce(batches[-1][1]))))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_swor_trie():
+    import copy
+
+    decoder_args = copy.copy(args)
+    decoder_args.nbest = 20
+    for name in ["basic_swor", "swor"]:
+        decoder = _dummy_decoder(decoder_args, name, vocab_size=6)
+        hypos = decoder.decode([4, 5])
+        sentences = [tuple(h.trgt_sentence) for h in hypos]
+        assert len(sentences) == 20 and len(set(sentences)) == 20
+        # Every sample is a path from the root
+        for sentence in sentences:
+            node = decoder.trie
+            for word in sentence:
+                node = node.children[utils.binary_search(node.dist.ids, word)]
+        stack = [decoder.trie]
+        while stack:
+            node = stack.pop()
+            if node.parent_dist is None:
+                assert node.marg() == 0
+            else:
+                assert node.marg() == \
+                    node.parent_dist.adjusted_lprobabilities[node.index]
+            if node.dist is None:
+                continue
+            for index, child in node.children.items():
+                assert child.parent_dist is node.dist and child.index == index
+                stack.append(child)
+            # The remaining mass of a prefix is the mass left in its
+            # distribution (joint in swor, conditional in basic_swor)
+            mass = np.exp(node.dist.adjusted_lprobabilities.S[1])
+            if node.parent_dist is None:
+                want = 1. - np.exp(decoder.covered_lprob)
+            else:
+                want = np.exp(node.marg())
+                if name == "basic_swor":
+                    mass *= np.exp(node.parent_dist.lprobabilities[node.index])
+            assert np.isclose(mass, want, rtol=1e-6, atol=1e-12)
+
+
+def test_sparse_dist():
+    from decoding.swor import Dist, SparseDist
+
+    rng = np.random.RandomState(0)
+    for ids in [list(range(300)), sorted(rng.choice(1000, 300, replace=False))]:
+        lprobs = rng.normal(scale=3., size=len(ids))
+        lprobs -= np.logaddexp.reduce(lprobs)
+        dist = SparseDist(ids, lprobs, None, 5)
+        dense = Dist(ids, lprobs.copy(), None)
+        for word, lprob in zip(ids, lprobs):
+            assert np.isclose(dist.get_current(word), lprob)
+        # Sample until far more words than the initial capacity are split
+        np.random.seed(0)
+        counts = collections.Counter()
+        for i in range(3000):
+            slots = [dist.sample()] if i % 2 else dist.sample_many(3)
+            counts.update(dist.ids[s] for s in slots)
+            _, lprobabilities, adjusted, _ = dist.values()
+            assert np.isclose(adjusted.S[1], 0.)
+        split = set(dist.ids[1:])
+        rest = [lp for word, lp in zip(ids, lprobs) if word not in split]
+        assert len(split) > 16
+        assert np.isclose(dist.lprobabilities[dist.REST],
+                          np.logaddexp.reduce(rest) if rest else utils.NEG_INF)
+        for word, lprob in zip(ids, lprobs):
+            assert np.isclose(dist.get_current(word), lprob)
+        # Sampling frequencies match the dense distribution
+        freqs = np.array([counts[w] for w in ids]) / sum(counts.values())
+        assert np.abs(freqs - np.exp(lprobs)).sum() < 0.1
+        for word in list(split)[:5]:
+            dist.adjust(word, dist.get_current(word) - 1.)
+            dense.adjust(word, dense.get_current(word) - 1.)
+            assert np.isclose(dist.get_current(word), dense.get_current(word))
+        assert np.isclose(dist.adjusted_lprobabilities.S[1],
+                          dense.adjusted_lprobabilities.S[1])
+
+
+def test_swor_memory():
+    import copy
+    import tracemalloc
+
+    def count_nodes(node):
+        stack, count = [node], 0
+        while stack:
+            node = stack.pop()
+            count += node.dist is not None
+            stack.extend(node.children.values())
+        return count
+
+    src = list(range(4, 9))
+    decoder_args = copy.copy(args)
+    decoder_args.nbest = 100
+    results = {}
+    for topk in [0, 50]:
+        decoder_args.swor_topk = topk
+        decoder = _dummy_decoder(decoder_args, "swor", vocab_size=2000)
+        tracemalloc.start()
+        hypos = decoder.decode(src)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert len(hypos) == 100
+        assert len(set(tuple(h.trgt_sentence) for h in hypos)) == 100
+        results[topk] = peak / count_nodes(decoder.trie)
+    # Three full-vocabulary heaps per prefix against one
+    assert results[50] < 0.5 * results[0], results
+
+
+def _swor_pairs(decoder_args, name, runs=1000):
+    """Decodes a one-word source with 2 samples for seeds 0..runs-1.
+
+    Returns:
+        (Counter, dict). Counts of the ordered sample pairs, and the
+        log-probability of each sampled sentence
+    """
+    decoder_args.nbest = 2
+    decoder = _dummy_decoder(decoder_args, name, vocab_size=4)
+    counts = collections.Counter()
+    lprobs = {}
+    for seed in range(runs):
+        decoder.seed = seed
+        hypos = decoder.decode([4])
+        counts[tuple(tuple(h.trgt_sentence) for h in hypos)] += 1
+        for hypo in hypos:
+            lprobs[tuple(hypo.trgt_sentence)] = hypo.base_score
+    return counts, lprobs
+
+
+def _check_swor_pairs(counts, lprobs):
+    """The first sample is drawn from p, the second from p without the
+    first one: P(y1, y2) = p(y1) p(y2) / (1 - p(y1))."""
+    runs = sum(counts.values())
+    p = dict((y, np.exp(lprob)) for y, lprob in lprobs.items())
+    assert np.isclose(sum(p.values()), 1.)
+    for (y1, y2), count in counts.items():
+        assert y1 != y2
+        want = p[y1] * p[y2] / (1. - p[y1])
+        assert abs(count / runs - want) < 5 * np.sqrt(want * (1 - want) / runs)
+
+
+def test_swor_sampling():
+    import copy
+    import logging
+
+    decoder_args = copy.copy(args)
+    level = logging.getLogger().level
+    limit = sys.getrecursionlimit()
+    logging.getLogger().setLevel(logging.WARN)
+    try:
+        pairs = {}
+        for name in ["basic_swor", "swor"]:
+            pairs[name] = _swor_pairs(copy.copy(decoder_args), name)
+            _check_swor_pairs(*pairs[name])
+        # Both decoders consume the random numbers in the same order
+        assert pairs["basic_swor"][0] == pairs["swor"][0]
+        # Paths are longer than the recursion limit. Other tests (e.g.
+        # arsenal imports) may have raised it, so it is set here.
+        decoder_args.nbest = 2
+        decoder_args.max_len_factor = 1.
+        sys.setrecursionlimit(1000)
+        for name in ["basic_swor", "swor", "mem_eff_swor"]:
+            hypos = _dummy_decoder(decoder_args, name).decode(list(range(1500)))
+            assert len(hypos) == 2
+            assert all(len(h.trgt_sentence) > 1000 for h in hypos)
+    finally:
+        sys.setrecursionlimit(limit)
+        logging.getLogger().setLevel(level)
+
+
+def test_swor_snapshot():
+    import copy
+
+    class CountingPredictor(DummyPredictor):
+        """Counts ``initialize()`` calls. With ``reinitialize``,
+        ``restore()`` initializes the predictor again, which is what
+        the SWOR decoders did before snapshots."""
+
+        def __init__(self, reinitialize):
+            super(CountingPredictor, self).__init__(SEED, vocab_size=VOCAB_SIZE)
+            self.reinitialize = reinitialize
+            self.initialized = 0
+
+        def initialize(self, src_sentence):
+            super(CountingPredictor, self).initialize(src_sentence)
+            self.initialized += 1
+
+        def restore(self, snapshot):
+            if self.reinitialize:
+                self.initialize(self.src)
+            else:
+                super(CountingPredictor, self).restore(snapshot)
+
+    decoder_args = copy.copy(args)
+    decoder_args.nbest = 10
+    src = [4, 5, 6]
+    for name in ["basic_swor", "swor", "mem_eff_swor"]:
+        samples = []
+        for reinitialize in [False, True]:
+            decoder = decoding.DECODER_REGISTRY[name](decoder_args)
+            predictor = CountingPredictor(reinitialize)
+            decoder.add_predictor("dummy", predictor)
+            hypos = decoder.decode(src)
+            assert len(hypos) == 10
+            samples.append([(h.trgt_sentence, h.total_score) for h in hypos])
+        assert samples[0] == samples[1], name
+        # One encoder pass per sentence, not one per sample
+        decoder.predictor.reinitialize = False
+        decoder.predictor.initialized = 0
+        decoder.decode(src)
+        assert decoder.predictor.initialized == 1, name
+
+
+def test_swor_batch():
+    import copy
+    import logging
+
+    decoder_args = copy.copy(args)
+    decoder_args.swor_batch = 4
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.WARN)
+    try:
+        for name in ["basic_swor", "swor"]:
+            _check_swor_pairs(*_swor_pairs(copy.copy(decoder_args), name))
+            # More samples than one walk draws, all distinct
+            decoder_args.nbest = 30
+            hypos = _dummy_decoder(decoder_args, name).decode([4, 5, 6])
+            assert len(hypos) == 30
+            assert len(set(tuple(h.trgt_sentence) for h in hypos)) == 30
+    finally:
+        logging.getLogger().setLevel(level)
+
+
+def test_mem_eff_swor():
+    import copy
+    import logging
+    from decoding.swor import MemEfficientSworDecoder, PrefixIndex
+
+    rng = np.random.RandomState(0)
+    x = np.log(rng.uniform(size=1000))
+    y = x + np.log(rng.uniform(size=1000))
+    y[:10] = x[:10]
+    y[10:20] = utils.NEG_INF
+    want = [utils.log_minus(a, b) for a, b in zip(x, y)]
+    assert utils.log_minus_array(x, y).tolist() == want
+
+    # Adjustments against dicts keyed by prefix tuples
+    decoder_args = copy.copy(args)
+    for ids in [np.arange(20), np.sort(rng.choice(100, 20, replace=False))]:
+        decoder = MemEfficientSworDecoder(decoder_args)
+        decoder.prefixes = PrefixIndex()
+        adjustments = collections.defaultdict(dict)
+        for _ in range(200):
+            prefix = tuple(rng.choice(ids, rng.randint(0, 3)))
+            word = int(rng.choice(ids))
+            lmass = np.log(rng.uniform(0., 0.001))
+            prefix_id = PrefixIndex.ROOT
+            for w in prefix:
+                prefix_id = decoder.prefixes.child(prefix_id, w)
+            decoder.prefixes.add(prefix_id, word, lmass)
+            old = adjustments[prefix].get(word, utils.NEG_INF)
+            adjustments[prefix][word] = utils.log_add(lmass, old)
+            lprobs = utils.log_softmax(rng.normal(scale=0.1, size=len(ids)))
+            want = np.copy(lprobs)
+            for w, mass in adjustments[prefix].items():
+                i = utils.binary_search(ids, w)
+                want[i] = utils.log_minus(want[i], mass)
+            got = decoder.adjust_probabilities(lprobs, prefix_id, ids)
+            assert got.tolist() == want.tolist()
+
+    # Same samples as the decoder which keeps its adjustments in the trie
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.WARN)
+    try:
+        pairs = _swor_pairs(copy.copy(decoder_args), "mem_eff_swor")
+        _check_swor_pairs(*pairs)
+        assert pairs == _swor_pairs(copy.copy(decoder_args), "basic_swor")
+    finally:
+        logging.getLogger().setLevel(level)
+    decoder_args.nbest = 20
+    samples = [[(h.trgt_sentence, h.total_score) for h in
+                _dummy_decoder(decoder_args, name).decode([4, 5, 6])]
+               for name in ["mem_eff_swor", "basic_swor"]]
+    assert samples[0] == samples[1]
+
+
+def test_sum_heap():
+    import copy
+    import logging
+    from datastructures.sum_heap import SumHeap
+
+    rng = np.random.RandomState(0)
+    for log_space in [False, True]:
+        for n in [1, 7, 64, 1000]:
+            w = rng.uniform(size=n)
+            if log_space:
+                w = np.log(w)
+            heap = SumHeap(w.copy(), log_space=log_space)
+            total = np.logaddexp.reduce(w) if log_space else w.sum()
+            assert np.isclose(heap.S[1], total)
+            buf = np.full(SumHeap.buffer_size(n),
+                          utils.NEG_INF if log_space else 0.)
+            buf[heap.d:heap.d+n] = w
+            assert np.array_equal(
+                SumHeap.from_buffer(buf, n, log_space=log_space).S, heap.S)
+            # update_many sets the same buffer as update in a loop
+            other = SumHeap(w.copy(), log_space=log_space)
+            ks = rng.randint(n, size=min(n, 20))
+            vs = rng.uniform(size=len(ks))
+            if log_space:
+                vs = np.log(vs)
+            for k, v in zip(ks, vs):
+                heap.update(int(k), v)
+            # Later duplicates win, like in the loop
+            last = dict(zip(ks.tolist(), range(len(ks))))
+            keep = np.array(sorted(last.values()))
+            other.update_many(ks[keep], vs[keep])
+            # S[0] is unused
+            assert np.array_equal(np.asarray(heap.S)[1:], np.asarray(other.S)[1:])
+            # sample_many draws the same indices as sample per uniform
+            us = rng.uniform(size=200)
+            want = [heap.sample(np.log(u) if log_space else u) for u in us]
+            assert np.asarray(heap.sample_many(us)).tolist() == want
+            # sample() is reproducible with np.random's seed
+            np.random.seed(1)
+            first = [heap.sample() for _ in range(10)]
+            np.random.seed(1)
+            assert [heap.sample() for _ in range(10)] == first
+
+    # Batched walks with SparseDist split counts with sample_many()
+    decoder_args = copy.copy(args)
+    decoder_args.swor_batch = 4
+    decoder_args.swor_topk = 2
+    level = logging.getLogger().level
+    logging.getLogger().setLevel(logging.WARN)
+    try:
+        _check_swor_pairs(*_swor_pairs(decoder_args, "swor"))
+    finally:
+        logging.getLogger().setLevel(level)
+
+
+def test_poisson_consts():
+    def check(log_lambdas, desired_k, c):
+        """The inclusion probabilities min(1, c*lambda) sum to desired_k
+        times the mass, or include all candidates."""
+        log_lambdas = np.asarray(log_lambdas)
+        target = min(desired_k * np.exp(np.logaddexp.reduce(log_lambdas)),
+                     np.isfinite(log_lambdas).sum())
+        size = np.minimum(1., c * np.exp(log_lambdas)).sum()
+        assert abs(size - target) <= 1e-6 * max(1., target), (size, target)
+
+    # Peaked log-softmax for which c*lambda_max rounds to exactly 1 at
+    # the root with desired_k=5. A strict bound used to include all
+    # candidates (c=1.3e49, expected size 10).
+    peaked = [-9.741040439235277, -32.33502140277393, -71.79259715158852,
+              -79.87554216429916, -65.38529892480476, -64.5896801168321,
+              -27.899954814089654, -26.762109628657427, -5.8821038159351247e-05,
+              -113.09811687263075]
+    for desired_k in [1, 5, 9, 10, 20]:
+        check(peaked, desired_k, sampling_utils.get_const(peaked, desired_k))
+    rng = np.random.RandomState(SEED)
+    for _ in range(3000):
+        desired_k = rng.choice([1, 2, 5, 10, 40])
+        log_lambdas = []
+        for _ in range(3): # Batches of distributions of different lengths
+            logits = rng.randn(rng.randint(1, 30)) * rng.uniform(0.1, 60.)
+            log_lambdas.append(logits - np.logaddexp.reduce(logits)
+                               + np.log(rng.uniform(0.3, 1.)))
+        consts = sampling_utils.get_consts(log_lambdas, desired_k)
+        for l, c in zip(log_lambdas, consts):
+            check(l, desired_k, c)
+
+
+def test_inclusion_prob_estimates():
+    import atexit
+    import copy
+    import pickle
+
+    decoder_args = copy.copy(args)
+    decoder_args.nbest = 3
+    decoder_args.inc_prob_estimate_rounds = 4
+    src = [4, 5, 6]
+    estimates = []
+    for workers in [0, 2]:
+        for combined in [False, True]:
+            decoder_args.inc_prob_workers = workers
+            decoder_args.inc_prob_combined = combined
+            decoder = _dummy_decoder(decoder_args, "cp_swor")
+            hypos = decoder.decode(src)
+            # The same sample twice gets independent rounds
+            hypos = hypos + hypos[:1]
+            try:
+                estimates.append(decoder.get_inclusion_prob_estimates(src, hypos))
+            finally:
+                decoder.shutdown_pool()
+            assert decoder.pool is None
+    assert np.isfinite(estimates[0]).all()
+    assert estimates[0][0] != estimates[0][-1]
+    # Estimates do not depend on where and in which tasks rounds run
+    for other in estimates[1:]:
+        assert np.array_equal(estimates[0], other)
+    # Workers get a description of the decoder, not the decoder
+    spec = pickle.loads(pickle.dumps(decoder.estimate_worker_spec()))
+    assert spec[0] == "cp_swor" and isinstance(spec[3], DummyPredictor)
+    # A pool which is shut down leaves no exit handler behind
+    handlers = []
+    register, unregister = atexit.register, atexit.unregister
+    atexit.register = lambda func: handlers.append(func) or register(func)
+    atexit.unregister = lambda func: handlers.remove(func) or unregister(func)
+    try:
+        for _ in range(2):
+            decoder.get_inclusion_prob_estimates(src, hypos)
+            assert len(handlers) == 1
+            decoder.shutdown_pool()
+            assert handlers == []
+    finally:
+        atexit.register, atexit.unregister = register, unregister
+        decoder.shutdown_pool()
+
+
+def test_gumbel_inclusion_probs():
+    import copy
+    import shutil
+    import tempfile
+    import decode_utils
+    import io_utils
+
+    from decimal import Decimal, getcontext
+
+    x = np.array([-1e4, -60., -40.5, -40., -39.5, -10., -1., -0.7, -0.5,
+                  0., 0.5, 3., 30., 700., 710., 1e4])
+    with np.errstate(over='ignore', divide='ignore'):
+        want = np.log(-np.expm1(-np.exp(x)))
+    # exp(x) underflows, and the exact value is x up to rounding
+    want[x < -700] = x[x < -700]
+    for kappa in [0., -3.5]:
+        got = sampling_utils.gumbel_inclusion_log_probs(x + kappa, kappa)
+        # For large x, 1 - exp(-exp(x)) rounds in the reference
+        assert np.allclose(got, want, rtol=1e-12, atol=1e-15)
+    assert (got[x >= 710] == 0).all()
+    getcontext().prec = 50
+    for v, log_prob in zip(x.tolist(), got.tolist()):
+        if -100 < v < 30:
+            exact = float((1 - (-Decimal(v).exp()).exp()).ln())
+            assert np.isclose(log_prob, exact, rtol=1e-13, atol=0), v
+    y = -np.exp(np.linspace(-10, 5, 200))
+    assert np.allclose(utils.log1mexp_array(y), np.log(-np.expm1(y)),
+                       rtol=1e-12, atol=1e-15)
+    assert utils.log1mexp_array(y).tolist() == [utils.log1mexp(v) for v in y]
+
+    class FixedHyposDecoder(object):
+        """Returns the same Gumbel top-k samples for each sentence."""
+        def __init__(self, decoder, hypos):
+            self.decoder = decoder
+            self.hypos = hypos
+        def decode(self, src):
+            return list(self.hypos)
+        def __getattr__(self, name):
+            return getattr(self.decoder, name)
+
+    class RecordingEstimator(estimators.Estimator):
+        name = 'recording'
+        def __init__(self, args):
+            super(RecordingEstimator, self).__init__(args)
+            self.calls = []
+        def add_values(self, hypos, weights, **kwargs):
+            self.calls.append((hypos, weights))
+            values = [0.] * len(hypos)
+            self.increment_batch(values, weights)
+            return values
+
+    decode_args = copy.copy(args)
+    decode_args.range = ""
+    decode_args.nbest = 3
+    decode_args.no_normalization = False
+    decode_utils.args = decode_args
+    io_utils.initialize(decode_args)
+    # The smallest perturbed score, 0, is the threshold kau
+    hypos = [decoding.core.Hypothesis([4, 5], 2.0, [-1.0], base_score=-1.0),
+             decoding.core.Hypothesis([6], 0.0, [-2.0], base_score=-2.0),
+             decoding.core.Hypothesis([7], 1.5, [-3.0], base_score=-3.0)]
+    greedy = _dummy_decoder(decode_args, 'greedy')
+    greedy.gumbel = True
+    estimator = RecordingEstimator(decode_args)
+    tmp_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmp_dir) # Estimate files go to the working directory
+        decode_utils.do_decode(FixedHyposDecoder(greedy, hypos), [], ["4 5"],
+                               estimator=estimator)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+    [(samples, weights)] = estimator.calls
+    assert samples == [hypos[0], hypos[2]]
+    base = np.array([-1.0, -3.0])
+    assert np.allclose(weights, base - np.log(-np.expm1(-np.exp(base))))
+    assert np.allclose(greedy.get_inclusion_prob_estimates([4, 5], samples, kau=0.),
+                       np.log(-np.expm1(-np.exp(base))))
+
+
 args = get_args()
 base_init(args)
 
 if not args.decoder:
-    test_sampling()
+    test_streaming_output()
+    test_output_flush()
+    test_binary_nbest()
+    test_ngram_posteriors()
+    test_server_batching()
+    test_async_server_batching()
+    test_lazy_imports()
+    test_binary_source()
+    test_bpe()
+    test_batch_encode_decode()
+    test_compiled_wmaps()
+    test_sentence_bleu()
+    test_id_bleu()
+    test_ngram_diversity()
+    test_estimators()
+    test_swor_trie()
+    test_sparse_dist()
+    test_swor_memory()
+    test_swor_sampling()
+    test_swor_snapshot()
+    test_swor_batch()
+    test_mem_eff_swor()
+    test_sum_heap()
+    test_poisson_consts()
+    test_inclusion_prob_estimates()
+    test_gumbel_inclusion_probs()
+    # These need sampling_utils.log_sample_k_dpp and utils.log_minus_old,
+    # which this tree does not have yet
     test_utils()
+    test_sampling()
     exit(0)
 
 random.seed(SEED)
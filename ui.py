@@ -117,6 +117,14 @@ def get_parser():
                         "a plain text file with one source sentence in each "
                         "line. Words need to be indexed, i.e. use word IDs "
                         "instead of their string representations.")
+    group.add_argument("--src_test_bin", default="",
+                        help="Path to a preprocessed binary source test set "
+                        "created with preprocess.py. If set, it is used "
+                        "instead of --src_test in 'file' mode. The sentences "
+                        "are already encoded and the file is memory-mapped, "
+                        "so decoding any --range starts without reading and "
+                        "tokenizing the full test set. For preprocess.py, "
+                        "this is the output path.")
     group.add_argument("--trgt_test", default="",
                         help="Path to source test set. This is expected to be "
                         "a plain text file with one source sentence in each "
@@ -131,14 +139,20 @@ def get_parser():
                        help="SGNMT terminates when a sanity check fails by "
                        "default. Set this to true to ignore sanity checks.")
     group.add_argument("--input_method", default="file",
-                        choices=['dummy', 'file', 'shell', 'stdin'],
+                        choices=['dummy', 'file', 'shell', 'stdin', 'server',
+                                 'async_server'],
                         help="This parameter controls how the input to SGNMT "
-                        "is provided. SGNMT supports three modes:\n\n"
+                        "is provided. SGNMT supports these modes:\n\n"
                         "* 'dummy': Use dummy source sentences.\n"
                         "* 'file': Read test sentences from a plain text file"
                             "specified by --src_test.\n"
                         "* 'shell': Start SGNMT in an interactive shell.\n"
-                        "* 'stdin': Test sentences are read from stdin\n\n"
+                        "* 'stdin': Test sentences are read from stdin\n"
+                        "* 'server': Keep the model loaded and decode JSON "
+                            "requests received on --server_address.\n"
+                        "* 'async_server': Like 'server', but decode many "
+                            "requests concurrently and batch their model "
+                            "calls.\n\n"
                         "In shell and stdin mode you can change SGNMT options "
                         "on the fly: Beginning a line with the string '!sgnmt '"
                         " signals SGNMT directives instead of sentences to "
@@ -149,6 +163,25 @@ def get_parser():
                         " with MERT to avoid start up times between "
                         "evaluations. Note that input sentences still have to "
                         "be written using word ids in all cases.")
+    group.add_argument("--server_address", default="localhost:8731",
+                        help="Address the server listens on if --input_method "
+                        "is 'server' or 'async_server'. Either '<host>:<port>' "
+                        "for a TCP socket or 'unix:<path>' for a Unix domain "
+                        "socket. See the "
+                        "server module for the request format.")
+    group.add_argument("--server_max_batch", default=8, type=int,
+                        help="Maximum number of queued requests the server "
+                        "decodes together. Model calls of requests with the "
+                        "same decoder configuration are batched. For "
+                        "'async_server', the maximum "
+                        "number of model calls evaluated in one batch.")
+    group.add_argument("--server_batch_wait", default=5.0, type=float,
+                        help="Time in milliseconds the server waits for "
+                        "further requests after receiving the first request "
+                        "of a batch.")
+    group.add_argument("--server_max_concurrent", default=16, type=int,
+                        help="Maximum number of requests the 'async_server' "
+                        "decodes concurrently.")
     group.add_argument("--log_sum",  default="log",
                         choices=['tropical', 'log'],
                         help="Controls how to compute the sum in the log "
@@ -209,6 +242,12 @@ def get_parser():
                         help="Report estimates for statistics during decoding")
     group.add_argument("--estimator_iterations", default=1, type=int,
                         help="Number of times to build estimator (for reporting variance)")
+    group.add_argument("--estimator_format", default="csv", choices=['csv', 'bin'],
+                        help="Format of the estimator samples file, which is "
+                        "written while decoding. 'bin' appends fixed size "
+                        "binary records (see estimators.SAMPLE_DTYPE). A "
+                        "CSV summary with estimates, effective sample sizes "
+                        "and confidence intervals is written in both cases.")
     group.add_argument("--length_norm", default=False, type='bool',
                         help="Use length normalization when decoding")
     
@@ -233,11 +272,35 @@ def get_parser():
                         "output to individual files based off of 'output_path'\n"
                         "* 'score': writes scores of hypotheses to file; output "
                         "is line-by-line.\n"
+                        "* 'nbest_bin': Full n-best lists in a columnar binary "
+                        "format which can be memory-mapped with "
+                        "binary_nbest.BinaryNBestReader.\n"
                         "* 'ngram': MBR-style n-gram posteriors.\n\n"
                         "For extract_scores_along_reference.py, select "
                         "one of the following output formats:\n"
                         "The path to the output files can be specified with "
                         "--output_path")
+    group.add_argument("--output_flush_every", default=1, type=int,
+                        help="Flush output files after this many sentences. "
+                        "Set to 0 to flush only when decoding finishes or "
+                        "--output_flush_interval has passed. Output files are"
+                        " always flushed when SGNMT terminates or receives "
+                        "SIGINT, SIGTERM or SIGHUP.")
+    group.add_argument("--output_flush_interval", default=0.0, type=float,
+                        help="Flush output files if at least this many "
+                        "seconds have passed since the last flush. Set to 0 "
+                        "to disable time-based flushing.")
+    group.add_argument("--min_order", default=1, type=int,
+                        help="Minimum order of ngrams extracted by the "
+                        "'ngram' output handler.")
+    group.add_argument("--max_order", default=4, type=int,
+                        help="Maximum order of ngrams extracted by the "
+                        "'ngram' output handler.")
+    group.add_argument("--ngram_workers", default=0, type=int,
+                        help="Number of worker processes which compute and "
+                        "write the files of the 'ngram' output handler in "
+                        "parallel to decoding. Set to 0 to write them in the "
+                        "main process.")
     group.add_argument("--remove_eos", default=True, type='bool',
                         help="Whether to remove </S> symbol on output.")
     group.add_argument("--src_wmap", default="",
@@ -270,6 +333,14 @@ def get_parser():
     group.add_argument("--bpe_codes", default="",
                         help="Must be set if preprocessing=bpe. Path to the "
                         "BPE codes file from Sennrich's subword_nmt.")
+    group.add_argument("--bpe_cache_size", default=100000, type=int,
+                        help="Maximum number of words whose BPE segmentation "
+                        "is kept in memory (least recently used words are "
+                        "evicted first).")
+    group.add_argument("--bpe_cache_path", default="",
+                        help="Path to an SQLite database in which BPE "
+                        "segmentations are cached across runs. Can be shared "
+                        "by worker processes which use the same codes.")
     group.add_argument("--add_incomplete", default=False, type='bool',
                         help="If nbest hypotheses are not found, add incomplete "
                         "hypotheses to output")
@@ -2,12 +2,13 @@ import operator
 import logging
 import os
 import sys
+import importlib
+import itertools
 from bisect import bisect_left 
+from collections.abc import Mapping
 from functools import reduce  
-import sacrebleu
 
 import numpy as np
-from scipy.special import logsumexp
 
 # Reserved IDs
 GO_ID = 1
@@ -64,6 +65,58 @@ def switch_to_t2t_indexing():
     UNK_ID = 3 # Don't rely on this: UNK not standardized in T2T
 
 
+# Lazy imports
+
+
+class LazyRegistry(Mapping):
+    """Read-only mapping from registry names to classes which imports
+    the module defining a class only when the class is looked up. The
+    names are recorded statically, so listing them (e.g. for argparse
+    choices) does not import anything. This keeps heavy dependencies
+    of unused decoders, predictors and estimators out of the start up
+    time.
+    """
+
+    def __init__(self, package, entries):
+        """
+        Args:
+            package (string): Package containing the modules
+            entries (dict): Maps registry names to 'module.ClassName'
+                            relative to ``package``
+        """
+        self.package = package
+        self.entries = entries
+        self.classes = {}
+
+    def __getitem__(self, name):
+        if name not in self.classes:
+            module_name, cls_name = self.entries[name].rsplit('.', 1)
+            module = importlib.import_module(
+                "%s.%s" % (self.package, module_name))
+            cls = getattr(module, cls_name)
+            if getattr(cls, 'name', None) != name:
+                raise ValueError("Class %s is registered as '%s' but its "
+                                 "`name` attribute is %s" % (
+                                     cls_name, name, getattr(cls, 'name', None)))
+            self.classes[name] = cls
+        return self.classes[name]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def logsumexp(*args, **kwargs):
+    """``scipy.special.logsumexp``. scipy is imported on the first
+    call since importing it takes a considerable part of the start up
+    time.
+    """
+    from scipy.special import logsumexp as scipy_logsumexp
+    return scipy_logsumexp(*args, **kwargs)
+
+
 # Log summation
 
 
@@ -248,6 +301,28 @@ def log_minus(x, y):
     else:
         return x + log1mexp(y-x)
 
+def log1mexp_array(x):
+    """
+    Vectorized version of ``log1mexp()``.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(x >= -0.693, np.log(-np.expm1(x)), np.log1p(-np.exp(x)))
+
+def log_minus_array(x, y):
+    """
+    Vectorized version of ``log_minus()``. Subtracts ``y`` from ``x``
+    elementwise in log space using the same numerically stable
+    log1mexp as ``log1mexp()``.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        d = y - x
+        diff = x + log1mexp_array(d)
+    if (d > MACHINE_EPS).any():
+        logging.warn("Using function log_minus for invalid values")
+    diff[x == y] = NEG_INF
+    return diff
+
 def logsigmoid(x):
     """
     log(sigmoid(x)) = -log(1+exp(-x)) = -log1pexp(-x)
@@ -395,20 +470,61 @@ def ngrams(sen, n):
         output.append(tuple(sen[i:i+n]))
     return output
 
+def _distinct_ngram_counts(hypos, max_order):
+    """Returns the number of distinct n-grams and the total number of
+    n-grams in ``hypos`` for n = 1..max_order. ``hypos`` are strings
+    (split at single spaces like ``ngrams()``) or token ID sequences.
+    """
+    if len(hypos) and isinstance(hypos[0], str):
+        word_ids = {}
+        hypos = [[word_ids.setdefault(w, len(word_ids)) for w in h.split(' ')]
+                 for h in hypos]
+        matrix, lengths = token_matrix(hypos)
+        num_words = len(word_ids)
+    else:
+        matrix, lengths = token_matrix(hypos)
+        # Dense IDs keep the packed n-gram codes collision-free
+        mask = np.arange(matrix.shape[1]) < lengths[:, None]
+        tokens = matrix[mask]
+        order = np.argsort(tokens)
+        new_word = np.ones(tokens.size, dtype=bool)
+        new_word[1:] = tokens[order[1:]] != tokens[order[:-1]]
+        dense = np.empty_like(tokens)
+        dense[order] = np.cumsum(new_word) - 1
+        matrix[mask] = dense
+        num_words = int(new_word.sum())
+    bits = max(1, num_words.bit_length())
+    distinct = np.zeros(max_order, dtype=np.int64)
+    total = np.zeros(max_order, dtype=np.int64)
+    for n in range(1, max_order + 1):
+        counts = np.maximum(lengths - n + 1, 0)
+        total[n-1] = counts.sum()
+        if not total[n-1]:
+            continue
+        valid = np.arange(matrix.shape[1] - n + 1) < counts[:, None]
+        if bits * n <= 62:
+            codes = np.sort(ngram_codes(matrix, n, bits)[valid])
+            distinct[n-1] = 1 + np.count_nonzero(codes[1:] != codes[:-1])
+        else:
+            windows = np.lib.stride_tricks.sliding_window_view(
+                matrix, n, axis=1)[valid]
+            distinct[n-1] = len(np.unique(windows, axis=0))
+    return distinct, total
+
+
 def distinct_ngrams(hypos, n):
-    total_ngrams = 0
-    distinct = []
-    for h in hypos:
-        all_ngrams = ngrams(h, n)
-        total_ngrams += len(all_ngrams)
-        distinct.extend(all_ngrams)
-    
-    if len(distinct) == 0:
+    """Fraction of distinct n-grams among all n-grams in ``hypos``
+    (strings or token ID sequences)."""
+    distinct, total = _distinct_ngram_counts(hypos, n)
+    if total[n-1] == 0:
         return 0
-    return float(len(set(distinct)))/len(distinct)
+    return float(distinct[n-1])/total[n-1]
 
 def ngram_diversity(hypos):
-    ds = [distinct_ngrams(hypos, i) for i in range(1,5)]
+    """Average of ``distinct_ngrams()`` for n = 1..4, computed for all
+    orders in one pass over a token matrix."""
+    distinct, total = _distinct_ngram_counts(hypos, 4)
+    ds = [float(d)/t if t else 0 for d, t in zip(distinct.tolist(), total.tolist())]
     return sum(ds)/4
 
 def hamming_distance(hypo, other_hypos, pad=-1):
@@ -432,16 +548,289 @@ def hamming_distance(hypo, other_hypos, pad=-1):
 def sentence_bleu(sentence, reference, detokenizer=None):
     """
     Utility function for calculating sentence BLEU. 
-    Expects sentence and reference as list of tokens.
-    Reference may be list of multiple references
+    Expects sentence and reference as strings of space separated
+    tokens. Reference may be list of multiple references.
+    Use ``SentenceBleuScorer`` to score many sentences against the
+    same reference.
+    """
+    return SentenceBleuScorer(reference, detokenizer).score(sentence)
+
+
+def _score_sentences(scorer, sentences):
+    return [scorer.score_detokenized(s) for s in sentences]
+
+
+class SentenceBleuScorer(object):
+    """Sentence BLEU of many hypotheses against the same reference(s).
+    Scores are identical to ``sacrebleu.sentence_bleu``, but the
+    references are detokenized and their n-gram counts are extracted
+    only once by letting sacrebleu cache them.
     """
-    if not isinstance(reference[0], list):
-        reference = [reference]
-    if detokenizer is not None:
-        sentence = detokenizer(sentence.split())
-        reference = [detokenizer(r.split()) for r in reference]
 
-    return sacrebleu.sentence_bleu(sentence, [reference]).score
+    def __init__(self, reference, detokenizer=None):
+        """Prepares the reference statistics.
+
+        Args:
+            reference (string|list): Reference or list of references,
+                                     strings of space separated tokens
+            detokenizer (callable): If not None, applied to the token
+                                    lists of references and hypotheses
+        """
+        from sacrebleu.metrics import BLEU
+
+        if isinstance(reference, str):
+            reference = [reference]
+        if detokenizer is not None:
+            reference = [detokenizer(r.split()) for r in reference]
+        self.detokenizer = detokenizer
+        # One reference stream per reference, each a single segment
+        self.metric = BLEU(effective_order=True,
+                           references=[[r] for r in reference])
+
+    def __getstate__(self):
+        # Detokenizers often wrap a subprocess and cannot be pickled.
+        # Worker processes only get detokenized sentences anyway.
+        state = dict(self.__dict__)
+        state['detokenizer'] = None
+        return state
+
+    def score_detokenized(self, sentence):
+        """Sentence BLEU of an already detokenized sentence."""
+        return self.metric.corpus_score([sentence], None).score
+
+    def score(self, sentence):
+        """Sentence BLEU of ``sentence`` (space separated tokens)."""
+        if self.detokenizer is not None:
+            sentence = self.detokenizer(sentence.split())
+        return self.score_detokenized(sentence)
+
+    def score_batch(self, sentences, executor=None):
+        """Sentence BLEU of a list of sentences.
+
+        Args:
+            sentences (list): Strings of space separated tokens
+            executor (Executor): If not None, a thread or process pool
+                                 from ``concurrent.futures`` which
+                                 scores the sentences in chunks.
+
+        Returns:
+            list. BLEU scores in the order of ``sentences``
+        """
+        if self.detokenizer is not None:
+            sentences = [self.detokenizer(s.split()) for s in sentences]
+        if executor is None or len(sentences) < 2:
+            return _score_sentences(self, sentences)
+        num_chunks = min(len(sentences), getattr(executor, '_max_workers', 1))
+        size = (len(sentences) + num_chunks - 1) // num_chunks
+        futures = [executor.submit(_score_sentences, self, sentences[i:i+size])
+                   for i in range(0, len(sentences), size)]
+        return [score for future in futures for score in future.result()]
+
+def token_matrix(seqs, pad=-1):
+    """Packs token ID sequences into a padded matrix.
+
+    Args:
+        seqs (list): Sequences of token IDs
+        pad (int): Value of padding entries
+
+    Returns:
+        (ndarray, ndarray). int64 matrix with one row per sequence
+        and the lengths of the sequences
+    """
+    lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64,
+                          count=len(seqs))
+    width = int(lengths.max()) if len(seqs) else 0
+    matrix = np.full((len(seqs), width), pad, dtype=np.int64)
+    num_tokens = int(lengths.sum())
+    if num_tokens:
+        matrix[np.arange(width) < lengths[:, None]] = np.fromiter(
+            itertools.chain.from_iterable(seqs), dtype=np.int64,
+            count=num_tokens)
+    return matrix, lengths
+
+
+def ngram_codes(matrix, n, bits):
+    """Packs the n-grams of each row of ``matrix`` into int64 codes,
+    ``bits`` bits per token. Tokens must be in [0, 2**bits).
+
+    Returns:
+        ndarray. Codes of shape (rows, max(0, cols-n+1)). The code at
+        position j is the n-gram starting at column j.
+    """
+    width = matrix.shape[1] - n + 1
+    if width <= 0:
+        return np.zeros((matrix.shape[0], 0), dtype=np.int64)
+    codes = matrix[:, :width].copy()
+    for k in range(1, n):
+        codes |= matrix[:, k:k+width] << (bits * k)
+    return codes
+
+
+def bleu_from_stats(stats, max_order=4):
+    """Vectorized version of sacrebleu's sentence BLEU (exponential
+    smoothing, effective order) from match statistics.
+
+    Args:
+        stats (ndarray): Matrix with rows [hyp_len, ref_len,
+                         correct_1..max_order, total_1..max_order]
+
+    Returns:
+        ndarray. BLEU scores (0-100), one per row
+    """
+    stats = np.asarray(stats, dtype=np.float64).reshape(-1, 2 + 2*max_order)
+    sys_len, ref_len = stats[:, 0], stats[:, 1]
+    correct = stats[:, 2:2+max_order]
+    total = stats[:, 2+max_order:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bp = np.where(sys_len < ref_len,
+                      np.exp(1. - ref_len / np.maximum(sys_len, 1.)), 1.)
+        bp[sys_len == 0] = 0.
+        # Each n-gram order without matches halves the smoothed precision
+        smooth = np.cumprod(np.where(correct == 0, 2., 1.), axis=1)
+        precisions = np.where(correct > 0, 100. * correct / total,
+                              100. / (smooth * total))
+        log_precisions = np.log(precisions)
+    eff_order = (total > 0).sum(axis=1)
+    log_sum = np.zeros(len(stats))
+    for n in range(max_order):
+        log_sum += np.where(n < eff_order, log_precisions[:, n], 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = bp * np.exp(log_sum / eff_order)
+    scores[(correct == 0).all(axis=1) | (eff_order == 0)] = 0.
+    return scores
+
+
+class IdBleuScorer(object):
+    """Sentence BLEU on token IDs. The reference n-gram table is
+    precomputed once, and the clipped n-gram counts of a whole n-best
+    list are computed with numpy. The result is identical to
+    ``sacrebleu.sentence_bleu`` with ``tokenize='none'`` on the token
+    sequences, i.e. BLEU is computed over whatever the IDs represent
+    (subwords, or words after merging BPE).
+
+    Tokens are replaced by their rank in the reference vocabulary
+    (0 for tokens which are not in any reference), so n-grams can be
+    packed into int64 codes without collisions.
+    """
+
+    def __init__(self, references, max_order=4):
+        """Builds the reference n-gram table.
+
+        Args:
+            references (list): Reference or list of references, each a
+                               sequence of token IDs
+            max_order (int): Maximum n-gram order
+
+        Raises:
+            ValueError. If the references have too many distinct tokens
+                        to pack ``max_order``-grams into 62 bits
+        """
+        if len(references) == 0 or np.isscalar(references[0]):
+            references = [references]
+        self.max_order = max_order
+        refs, ref_lens = token_matrix(references)
+        self.ref_lens = np.sort(ref_lens)
+        self.vocab = np.unique(refs[refs >= 0])
+        self.bits = max(1, int(self.vocab.size).bit_length())
+        if self.bits * max_order > 62:
+            raise ValueError("Too many distinct reference tokens (%d) for "
+                             "%d-gram codes" % (self.vocab.size, max_order))
+        ranks = self.ranks(refs)
+        self.ref_codes = []
+        self.ref_counts = []
+        for n in range(1, max_order + 1):
+            codes = ngram_codes(ranks, n, self.bits)
+            valid = np.arange(codes.shape[1]) < (ref_lens - n + 1)[:, None]
+            # Clip with the maximum count over all references
+            rows, counts = [], []
+            for row, row_valid in zip(codes, valid):
+                c, cnt = np.unique(row[row_valid], return_counts=True)
+                rows.append(c)
+                counts.append(cnt)
+            codes = np.concatenate(rows)
+            counts = np.concatenate(counts)
+            order = np.lexsort((-counts, codes))
+            codes, counts = codes[order], counts[order]
+            first = np.ones(len(codes), dtype=bool)
+            first[1:] = codes[1:] != codes[:-1]
+            self.ref_codes.append(codes[first])
+            self.ref_counts.append(counts[first])
+
+    def ranks(self, matrix):
+        """Maps token IDs to their reference vocabulary rank (1-based),
+        and tokens outside the reference vocabulary to 0."""
+        if self.vocab.size == 0:
+            return np.zeros_like(matrix)
+        idx = np.searchsorted(self.vocab, matrix)
+        idx_clipped = np.minimum(idx, self.vocab.size - 1)
+        return np.where(self.vocab[idx_clipped] == matrix, idx_clipped + 1, 0)
+
+    def stats(self, hypos, lengths=None):
+        """Computes the BLEU match statistics of all hypotheses.
+
+        Args:
+            hypos (list|ndarray): Sequences of token IDs, or a padded
+                                  matrix if ``lengths`` is given
+            lengths (ndarray): Lengths of the rows of ``hypos``
+
+        Returns:
+            ndarray. int64 matrix with rows [hyp_len, ref_len,
+            correct_1..max_order, total_1..max_order]
+        """
+        if lengths is None:
+            hypos, lengths = token_matrix(hypos)
+        lengths = np.asarray(lengths, dtype=np.int64)
+        num_hypos = len(lengths)
+        ranks = self.ranks(np.asarray(hypos, dtype=np.int64))
+        ranks[np.arange(ranks.shape[1]) >= lengths[:, None]] = 0
+        stats = np.zeros((num_hypos, 2 + 2*self.max_order), dtype=np.int64)
+        stats[:, 0] = lengths
+        diff = np.abs(lengths[:, None] - self.ref_lens[None, :])
+        stats[:, 1] = self.ref_lens[np.argmin(diff, axis=1)]
+        for n in range(1, self.max_order + 1):
+            stats[:, 1 + self.max_order + n] = np.maximum(lengths - n + 1, 0)
+            codes = ngram_codes(ranks, n, self.bits)
+            width = codes.shape[1]
+            ref_codes = self.ref_codes[n-1]
+            if width == 0 or ref_codes.size == 0:
+                continue
+            # n-grams with unknown tokens or padding cannot match
+            unmatched = (ranks[:, :width] == 0)
+            for k in range(1, n):
+                unmatched |= ranks[:, k:k+width] == 0
+            codes[unmatched] = -1
+            # Count each distinct n-gram per row: sort rows and find runs
+            codes.sort(axis=1)
+            flat = codes.ravel()
+            first = np.ones(flat.size, dtype=bool)
+            first[1:] = flat[1:] != flat[:-1]
+            first[::width] = True
+            starts = np.flatnonzero(first)
+            counts = np.diff(np.append(starts, flat.size))
+            codes = flat[starts]
+            keep = codes >= 0
+            starts, counts, codes = starts[keep], counts[keep], codes[keep]
+            idx = np.minimum(np.searchsorted(ref_codes, codes),
+                             ref_codes.size - 1)
+            ref_counts = np.where(ref_codes[idx] == codes,
+                                  self.ref_counts[n-1][idx], 0)
+            stats[:, 1 + n] = np.bincount(
+                starts // width, weights=np.minimum(counts, ref_counts),
+                minlength=num_hypos)
+        return stats
+
+    def score_batch(self, hypos, lengths=None):
+        """Sentence BLEU of all hypotheses, see ``stats()``.
+
+        Returns:
+            ndarray. BLEU scores (0-100)
+        """
+        return bleu_from_stats(self.stats(hypos, lengths), self.max_order)
+
+    def score(self, hypo):
+        """Sentence BLEU of a single sequence of token IDs."""
+        return float(self.score_batch([hypo])[0])
+
 
 def entropy(distribution, base=np.e):
     return -sum(distribution*np.log(distribution, base=base))